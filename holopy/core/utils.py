@@ -238,6 +238,15 @@ def choose_pool(parallel):
     return pool
 
 
+def close_pool(pool):
+    """
+    Close a pool made by `choose_pool` and wait for its workers to exit.
+    """
+    pool.close()
+    if hasattr(pool, 'join'):
+        pool.join()
+
+
 class NonePool():
     def map(self, function, arguments):
         return map(function, arguments)
@@ -27,6 +27,8 @@ from holopy.core.errors import raise_fitting_api_error
 from holopy.scattering.errors import (MultisphereFailure, TmatrixFailure,
                                       InvalidScatterer, MissingParameter)
 from holopy.scattering.interface import calc_holo, interpret_theory
+from holopy.scattering.forwardplan import HologramPlan
+from holopy.scattering.theory.coefficientcache import make_key
 from holopy.inference import prior
 from holopy.core.mapping import Mapper, read_map, edit_map_indices
 
@@ -40,13 +42,23 @@ class Model(HoloPyObject):
 
     Compute probabilities that observed data could be explained by a set of
     scatterer and observation parameters.
+
+    Holograms are calculated as with `calc_holo`; `parallel`,
+    `radius_of_influence` and `truncation_tolerance` are passed on to
+    it, and a pool started for
+    `parallel` is reused for as long as the model is evaluated on the
+    same data.
     """
     _model_parameters = {}
 
     def __init__(self, scatterer, noise_sd=None, medium_index=None,
                  illum_wavelen=None, illum_polarization=None, theory='auto',
-                 constraints=[]):
+                 constraints=[], parallel=None, radius_of_influence=None,
+                 truncation_tolerance=None):
         self._dummy_scatterer = self._create_dummy_scatterer(scatterer)
+        self.parallel = parallel
+        self.radius_of_influence = radius_of_influence
+        self.truncation_tolerance = truncation_tolerance
         self.theory = interpret_theory(self._dummy_scatterer, theory)
         self.constraints = ensure_listlike(constraints)
         if not (np.isscalar(noise_sd)
@@ -337,6 +349,27 @@ class Model(HoloPyObject):
         forward_model = self._forward(pars, data)
         return ((forward_model - data) / noise).values
 
+    def _hologram_plan(self, detector, optics):
+        """
+        A HologramPlan for `detector` and `optics`, reused for as long as
+        the model is evaluated on the same detector with the same optics.
+        """
+        optics_key = make_key(*[
+            repr(optics[key]) if isinstance(optics[key], dict)
+            else optics[key] for key in sorted(optics)])
+        plan = getattr(self, '_plan', None)
+        if (plan is None or plan.detector is not detector or
+                self._plan_optics_key != optics_key):
+            if plan is not None:
+                plan.close()
+            plan = HologramPlan(
+                detector, self.theory, parallel=self.parallel,
+                radius_of_influence=self.radius_of_influence,
+                truncation_tolerance=self.truncation_tolerance, **optics)
+            self._plan = plan
+            self._plan_optics_key = optics_key
+        return plan
+
     def lnlike(self, pars, data):
         """
         Compute the log-likelihood for pars given data
@@ -394,10 +427,12 @@ class AlphaModel(Model):
     """
     def __init__(self, scatterer, alpha=1, noise_sd=None, medium_index=None,
                  illum_wavelen=None, illum_polarization=None, theory='auto',
-                 constraints=[]):
+                 constraints=[], parallel=None, radius_of_influence=None,
+                 truncation_tolerance=None):
         self._model_parameters = {'alpha': alpha}
         super().__init__(scatterer, noise_sd, medium_index, illum_wavelen,
-                         illum_polarization, theory, constraints)
+                         illum_polarization, theory, constraints, parallel,
+                         radius_of_influence, truncation_tolerance)
 
     @property
     def alpha(self):
@@ -417,13 +452,30 @@ class AlphaModel(Model):
             dimensions of the resulting hologram. Metadata taken from
             detector if not given explicitly when instantiating self.
         """
+        plan = self._hologram_plan(detector, self._find_optics(pars, detector))
+        holo = self._calculate_planned_hologram(pars, plan)
+        if np.isscalar(holo):
+            return holo
+        return plan.to_xarray(holo)
+
+    def _residuals(self, pars, data, noise):
+        # For single-color data and noise, skip building an xarray for
+        # the hologram and compare it with the data directly. The
+        # residuals are in the order of the flattened data.
+        if 'illumination' in data.dims or np.size(noise) != 1:
+            return super()._residuals(pars, data, noise)
+        plan = self._hologram_plan(data, self._find_optics(pars, data))
+        if len(plan.shape) > 1:
+            return super()._residuals(pars, data, noise)
+        holo = self._calculate_planned_hologram(pars, plan)
+        return (holo - plan.detector_values.ravel()) / ensure_scalar(noise)
+
+    def _calculate_planned_hologram(self, pars, plan):
         alpha = read_map(self._maps['model'], pars)['alpha']
-        optics = self._find_optics(pars, detector)
         scatterer = self._scatterer_from_parameters(pars)
         theory = self.theory_from_parameters(pars)
         try:
-            return calc_holo(detector, scatterer, theory=theory,
-                             scaling=alpha, **optics)
+            return plan(scatterer, scaling=alpha, theory=theory)
         except (MultisphereFailure, TmatrixFailure, InvalidScatterer):
             return -np.inf
 
@@ -434,9 +486,12 @@ class ExactModel(Model):
     """
     def __init__(self, scatterer, calc_func=calc_holo, noise_sd=None,
                  medium_index=None, illum_wavelen=None,
-                 illum_polarization=None, theory='auto', constraints=[]):
+                 illum_polarization=None, theory='auto', constraints=[],
+                 parallel=None, radius_of_influence=None,
+                 truncation_tolerance=None):
         super().__init__(scatterer, noise_sd, medium_index, illum_wavelen,
-                         illum_polarization, theory, constraints)
+                         illum_polarization, theory, constraints, parallel,
+                         radius_of_influence, truncation_tolerance)
         self.calc_func = calc_func
 
     def _forward(self, pars, detector):
@@ -456,6 +511,9 @@ class ExactModel(Model):
         scatterer = self._scatterer_from_parameters(pars)
         theory = self.theory_from_parameters(pars)
         try:
+            if self.calc_func is calc_holo:
+                plan = self._hologram_plan(detector, optics)
+                return plan.to_xarray(plan(scatterer, theory=theory))
             return self.calc_func(detector, scatterer, theory=theory, **optics)
         except (MultisphereFailure, InvalidScatterer):
             return -np.inf
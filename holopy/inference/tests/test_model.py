@@ -30,6 +30,7 @@ from holopy.core import detector_grid, holopy_object
 from holopy.scattering import (
     Sphere, Spheres, Mie, MieLens, AberratedMieLens, calc_holo, Multisphere)
 from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.multisphere import warm_start_cache
 from holopy.scattering.errors import MissingParameter
 from holopy.core.tests.common import assert_read_matches_write
 from holopy.inference import prior, AlphaModel, ExactModel
@@ -508,6 +509,23 @@ class TestAlphaModel(unittest.TestCase):
 
         self.assertTrue(np.all(from_model.values == correct.values))
 
+    @attr('fast')
+    def test_residuals_same_as_from_forward_model(self):
+        model = AlphaModel(
+            SPHERE_IN_METERS, alpha=prior.Uniform(0, 1.0),
+            theory=MieLens(lens_angle=0.8))
+        pars = {'n': 1.5, 'r': 0.5e-6, 'alpha': 0.7}
+        pars = model.ensure_parameters_are_listlike(pars)
+        data = calc_holo(
+            xschema_lens, SPHERE_IN_METERS, theory=MieLens(lens_angle=0.8),
+            scaling=0.6)
+        noise = 0.1
+        residuals = model._residuals(pars, data, noise)
+        correct = ((model._forward(pars, data) - data) / noise).values
+        self.assertTrue(np.allclose(
+            np.sort(residuals.ravel()), np.sort(correct.ravel()),
+            atol=1e-13, rtol=1e-13))
+
     @attr('fast')
     def test_forward_correctly_creates_aberratedmielens_theory(self):
         n_ab_params = 4
@@ -543,6 +561,57 @@ class TestAlphaModel(unittest.TestCase):
 
         self.assertTrue(np.all(from_model.values == correct.values))
 
+    @attr('medium')
+    def test_forward_reuses_pool_for_superposition(self):
+        spheres = Spheres([
+            Sphere(n=1.5, r=0.5e-6, center=(10e-6, 10e-6, 5e-6)),
+            Sphere(n=1.5, r=prior.Uniform(0.4e-6, 0.6e-6),
+                   center=(5e-6, 5e-6, 5e-6))])
+        model = AlphaModel(spheres, alpha=0.7, theory=Mie(), parallel=1,
+                           radius_of_influence=4e-6)
+        pars = [0.45e-6]
+        first = model.forward(pars, xschema_lens)
+        pool = model._plan._pool
+        second = model.forward(pars, xschema_lens)
+        self.assertTrue(pool is not None)
+        self.assertTrue(model._plan._pool is pool)
+        model._plan.close()
+        correct = calc_holo(
+            xschema_lens, model.scatterer_from_parameters(pars),
+            theory=Mie(), scaling=0.7, radius_of_influence=4e-6)
+        self.assertTrue(np.allclose(first.values, correct.values))
+        self.assertTrue(np.allclose(second.values, correct.values))
+
+    @attr('medium')
+    def test_multisphere_warm_start_carries_over_between_evaluations(self):
+        warm_start_cache.clear()
+        dimer = Spheres([
+            Sphere(n=1.59, r=0.5e-6,
+                   center=(prior.Uniform(2e-6, 3e-6), 2e-6, 5e-6)),
+            Sphere(n=1.59, r=0.5e-6, center=(1.4e-6, 2e-6, 5e-6))])
+        iterations = {}
+        for warm_start in [False, True]:
+            model = AlphaModel(
+                dimer, alpha=0.7,
+                theory=RecordingMultisphere(warm_start=warm_start))
+            RecordingMultisphere.iterations = []
+            for x in 2.5e-6 + 2e-9 * np.arange(4):
+                model.forward([x], xschema_lens)
+            iterations[warm_start] = RecordingMultisphere.iterations
+        self.assertEqual(len(iterations[True]), 4)
+        self.assertLess(max(iterations[True][1:]),
+                        min(iterations[False][1:]))
+
+
+class RecordingMultisphere(Multisphere):
+    """Multisphere which records the iterations of every solution."""
+    iterations = []
+
+    def _scsmfo_setup(self, *args, **kwargs):
+        amn_and_lmax = super()._scsmfo_setup(*args, **kwargs)
+        RecordingMultisphere.iterations.append(max(self.last_iterations))
+        return amn_and_lmax
+
 
 def make_sphere():
     index = prior.Uniform(1.4, 1.6, name='n')
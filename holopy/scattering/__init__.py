@@ -43,6 +43,7 @@ from holopy.scattering.scatterer import (Scatterer, Scatterers, Sphere,
     LayeredSphere, Spheres, RigidCluster, Ellipsoid, Capsule, Cylinder,
     Bisphere, Spheroid, JanusSphere_Uniform, JanusSphere_Tapered)
 from holopy.scattering.interface import (calc_holo, calc_field,
-    calc_intensity, calc_cross_sections, calc_scat_matrix)
+    calc_total_field, calc_intensity, calc_cross_sections,
+    calc_cross_sections_batch, calc_scat_matrix)
 from holopy.scattering.theory import (
     Mie, MieLens, AberratedMieLens, Multisphere, DDA, Tmatrix)
@@ -0,0 +1,210 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Precomputed hologram calculations for repeated evaluation on one detector.
+
+`calc_holo` validates the scatterer, prepares the schema, flattens the
+detector and packs the result into an xarray on every call. In a fit the
+detector and optics never change, so a `HologramPlan` does that work once
+and then returns holograms as plain numpy arrays.
+"""
+import numpy as np
+import xarray as xr
+
+from holopy.core.metadata import flat, dict_to_array, illumination
+from holopy.core.utils import ensure_array, choose_pool, close_pool
+from holopy.scattering.imageformation import (
+    ImageFormation, PRECISIONS, get_wavevec_from,
+    select_scatterer_by_illumination)
+from holopy.scattering.interface import (
+    prep_schema, interpret_theory, finalize)
+
+
+class HologramPlan(object):
+    def __init__(self, detector, theory='auto', medium_index=None,
+                 illum_wavelen=None, illum_polarization=None, parallel=None,
+                 radius_of_influence=None, truncation_tolerance=None,
+                 precision='double'):
+        """Hologram calculation on a fixed detector with fixed optics.
+
+        Parameters
+        ----------
+        detector : xarray object
+            The detector points and calculation metadata used to calculate
+            the hologram.
+        theory : :class:`.theory` object (optional)
+            Scattering theory object to use for the calculation. If
+            'auto', a theory is chosen for each scatterer as in
+            `calc_holo`.
+        medium_index, illum_wavelen, illum_polarization : optional
+            As in `calc_holo`; taken from `detector` if not given.
+        parallel, radius_of_influence, truncation_tolerance : optional
+            How to superpose the fields of non-interacting scatterers; see
+            `ImageFormation`. If `parallel` is not a pool object, the pool
+            it describes is started on the first calculation that uses it
+            and reused until `close` is called.
+        precision : {'double', 'single'}
+            The precision of the calculation and of the returned
+            holograms; see `ImageFormation`.
+
+        Notes
+        -----
+        Unlike `calc_holo`, calling a plan does not check the scatterer
+        for unset parameters or priors, since that check is slower than
+        many scattering calculations.
+        """
+        self.detector = detector
+        self.theory = theory
+        self.parallel = parallel
+        self.radius_of_influence = radius_of_influence
+        self.truncation_tolerance = truncation_tolerance
+        self.precision = precision
+        self._pool = None
+        self.schema = prep_schema(
+            detector, medium_index, illum_wavelen, illum_polarization)
+        self._flat_schema = flat(self.schema)
+        self._is_multicolor = len(ensure_array(self.schema.illum_wavelen)) > 1
+        if self._is_multicolor:
+            self._illuminations = self.schema.illum_wavelen.illumination
+            wavevectors = ensure_array(get_wavevec_from(self.schema).values)
+            polarizations = [
+                self.schema.illum_polarization.sel(illumination=illum)
+                for illum in self._illuminations.values]
+        else:
+            self._illuminations = None
+            wavevectors = [get_wavevec_from(self.schema)]
+            polarizations = [self.schema.illum_polarization]
+        self._wavevectors = wavevectors
+        self._polarizations = polarizations
+        # (nillum, 2) reference fields in the detector plane
+        self._reference_fields = np.array(
+            [p.values[:2] for p in polarizations],
+            dtype=PRECISIONS[precision])
+
+    @property
+    def shape(self):
+        """Shape of the arrays returned by the plan: (npoints,) for a
+        single illumination, (npoints, nillum) for several."""
+        npoints = self._flat_schema.shape[0]
+        if self._is_multicolor:
+            return (npoints, len(self._polarizations))
+        return (npoints,)
+
+    @property
+    def detector_values(self):
+        """The values of the detector at the flattened detector points, in
+        the order of the arrays returned by the plan."""
+        return self._flat_schema.values
+
+    def __call__(self, scatterer, scaling=1.0, theory=None):
+        """Calculate the hologram of a fully-specified `scatterer`.
+
+        Parameters
+        ----------
+        scatterer : :class:`.scatterer` object
+        scaling : float, or dict keyed by illumination
+            Scaling value (alpha) for the amplitude of the reference wave.
+        theory : :class:`.theory` object (optional)
+            Overrides the plan's theory for this calculation, e.g. when
+            fitting theory parameters.
+
+        Returns
+        -------
+        holo : numpy.ndarray
+            The hologram at the flattened detector points, with shape
+            `self.shape`.
+        """
+        if theory is None:
+            theory = self.theory
+        theory = interpret_theory(scatterer, theory)
+        # only superpositions of scatterers are spread over the pool
+        parallel = None if theory.can_handle(scatterer) else self._get_pool()
+        imageformer = ImageFormation(
+            theory, parallel=parallel,
+            radius_of_influence=self.radius_of_influence,
+            truncation_tolerance=self.truncation_tolerance,
+            precision=self.precision)
+        scaling = self._scaling_per_illumination(scaling).astype(
+            PRECISIONS[self.precision])
+        holo = np.zeros(
+            (self._flat_schema.shape[0], len(self._polarizations)),
+            dtype=PRECISIONS[self.precision])
+        for i, polarization in enumerate(self._polarizations):
+            this_scatterer = scatterer
+            if self._is_multicolor:
+                this_scatterer = select_scatterer_by_illumination(
+                    scatterer, self._illuminations.values[i])
+            field = imageformer._calculate_raw_scattered_field(
+                this_scatterer, self._flat_schema, self._wavevectors[i],
+                self.schema.medium_index, polarization)
+            total = field[:, :2] * scaling[i] + self._reference_fields[i]
+            holo[:, i] = (np.abs(total)**2).sum(axis=1)
+        if not self._is_multicolor:
+            holo = holo[:, 0]
+        return holo
+
+    def close(self):
+        """Shut down the pool started by the plan, if any."""
+        if self._pool is not None:
+            close_pool(self._pool)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # a running pool cannot be pickled; copies start their own
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _get_pool(self):
+        if self.parallel is None or hasattr(self.parallel, 'map'):
+            return self.parallel
+        if self._pool is None:
+            self._pool = choose_pool(self.parallel)
+        return self._pool
+
+    def to_xarray(self, holo):
+        """Pack an array returned by the plan into an xarray with the
+        same layout and metadata as the result of `calc_holo`."""
+        flattened = self._flat_schema
+        point_or_flat = ImageFormation._is_detector_view_point_or_flat(
+            flattened)
+        coords = {
+            key: (point_or_flat, val.values)
+            for key, val in flattened[point_or_flat].coords.items()}
+        coords[point_or_flat] = flattened[point_or_flat]
+        dims = [point_or_flat]
+        if self._is_multicolor:
+            coords[illumination] = self._illuminations
+            dims.append(illumination)
+        packed = xr.DataArray(holo, dims=dims, coords=coords)
+        return finalize(self.schema, packed)
+
+    def _scaling_per_illumination(self, scaling):
+        scaling = dict_to_array(self.detector, scaling)
+        if isinstance(scaling, xr.DataArray) and illumination in scaling.dims:
+            scaling = scaling.sel(illumination=self._illuminations).values
+        else:
+            scaling = np.full(len(self._polarizations), ensure_array(
+                getattr(scaling, 'values', scaling)).item())
+        return scaling
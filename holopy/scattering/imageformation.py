@@ -1,3 +1,5 @@
+from functools import partial
+
 import numpy as np
 import xarray as xr
 
@@ -6,16 +8,74 @@ from holopy.core.holopy_object import HoloPyObject
 from holopy.scattering.scatterer import Scatterers
 from holopy.scattering.errors import TheoryNotCompatibleError, MissingParameter
 from holopy.core.metadata import (
-    vector, illumination, flat, update_metadata, clean_concat)
-from holopy.core.utils import ensure_array
+    vector, illumination, flat)
+from holopy.core.utils import ensure_array, choose_pool, close_pool
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key)
+
+detector_coordinate_cache = CoefficientCache(maxsize=4)
+detector_polar_cache = CoefficientCache(maxsize=4)
+support_radius_cache = CoefficientCache(maxsize=256)
+SUPERPOSITION_BATCHSIZE = 32
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+SUPPORT_SAMPLING = 1.0  # spacing in k * rho of the samples used to
+                        # find a scatterer's support radius
 
 
 class ImageFormation(HoloPyObject):
     """
     Calculates fields, holograms, intensities, etc.
     """
-    def __init__(self, scattering_theory):
+    def __init__(self, scattering_theory, parallel=None,
+                 radius_of_influence=None, truncation_tolerance=None,
+                 precision='double'):
+        """
+        Parameters
+        ----------
+        scattering_theory : :mod:`.theory` object
+        parallel : optional
+            How to compute the components of a superposition of
+            non-interacting scatterers: None (serially), a pool object
+            with a `map` method (e.g. a
+            `concurrent.futures.ThreadPoolExecutor`), or any argument
+            accepted by `holopy.core.utils.choose_pool`. Pass a pool
+            object when calculating many holograms, since other choices
+            start a new pool on every calculation.
+        radius_of_influence : float, optional
+            If set, each component of a superposition is only evaluated
+            at detector points within this transverse distance of its
+            center; its field is taken as zero elsewhere.
+        truncation_tolerance : float, optional
+            If set, each component of a superposition gets its own
+            support radius instead of `radius_of_influence`: the largest
+            distance from its center at which the hologram term it
+            contributes, 2 * abs(E_scat), exceeds `truncation_tolerance`
+            times the detector's `noise_sd`. The radius is found from the
+            field along the x and y axes through the component's center,
+            so it is exact for spheres and approximate for scatterers
+            without axial symmetry.
+        precision : {'double', 'single'}
+            The floating-point precision of the calculated fields. With
+            'single', the detector positions are passed to the theory in
+            float32 and the fields are stored in complex64, which halves
+            the memory needed for large detectors. Theories that work in
+            double precision internally (e.g. the Fortran Mie code) have
+            their results rounded, so the fields agree with 'double' to a
+            relative error of about 1e-6, plus about 1e-7 times the
+            largest k * rho on the detector from rounding the positions.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of {}, not {}".format(
+                list(PRECISIONS), precision))
         self.scattering_theory = scattering_theory
+        self.parallel = parallel
+        self.radius_of_influence = radius_of_influence
+        self.truncation_tolerance = truncation_tolerance
+        self.precision = precision
+
+    @property
+    def _complex_dtype(self):
+        return np.result_type(PRECISIONS[self.precision], np.complex64)
 
     def calculate_scattered_field(self, scatterer, schema):
         """
@@ -38,6 +98,41 @@ class ImageFormation(HoloPyObject):
             self._calculate_single_color_scattered_field(scatterer, schema))
         return field
 
+    def calculate_total_field(self, scatterer, schema):
+        """
+        The total field inside and around a scatterer: the internal field
+        inside it, and the incident plus the scattered field outside.
+
+        Parameters
+        ----------
+        scatterer : :mod:`.scatterer` object
+            a scatterer the theory can calculate internal fields for
+
+        Returns
+        -------
+        e_field : :mod:`.VectorGrid`
+            total electric field, with the phase of the incident field
+            referenced to the plane z = 0 as in `calculate_scattered_field`
+        """
+        if scatterer.center is None:
+            raise MissingParameter("center")
+        if not (hasattr(self.scattering_theory, 'raw_total_fields') and
+                self.scattering_theory.can_handle(scatterer)):
+            raise TheoryNotCompatibleError(self.scattering_theory, scatterer)
+        if len(ensure_array(schema.illum_wavelen)) > 1:
+            raise ValueError("Total fields can only be calculated for a "
+                             "single illumination")
+        wavevector = get_wavevec_from(schema)
+        positions = self._transform_to_desired_coordinates(
+            schema, scatterer.center, wavevec=wavevector)
+        field = np.transpose(self.scattering_theory.raw_total_fields(
+            positions, scatterer, medium_wavevec=wavevector,
+            medium_index=schema.medium_index,
+            illum_polarization=schema.illum_polarization))
+        field = field * np.exp(-1j * wavevector * scatterer.center[2])
+        return self._pack_field_into_xarray(
+            field.astype(self._complex_dtype, copy=False), schema)
+
     def calculate_cross_sections(
             self, scatterer, medium_wavevec, medium_index, illum_polarization):
         raw_sections = self.scattering_theory.raw_cross_sections(
@@ -71,38 +166,127 @@ class ImageFormation(HoloPyObject):
             scat_matrs, positions, schema)
 
     def _calculate_multiple_color_scattered_field(self, scatterer, schema):
-        field = []
-        for illum in schema.illum_wavelen.illumination.values:
-            this_schema = update_metadata(
-                schema,
-                illum_wavelen=ensure_array(
-                    schema.illum_wavelen.sel(illumination=illum).values)[0],
-                illum_polarization=ensure_array(
-                    schema.illum_polarization.sel(illumination=illum).values))
+        # The fields for every illumination are written into one array,
+        # which is only packed into an xarray at the end.
+        illuminations = schema.illum_wavelen.illumination
+        wavevectors = ensure_array(get_wavevec_from(schema).values)
+        field = np.zeros(
+            (schema.size, 3, len(illuminations)), dtype=self._complex_dtype)
+        for i, illum in enumerate(illuminations.values):
             this_scatterer = select_scatterer_by_illumination(scatterer, illum)
-            this_field = self._calculate_single_color_scattered_field(
-                this_scatterer, this_schema)
-            field.append(this_field)
-        field = clean_concat(field, dim=schema.illum_wavelen.illumination)
-        return field
+            field[..., i] = self._calculate_raw_scattered_field(
+                this_scatterer, schema, wavevectors[i],
+                schema.medium_index,
+                schema.illum_polarization.sel(illumination=illum))
+        return self._pack_field_into_xarray(
+            field, schema, illumination=illuminations)
 
     def _calculate_scattered_field_from_superposition(
             self, scatterers, schema):
-        field = self._calculate_single_color_scattered_field(
-            scatterers[0], schema)
-        for s in scatterers[1:]:
-            field += self._calculate_single_color_scattered_field(s, schema)
-        return field
+        field = self._calculate_raw_field_from_superposition(
+            scatterers, schema, get_wavevec_from(schema),
+            schema.medium_index, schema.illum_polarization)
+        return self._pack_field_into_xarray(field, schema)
 
     def _calculate_single_color_scattered_field(self, scatterer, schema):
+        field = self._calculate_raw_scattered_field(
+            scatterer, schema, get_wavevec_from(schema),
+            schema.medium_index, schema.illum_polarization)
+        return self._pack_field_into_xarray(field, schema)
+
+    def _calculate_raw_scattered_field(
+            self, scatterer, detector, wavevector, medium_index,
+            illum_polarization):
+        """
+        The scattered field for a single illumination, as a numpy.ndarray
+        of shape (npoints, 3), for the points of `detector` in the order
+        of `flat(detector)`.
+        """
+        args = (detector, wavevector, medium_index, illum_polarization)
         if self.scattering_theory.can_handle(scatterer):
-            field = self._get_field_from(scatterer, schema)
+            field = self._get_raw_field_from(scatterer, *args)
         elif isinstance(scatterer, Scatterers):
-            field = self._calculate_scattered_field_from_superposition(
-                scatterer.get_component_list(), schema)
+            field = self._calculate_raw_field_from_superposition(
+                scatterer.get_component_list(), *args)
         else:
             raise TheoryNotCompatibleError(self.scattering_theory, scatterer)
-        return self._pack_field_into_xarray(field, schema)
+        return field
+
+    def _calculate_raw_field_from_superposition(
+            self, scatterers, detector, wavevector, medium_index,
+            illum_polarization):
+        # Components are computed in batches, so that at most a batch of
+        # per-component position and field arrays exist at once, and are
+        # added into a single preallocated buffer.
+        field = np.zeros((detector.size, 3), dtype=self._complex_dtype)
+        pool = choose_pool(self.parallel)
+        try:
+            for start in range(0, len(scatterers), SUPERPOSITION_BATCHSIZE):
+                batch = scatterers[start:start + SUPERPOSITION_BATCHSIZE]
+                tasks = []
+                for s in batch:
+                    if not self.scattering_theory.can_handle(s):
+                        field += self._calculate_raw_scattered_field(
+                            s, detector, wavevector, medium_index,
+                            illum_polarization)
+                        continue
+                    radius = self._support_radius(
+                        s, detector, wavevector, medium_index,
+                        illum_polarization)
+                    points = self._points_within_radius_of_influence(
+                        detector, s.center, radius)
+                    positions = self._transform_to_desired_coordinates(
+                        detector, s.center, wavevec=wavevector,
+                        points=points)
+                    tasks.append((points, (
+                        s, positions, wavevector, medium_index,
+                        illum_polarization)))
+                fields = pool.map(
+                    partial(_calculate_raw_fields, self.scattering_theory),
+                    [task for _, task in tasks])
+                for (points, _), this_field in zip(tasks, fields):
+                    if points is None:
+                        field += this_field
+                    else:
+                        field[points] += this_field
+        finally:
+            if pool is not self.parallel:
+                close_pool(pool)
+        return field
+
+    def _support_radius(self, scatterer, detector, wavevector,
+                        medium_index, illum_polarization):
+        """The transverse distance from `scatterer` beyond which its field
+        is neglected, or None to evaluate it everywhere."""
+        if self.truncation_tolerance is None or _is_far_field(detector):
+            return self.radius_of_influence
+        noise_sd = detector.attrs.get('noise_sd')
+        if noise_sd is None:
+            raise MissingParameter('noise_sd')
+        threshold = self.truncation_tolerance * np.min(
+            ensure_array(getattr(noise_sd, 'values', noise_sd)))
+        x, y, z = get_flat_coordinates(detector)
+        extent = np.hypot(np.ptp(x), np.ptp(y))
+        # The radius only depends on the height of the scatterer above the
+        # detector, so it is cached for the scatterer moved onto the axis.
+        on_axis = scatterer.translated(
+            -scatterer.center[0], -scatterer.center[1], -np.mean(z))
+        key = make_key(
+            'support', repr(self.scattering_theory), repr(on_axis),
+            wavevector, medium_index, illum_polarization, threshold, extent)
+        return support_radius_cache.get(key, lambda: _calculate_support_radius(
+            self.scattering_theory, on_axis, extent, wavevector, medium_index,
+            illum_polarization, threshold))
+
+    def _points_within_radius_of_influence(self, detector, center, radius):
+        """Indices of the detector points within `radius` of `center`,
+        where a scatterer at `center` is evaluated, or None for all of
+        them."""
+        if radius is None or _is_far_field(detector):
+            return None
+        x, y, _ = get_flat_coordinates(detector)
+        rho_squared = (x - center[0])**2 + (y - center[1])**2
+        return np.flatnonzero(rho_squared <= radius**2)
 
     def _get_field_from(self, scatterer, schema):
         """
@@ -116,26 +300,27 @@ class ImageFormation(HoloPyObject):
         -------
         raveled fields, shape (npoints = nx*ny = schema.shape.prod(), 3)
         """
-        wavevector = get_wavevec_from(schema)
+        return self._get_raw_field_from(
+            scatterer, schema, get_wavevec_from(schema), schema.medium_index,
+            schema.illum_polarization)
+
+    def _get_raw_field_from(self, scatterer, detector, wavevector,
+                            medium_index, illum_polarization):
         positions = self._transform_to_desired_coordinates(
-            schema, scatterer.center, wavevec=wavevector)
-        scattered_field = np.transpose(
-            self.scattering_theory.raw_fields(
-                positions,
-                scatterer,
-                medium_wavevec=wavevector,
-                medium_index=schema.medium_index,
-                illum_polarization=schema.illum_polarization)
-            )
-        phase = np.exp(-1j * wavevector * scatterer.center[2])
-        scattered_field *= phase
-        return scattered_field
+            detector, scatterer.center, wavevec=wavevector)
+        return _calculate_raw_fields(
+            self.scattering_theory,
+            (scatterer, positions, wavevector, medium_index,
+             illum_polarization))
 
-    def _pack_field_into_xarray(self, scattered_field, schema):
+    def _pack_field_into_xarray(self, scattered_field, schema,
+                                illumination=None):
         """Packs the numpy.ndarray, shape (N, 3) ``scattered_field`` into
         an xr.DataArray, shape (N, 3). This function needs to pack the
         fields [flat or point, vector], with the coordinates the
-        same as that of the schema."""
+        same as that of the schema. If `illumination` is passed, the
+        field has shape (N, 3, len(illumination)) and is packed as
+        [flat or point, vector, illumination]."""
         flattened_schema = flat(schema)  # now either point or flat
         point_or_flat = self._is_detector_view_point_or_flat(flattened_schema)
         coords = {
@@ -145,9 +330,12 @@ class ImageFormation(HoloPyObject):
         coords.update(
             {point_or_flat: flattened_schema[point_or_flat],
              vector: ['x', 'y', 'z']})
+        dims = [point_or_flat, vector]
+        if illumination is not None:
+            coords.update({illumination.name: illumination})
+            dims.append(illumination.name)
         scattered_field = xr.DataArray(
-            scattered_field, dims=[point_or_flat, vector], coords=coords,
-            attrs=schema.attrs)
+            scattered_field, dims=dims, coords=coords, attrs=schema.attrs)
         return scattered_field
 
     def _pack_scattering_matrix_into_xarray(
@@ -186,8 +374,9 @@ class ImageFormation(HoloPyObject):
             raise ValueError(msg)
         return point_or_flat
 
-    def _transform_to_desired_coordinates(self, detector, origin, wavevec=1):
-        if hasattr(detector, 'theta') and hasattr(detector, 'phi'):
+    def _transform_to_desired_coordinates(self, detector, origin, wavevec=1,
+                                          points=None):
+        if _is_far_field(detector):
             original_coordinate_system = 'spherical'
             original_coordinate_values = [
                 (detector.r.values * wavevec if hasattr(detector, 'r')
@@ -195,35 +384,169 @@ class ImageFormation(HoloPyObject):
                 detector.theta.values,
                 detector.phi.values,
                 ]
-        else:
+            if points is not None:
+                original_coordinate_values = [
+                    v[points] for v in original_coordinate_values]
+        elif self.scattering_theory.desired_coordinate_system == 'cartesian':
             original_coordinate_system = 'cartesian'
-            f = flat(detector)  # 1.6 ms
+            x, y, z = get_flat_coordinates(detector)
+            if points is not None:
+                x, y, z = x[points], y[points], z[points]
+            original_coordinate_values = [
+                wavevec * (x - origin[0]),
+                wavevec * (y - origin[1]),
+                wavevec * (origin[2] - z),
+                # z is defined opposite light propagation, so we invert
+                ]
+        else:
+            # The transverse polar coordinates are cached, so a scatterer
+            # moved along z or seen at another wavelength only needs the
+            # axial offset and the scaling by the wavevector.
+            original_coordinate_system = 'cylindrical'
+            rho, phi = get_polar_coordinates(detector, origin, points)
+            z = get_flat_coordinates(detector)[2]
+            if points is not None:
+                z = z[points]
             original_coordinate_values = [
-                wavevec * (f.x.values - origin[0]),
-                wavevec * (f.y.values - origin[1]),
-                wavevec * (origin[2] - f.z.values),
+                np.asarray(wavevec * rho),
+                phi,
+                np.asarray(wavevec * (origin[2] - z)),
                 # z is defined opposite light propagation, so we invert
                 ]
         method = find_transformation_function(
             original_coordinate_system,
             self.scattering_theory.desired_coordinate_system)
-        return method(original_coordinate_values)
+        return method(original_coordinate_values).astype(
+            PRECISIONS[self.precision], copy=False)
 
 
 def select_scatterer_by_illumination(scatterer, illum):
     select_parameters = {}
+    depends_on_illumination = False
     for key, val in scatterer.parameters.items():
         selected_val = val
         if isinstance(val, dict) and illum in val.keys():
             selected_val = val[illum]
+            depends_on_illumination = True
         elif isinstance(val, xr.DataArray):
             try:
                 selected_val = val.sel(illumination=illum).values
+                depends_on_illumination = True
             except (KeyError, ValueError):
                 pass
         select_parameters[key] = selected_val
+    if not depends_on_illumination:
+        # nothing to select, so skip rebuilding the scatterer
+        return scatterer
     return scatterer.from_parameters(select_parameters)
 
 
+def _calculate_raw_fields(theory, component):
+    """
+    The (npoints, 3) scattered field of one scatterer, with the phase
+    referenced to the plane z = 0, in the complex precision matching
+    `positions`. Module-level so it can be sent to a process pool.
+    """
+    scatterer, positions, wavevector, medium_index, illum_polarization = (
+        component)
+    dtype = np.result_type(positions, np.complex64)
+    scattered_field = np.transpose(
+        theory.raw_fields(
+            positions,
+            scatterer,
+            medium_wavevec=wavevector,
+            medium_index=medium_index,
+            illum_polarization=illum_polarization)
+        ).astype(dtype, copy=False)
+    phase = np.exp(-1j * wavevector * scatterer.center[2])
+    scattered_field *= phase
+    return scattered_field
+
+
+def _calculate_support_radius(theory, scatterer, extent, wavevector,
+                              medium_index, illum_polarization, threshold):
+    """
+    The largest distance, up to `extent`, from the optical axis at which
+    twice the transverse scattered field of `scatterer`, centered on the
+    axis above the plane z = 0, exceeds `threshold`.
+    """
+    krho = np.arange(0, wavevector * extent + SUPPORT_SAMPLING,
+                     SUPPORT_SAMPLING)
+    zeros = np.zeros_like(krho)
+    kz = np.full(2 * krho.size, wavevector * scatterer.center[2])
+    positions = find_transformation_function(
+        'cartesian', theory.desired_coordinate_system)(
+            [np.concatenate([krho, zeros]), np.concatenate([zeros, krho]),
+             kz])
+    field = theory.raw_fields(
+        positions, scatterer, medium_wavevec=wavevector,
+        medium_index=medium_index, illum_polarization=illum_polarization)
+    magnitude = np.linalg.norm(np.asarray(field)[:2], axis=0)
+    magnitude = magnitude.reshape(2, krho.size).max(axis=0)
+    above = np.flatnonzero(2 * magnitude > threshold)
+    if above.size == 0:
+        return 0.0
+    # pad by one sample so the fringes at the edge are not clipped
+    return krho[min(above[-1] + 1, krho.size - 1)] / wavevector
+
+
+def _is_far_field(detector):
+    return hasattr(detector, 'theta') and hasattr(detector, 'phi')
+
+
+def get_flat_coordinates(detector):
+    """
+    The x, y, z coordinates of the points of `detector`, in the order of
+    `flat(detector)`, as a (3, N) numpy.ndarray.
+
+    Flattening a detector grid takes a few ms, which is comparable to the
+    scattering calculation for small grids, so the coordinates of the
+    most recently used grids are cached by their geometry. The
+    coordinates of detectors which are already flat are read directly.
+    """
+    def flatten():
+        f = flat(detector)  # 1.6 ms
+        return np.array([f.x.values, f.y.values, f.z.values], dtype=float)
+    if _is_flat(detector):
+        return flatten()
+    return detector_coordinate_cache.get(_grid_key(detector), flatten)
+
+
+def get_polar_coordinates(detector, center, points=None):
+    """
+    The distances and azimuthal angles, as a (2, N) numpy.ndarray, of the
+    points of `detector` from the axis through `center` along z, in the
+    order of `flat(detector)`. If `points` is given, only the selected
+    points are computed.
+
+    For whole detector grids these are cached by the grid geometry and
+    the transverse position of `center`, since they do not change when a
+    scatterer only moves along z or changes wavelength. Subsets are not
+    cached; they are cheap and rarely repeat.
+    """
+    def calculate():
+        x, y, _ = get_flat_coordinates(detector)
+        if points is not None:
+            x, y = x[points], y[points]
+        dx = x - center[0]
+        dy = y - center[1]
+        return np.array([np.sqrt(dx**2 + dy**2),
+                         np.arctan2(dy, dx) % (2 * np.pi)])
+    if points is not None or _is_flat(detector):
+        return calculate()
+    key = _grid_key(detector) + make_key(center[0], center[1])
+    return detector_polar_cache.get(key, calculate)
+
+
+def _is_flat(detector):
+    return hasattr(detector, 'flat') or hasattr(detector, 'point')
+
+
+def _grid_key(detector):
+    """A cache key for the geometry of an unflattened detector grid."""
+    return make_key('grid', ' '.join(detector.dims), detector.shape,
+                    detector.x, detector.y, detector.z)
+
+
 def get_wavevec_from(schema):
     return 2 * np.pi / (schema.illum_wavelen / schema.medium_index)
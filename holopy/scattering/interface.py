@@ -167,7 +167,9 @@ def calc_intensity(detector, scatterer, medium_index=None, illum_wavelen=None,
 
 
 def calc_holo(detector, scatterer, medium_index=None, illum_wavelen=None,
-              illum_polarization=None, theory='auto', scaling=1.0):
+              illum_polarization=None, theory='auto', scaling=1.0,
+              precision='double', parallel=None, radius_of_influence=None,
+              truncation_tolerance=None):
     """
     Calculate hologram formed by interference between scattered
     fields and a reference wave
@@ -190,6 +192,20 @@ def calc_holo(detector, scatterer, medium_index=None, illum_wavelen=None,
         If there is not a clear choice, `calc_holo` will error out and
         ask you to specify a theory
     scaling : scaling value (alpha) for amplitude of reference wave
+    precision : {'double', 'single'}
+        With 'single', the fields and hologram are calculated in complex64
+        and float32. See :class:`.ImageFormation` for the accuracy.
+    parallel : optional
+        Pool, or argument to `holopy.core.utils.choose_pool`, over which
+        the components of a superposition of non-interacting scatterers
+        are spread. A pool started here is shut down before returning.
+    radius_of_influence : float, optional
+        If set, each component of a superposition is only evaluated at
+        detector points within this transverse distance of its center.
+    truncation_tolerance : float, optional
+        If set, each component of a superposition is only evaluated where
+        its hologram term exceeds this multiple of the detector's
+        `noise_sd`; see :class:`.ImageFormation`.
 
     Returns
     -------
@@ -201,8 +217,12 @@ def calc_holo(detector, scatterer, medium_index=None, illum_wavelen=None,
         detector, medium_index, illum_wavelen, illum_polarization)
     scaling = dict_to_array(detector, scaling)
     theory = interpret_theory(scatterer, theory)
-    imageformer = ImageFormation(theory)
+    imageformer = ImageFormation(
+        theory, parallel=parallel, radius_of_influence=radius_of_influence,
+        truncation_tolerance=truncation_tolerance, precision=precision)
     scattered_field = imageformer.calculate_scattered_field(scatterer, uschema)
+    if isinstance(scaling, xr.DataArray):
+        scaling = scaling.astype(np.finfo(scattered_field.dtype).dtype)
     reference_field = uschema.illum_polarization
     holo = scattered_field_to_hologram(
         scattered_field * scaling, reference_field)
@@ -247,6 +267,54 @@ def calc_cross_sections(scatterer, medium_index=None, illum_wavelen=None,
     return cross_section
 
 
+def calc_cross_sections_batch(n, r, medium_index, illum_wavelen, *,
+                              theory=None, parallel=None):
+    """
+    Calculate cross sections and asymmetry parameters of many homogeneous
+    spheres at once, e.g. for spectra of polydisperse suspensions.
+
+    Parameters
+    ----------
+    n, r, medium_index, illum_wavelen : float, array-like or xarray.DataArray
+        Sphere refractive indices and radii, medium refractive index and
+        illumination wavelength, in the order of the `Sphere` and
+        `calc_cross_sections` arguments. These are broadcast against each
+        other as xarray does: DataArrays by dimension name, so that e.g.
+        `r` along a dimension 'r' and `illum_wavelen` along a dimension
+        'illum_wavelen' give every combination, and plain arrays as
+        DataArrays with the default dimension names dim_0, dim_1, ...,
+        so that plain arrays of the same shape are paired elementwise.
+    theory : :class:`.Mie` object (optional)
+        Mie theory object whose settings are used; defaults to Mie().
+    parallel : optional
+        Pool or argument to `holopy.core.utils.choose_pool` used to spread
+        the calculation over workers.
+
+    Returns
+    -------
+    cross_sections : xarray.DataArray
+        Dimensional scattering, absorption, and extinction cross sections,
+        and <cos theta>, with the broadcast dimensions of the inputs and a
+        final 'cross_section' dimension, labelled as for
+        `calc_cross_sections`.
+    """
+    if theory is None:
+        theory = Mie()
+    n, r, medium_index, illum_wavelen = xr.broadcast(*[
+        val if isinstance(val, xr.DataArray) else xr.DataArray(val)
+        for val in (n, r, medium_index, illum_wavelen)])
+    medium_wavevec = 2 * np.pi / (illum_wavelen / medium_index)
+    cross_sections = theory.raw_cross_sections_batch(
+        n.values, r.values, medium_wavevec.values, medium_index.values,
+        parallel=parallel)
+    coords = {key: val for key, val in r.coords.items()}
+    coords['cross_section'] = ['scattering', 'absorbtion',
+                               'extinction', 'assymetry']
+    return xr.DataArray(
+        np.moveaxis(cross_sections, 0, -1).reshape(r.shape + (4,)),
+        dims=r.dims + ('cross_section',), coords=coords)
+
+
 def calc_scat_matrix(detector, scatterer, medium_index=None, illum_wavelen=None,
                      theory='auto'):
     """
@@ -325,6 +393,46 @@ def calc_field(detector, scatterer, medium_index=None, illum_wavelen=None,
     return finalize(uschema, result)
 
 
+def calc_total_field(detector, scatterer, medium_index=None,
+                     illum_wavelen=None, illum_polarization=None,
+                     theory='auto'):
+    """
+    Calculate the total field inside and around a scatterer: the internal
+    field inside it, and the incident plus the scattered field outside.
+
+    Unlike `calc_field`, the detector points may be inside the scatterer,
+    so this gives full-volume field maps, e.g. for optical forces. Only
+    :class:`.Mie` theory, for spheres and layered spheres, can calculate
+    internal fields. The points are evaluated in chunks, so the memory
+    needed beyond the detector and the result does not grow with the
+    number of points.
+
+    Parameters
+    ----------
+    detector : xarray object
+        The points (e.g. from `detector_points`) at which to calculate the
+        field, and the calculation metadata.
+    scatterer : :class:`.scatterer` object
+        Scatterer for which to compute the field
+    medium_index, illum_wavelen, illum_polarization, theory : optional
+        As in `calc_field`; a single illumination wavelength only.
+
+    Returns
+    -------
+    e_field : :class:`.Vector` object
+        Total field, with the incident field referenced to the plane z = 0
+        as in `calc_field`
+    """
+    scatterer = validate_scatterer(scatterer)
+    uschema = prep_schema(
+        detector, medium_index=medium_index, illum_wavelen=illum_wavelen,
+        illum_polarization=illum_polarization)
+    theory = interpret_theory(scatterer, theory)
+    imageformer = ImageFormation(theory)
+    result = imageformer.calculate_total_field(scatterer, uschema)
+    return finalize(uschema, result)
+
+
 # this is pulled out separate from the calc_holo method because
 # occasionally you want to turn prepared  e_fields into holograms directly
 def scattered_field_to_hologram(scat, ref):
@@ -338,7 +446,8 @@ def scattered_field_to_hologram(scat, ref):
     ref : xarray[vector]]
         The reference field
     """
-    total_field = scat + ref
+    # match the precision of the scattered field
+    total_field = scat + ref.astype(np.result_type(scat, np.float32))
     holo = (np.abs(total_field.sel(vector=['x', 'y']))**2).sum(dim=vector)
     return holo
 
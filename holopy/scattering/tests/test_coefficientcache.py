@@ -0,0 +1,151 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+import numpy as np
+from numpy.testing import assert_equal
+from nose.plugins.attrib import attr
+
+from holopy.scattering import Sphere, calc_holo, calc_cross_sections
+from holopy.scattering.theory import Mie
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key, scattering_coefficient_cache)
+from holopy.scattering.theory.mielensfunctions import MieScatteringMatrix
+from holopy.scattering.tests.common import (
+    sphere, xschema, wavelen, index, radius)
+
+
+class TestCoefficientCache(unittest.TestCase):
+    @attr("fast")
+    def test_counts_hits_and_misses(self):
+        cache = CoefficientCache(maxsize=4)
+        cache.get('a', lambda: 1)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        self.assertEqual(cache.info(), (1, 2, 4, 2))
+
+    @attr("fast")
+    def test_does_not_recompute_on_hit(self):
+        cache = CoefficientCache()
+        calls = []
+        compute = lambda: calls.append(1) or np.arange(3)
+        first = cache.get('a', compute)
+        second = cache.get('a', compute)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(first is second)
+
+    @attr("fast")
+    def test_evicts_least_recently_used(self):
+        cache = CoefficientCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)
+        cache.get('c', lambda: 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', lambda: None), 1)
+        self.assertEqual(cache.get('b', lambda: None), None)
+
+    @attr("fast")
+    def test_resize_evicts(self):
+        cache = CoefficientCache(maxsize=3)
+        for key in 'abc':
+            cache.get(key, lambda: key)
+        cache.resize(1)
+        self.assertEqual(cache.info().currsize, 1)
+
+    @attr("fast")
+    def test_zero_maxsize_disables_caching(self):
+        cache = CoefficientCache(maxsize=0)
+        cache.get('a', lambda: 1)
+        cache.get('a', lambda: 1)
+        self.assertEqual(cache.info(), (0, 2, 0, 0))
+
+    @attr("fast")
+    def test_clear(self):
+        cache = CoefficientCache()
+        cache.get('a', lambda: 1)
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 128, 0))
+
+    @attr("fast")
+    def test_cached_arrays_are_readonly(self):
+        cache = CoefficientCache()
+        values = cache.get('a', lambda: (np.zeros(2), np.ones(2)))
+        self.assertFalse(any(v.flags.writeable for v in values))
+
+    @attr("fast")
+    def test_put_replaces_value(self):
+        cache = CoefficientCache()
+        cache.get('a', lambda: 1)
+        cache.put('a', np.zeros(2))
+        value = cache.get('a', lambda: None)
+        assert_equal(value, np.zeros(2))
+        self.assertFalse(value.flags.writeable)
+        self.assertEqual(len(cache), 1)
+
+    @attr("fast")
+    def test_make_key_is_hashable_for_arrays(self):
+        key = make_key('mie', [1.59, 1.4], np.array([0.5, 0.6]), 2.0, None)
+        self.assertEqual(hash(key), hash(make_key(
+            'mie', (1.59, 1.4), [0.5, 0.6], np.float64(2.0), None)))
+
+
+class TestCachedTheories(unittest.TestCase):
+    def setUp(self):
+        scattering_coefficient_cache.clear()
+
+    @attr("fast")
+    def test_mie_coefficients_reused_when_sphere_moves(self):
+        calc_holo(xschema, sphere, index, wavelen, theory=Mie())
+        calc_holo(xschema, sphere.translated(1e-7, 0, 2e-7), index, wavelen,
+                  theory=Mie())
+        info = scattering_coefficient_cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    @attr("fast")
+    def test_mie_holograms_unchanged_by_cache(self):
+        first = calc_holo(xschema, sphere, index, wavelen, theory=Mie())
+        second = calc_holo(xschema, sphere, index, wavelen, theory=Mie())
+        assert_equal(first.values, second.values)
+
+    @attr("fast")
+    def test_cross_sections_share_mie_coefficients(self):
+        calc_holo(xschema, sphere, index, wavelen, theory=Mie())
+        calc_cross_sections(sphere, index, wavelen, (1, 0))
+        self.assertEqual(scattering_coefficient_cache.info().hits, 1)
+
+    @attr("fast")
+    def test_new_radius_is_a_miss(self):
+        calc_cross_sections(sphere, index, wavelen, (1, 0))
+        calc_cross_sections(
+            Sphere(n=sphere.n, r=1.1 * radius, center=sphere.center),
+            index, wavelen, (1, 0))
+        self.assertEqual(scattering_coefficient_cache.info().misses, 2)
+
+    @attr("fast")
+    def test_mielens_parallel_and_perpendicular_share_coefficients(self):
+        kwargs = {'index_ratio': 1.2, 'size_parameter': 7.3}
+        theta = np.linspace(0, 1, 5)
+        MieScatteringMatrix('parallel', **kwargs)(theta)
+        MieScatteringMatrix('perpendicular', **kwargs)(theta)
+        info = scattering_coefficient_cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+import pickle
+import unittest
+
+import numpy as np
+from nose.plugins.attrib import attr
+
+from holopy.core.metadata import (
+    detector_grid, detector_points, update_metadata, flat)
+from holopy.scattering import Sphere, Spheres, calc_holo
+from holopy.scattering.forwardplan import HologramPlan
+from holopy.scattering.theory import Mie, MieLens
+
+OPTICS = {'medium_index': 1.33, 'illum_wavelen': 0.66,
+          'illum_polarization': (1, 0)}
+SPHERE = Sphere(n=1.59, r=0.5, center=(2, 2, 5))
+TOLS = {'atol': 1e-14, 'rtol': 1e-14}
+
+
+class TestHologramPlan(unittest.TestCase):
+    @attr("fast")
+    def test_same_as_calc_holo(self):
+        detector = detector_grid(20, 0.2)
+        plan = HologramPlan(detector, Mie(), **OPTICS)
+        holo = plan.to_xarray(plan(SPHERE, scaling=0.8))
+        correct = calc_holo(detector, SPHERE, theory=Mie(), scaling=0.8,
+                            **OPTICS)
+        self.assertEqual(holo.dims, correct.dims)
+        self.assertTrue(np.allclose(holo.values, correct.values, **TOLS))
+
+    @attr("fast")
+    def test_returns_flattened_array(self):
+        detector = detector_grid(20, 0.2)
+        plan = HologramPlan(detector, Mie(), **OPTICS)
+        holo = plan(SPHERE)
+        correct = flat(calc_holo(detector, SPHERE, theory=Mie(), **OPTICS))
+        self.assertEqual(type(holo), np.ndarray)
+        self.assertEqual(holo.shape, plan.shape)
+        self.assertTrue(np.allclose(holo, correct.values, **TOLS))
+
+    @attr("fast")
+    def test_detector_points(self):
+        detector = detector_points(x=[1, 2, 3], y=[1, 3, 2], z=0)
+        plan = HologramPlan(detector, **OPTICS)
+        holo = plan.to_xarray(plan(SPHERE))
+        correct = calc_holo(detector, SPHERE, **OPTICS)
+        self.assertEqual(holo.dims, ('point',))
+        self.assertTrue(np.allclose(holo.values, correct.values, **TOLS))
+
+    @attr("fast")
+    def test_superposition(self):
+        detector = detector_grid(10, 0.2)
+        spheres = Spheres([SPHERE, Sphere(n=1.5, r=0.3, center=(1, 1, 4))])
+        plan = HologramPlan(detector, Mie(), **OPTICS)
+        correct = calc_holo(detector, spheres, theory=Mie(), **OPTICS)
+        self.assertTrue(np.allclose(
+            plan.to_xarray(plan(spheres)).values, correct.values, **TOLS))
+
+    @attr("fast")
+    def test_multiple_colors(self):
+        detector = detector_grid(
+            10, 0.2, extra_dims={'illumination': ['red', 'green']})
+        optics = {'medium_index': 1.33,
+                  'illum_wavelen': {'red': 0.66, 'green': 0.52},
+                  'illum_polarization': {'red': (1, 0), 'green': (0, 1)}}
+        scatterer = Sphere(
+            n={'red': 1.59, 'green': 1.6}, r=0.5, center=(1, 1, 5))
+        scaling = {'red': 0.8, 'green': 0.9}
+        plan = HologramPlan(detector, **optics)
+        holo = plan.to_xarray(plan(scatterer, scaling=scaling))
+        correct = calc_holo(detector, scatterer, scaling=scaling, **optics)
+        self.assertEqual(plan.shape, (100, 2))
+        self.assertEqual(holo.dims, correct.dims)
+        self.assertTrue(np.allclose(holo.values, correct.values, **TOLS))
+
+    @attr("fast")
+    def test_single_precision(self):
+        detector = detector_grid(10, 0.2)
+        plan = HologramPlan(detector, Mie(), precision='single', **OPTICS)
+        holo = plan(SPHERE, scaling=0.8)
+        correct = calc_holo(detector, SPHERE, theory=Mie(), scaling=0.8,
+                            precision='single', **OPTICS)
+        self.assertEqual(holo.dtype, np.float32)
+        self.assertEqual(correct.dtype, np.float32)
+        self.assertTrue(np.allclose(holo, flat(correct).values, rtol=1e-6))
+
+    @attr("fast")
+    def test_theory_can_be_overridden(self):
+        detector = update_metadata(detector_grid(10, 0.2), **OPTICS)
+        plan = HologramPlan(detector, MieLens(lens_angle=0.6))
+        holo = plan(SPHERE, theory=MieLens(lens_angle=0.9))
+        correct = calc_holo(detector, SPHERE, theory=MieLens(lens_angle=0.9))
+        self.assertTrue(np.allclose(
+            holo, flat(correct).values, **TOLS))
+
+    @attr("medium")
+    def test_pool_is_started_once_and_shut_down(self):
+        detector = detector_grid(10, 0.2)
+        spheres = Spheres([SPHERE, Sphere(n=1.5, r=0.3, center=(1, 1, 4))])
+        plan = HologramPlan(detector, Mie(), parallel=1, **OPTICS)
+        plan(SPHERE)
+        self.assertTrue(plan._pool is None)
+        holo = plan(spheres)
+        pool = plan._pool
+        self.assertTrue(pool is not None)
+        plan(spheres)
+        self.assertTrue(plan._pool is pool)
+        self.assertTrue(pickle.loads(pickle.dumps(plan))._pool is None)
+        plan.close()
+        self.assertTrue(plan._pool is None)
+        correct = calc_holo(detector, spheres, theory=Mie(), **OPTICS)
+        self.assertTrue(np.allclose(holo, flat(correct).values, **TOLS))
+
+    @attr("fast")
+    def test_radius_of_influence_same_as_calc_holo(self):
+        detector = detector_grid(10, 0.2)
+        spheres = Spheres([SPHERE, Sphere(n=1.5, r=0.3, center=(1, 1, 4))])
+        plan = HologramPlan(
+            detector, Mie(), radius_of_influence=0.5, **OPTICS)
+        correct = calc_holo(detector, spheres, theory=Mie(),
+                            radius_of_influence=0.5, **OPTICS)
+        untruncated = calc_holo(detector, spheres, theory=Mie(), **OPTICS)
+        self.assertTrue(np.allclose(
+            plan(spheres), flat(correct).values, **TOLS))
+        self.assertFalse(np.allclose(correct.values, untruncated.values))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,21 @@
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import xarray as xr
 from nose.plugins.attrib import attr
 
 from holopy.core import detector_grid, detector_points
-from holopy.core.metadata import flat
-from holopy.scattering.imageformation import ImageFormation
-from holopy.scattering.theory import Mie
+from holopy.core.metadata import flat, update_metadata
+from holopy.scattering.imageformation import (
+    ImageFormation, select_scatterer_by_illumination, get_flat_coordinates,
+    get_wavevec_from, detector_coordinate_cache, detector_polar_cache)
+from holopy.scattering.theory import Mie, MieLens, Lens
 from holopy.scattering.scatterer import Sphere, Spheres, Ellipsoid
-from holopy.scattering.errors import TheoryNotCompatibleError
-from holopy.scattering.interface import prep_schema
+from holopy.scattering.errors import (
+    TheoryNotCompatibleError, MissingParameter)
+from holopy.scattering.interface import prep_schema, calc_holo
 from holopy.scattering.tests.common import xschema as XSCHEMA
 from holopy.scattering.tests.test_scatteringtheory import (
     MockTheory, MockScatteringMatrixBasedTheory)
@@ -263,6 +268,184 @@ class TestImageFormation(unittest.TestCase):
             np.allclose(fields02.values, 2 * fields01.values, **TOLS))
 
 
+class TestMultipleColors(unittest.TestCase):
+    def setUp(self):
+        self.schema = prep_schema(
+            detector_grid(
+                shape=4, spacing=0.1, extra_dims={'illumination': ['r', 'g']}),
+            medium_index=1.33, illum_wavelen={'r': 0.66, 'g': 0.52},
+            illum_polarization={'r': (1, 0), 'g': (0, 1)})
+
+    @attr("fast")
+    def test_multicolor_field_has_correct_dims(self):
+        imageformer = make_imageformer()
+        fields = imageformer.calculate_scattered_field(SPHERE, self.schema)
+        self.assertEqual(fields.dims, ('flat', 'vector', 'illumination'))
+        self.assertEqual(list(fields.illumination.values), ['r', 'g'])
+
+    @attr("fast")
+    def test_multicolor_field_equals_single_color_fields(self):
+        imageformer = make_imageformer()
+        scatterer = Sphere(n={'r': 1.5, 'g': 1.6}, r=1.0, center=(0, 0, 2))
+        fields = imageformer.calculate_scattered_field(scatterer, self.schema)
+        for color, wavelen, pol, n in [('r', 0.66, (1, 0), 1.5),
+                                       ('g', 0.52, (0, 1), 1.6)]:
+            single_schema = prep_schema(
+                detector_grid(shape=4, spacing=0.1), medium_index=1.33,
+                illum_wavelen=wavelen, illum_polarization=pol)
+            single = imageformer.calculate_scattered_field(
+                Sphere(n=n, r=1.0, center=(0, 0, 2)), single_schema)
+            self.assertTrue(np.allclose(
+                fields.sel(illumination=color).values, single.values,
+                **TOLS))
+
+    @attr("fast")
+    def test_select_scatterer_by_illumination_keeps_shared_scatterer(self):
+        self.assertTrue(select_scatterer_by_illumination(SPHERE, 'r') is SPHERE)
+
+
+class TestSuperposition(unittest.TestCase):
+    def setUp(self):
+        self.spheres = Spheres([
+            Sphere(n=1.5, r=0.5, center=(x, y, 3))
+            for x, y in [(0, 0), (2, 3), (5, 1), (4, 4)]])
+        self.schema = prep_schema(
+            detector_grid(shape=12, spacing=0.5), medium_index=1.33,
+            illum_wavelen=0.66, illum_polarization=(1, 0))
+
+    @attr("fast")
+    def test_pool_gives_same_field_as_serial(self):
+        serial = ImageFormation(Mie()).calculate_scattered_field(
+            self.spheres, self.schema)
+        with ThreadPoolExecutor(2) as pool:
+            imageformer = ImageFormation(Mie(), parallel=pool)
+            pooled = imageformer.calculate_scattered_field(
+                self.spheres, self.schema)
+        self.assertTrue(np.allclose(pooled.values, serial.values, **TOLS))
+
+    @attr("fast")
+    def test_large_radius_of_influence_gives_same_field(self):
+        full = ImageFormation(Mie()).calculate_scattered_field(
+            self.spheres, self.schema)
+        imageformer = ImageFormation(Mie(), radius_of_influence=100)
+        truncated = imageformer.calculate_scattered_field(
+            self.spheres, self.schema)
+        self.assertTrue(np.allclose(truncated.values, full.values, **TOLS))
+
+    @attr("fast")
+    def test_field_is_zero_outside_radius_of_influence(self):
+        spheres = Spheres([Sphere(n=1.5, r=0.5, center=(0, 0, 3)),
+                           Sphere(n=1.5, r=0.5, center=(0.5, 0, 3))])
+        imageformer = ImageFormation(Mie(), radius_of_influence=1.0)
+        fields = imageformer.calculate_scattered_field(spheres, self.schema)
+        rho = np.hypot(fields.x.values, fields.y.values)
+        magnitude = np.abs(fields).sum(dim='vector').values
+        self.assertTrue(np.all(magnitude[rho > 1.5] == 0))
+        self.assertTrue(np.all(magnitude[rho <= 1.0] > 0))
+
+
+class TestTruncationTolerance(unittest.TestCase):
+    def setUp(self):
+        self.schema = prep_schema(
+            update_metadata(detector_grid(shape=64, spacing=0.2),
+                            noise_sd=0.01),
+            medium_index=1.33, illum_wavelen=0.66, illum_polarization=(1, 0))
+
+    @attr("fast")
+    def test_truncation_error_is_below_tolerance(self):
+        spheres = Spheres([Sphere(n=1.59, r=0.5, center=(3, 4, 5))])
+        full = ImageFormation(Mie()).calculate_scattered_field(
+            spheres, self.schema)
+        imageformer = ImageFormation(Mie(), truncation_tolerance=1)
+        truncated = imageformer.calculate_scattered_field(
+            spheres, self.schema)
+        hologram_error = 2 * np.abs(full - truncated).max().item()
+        self.assertTrue(np.any(truncated.values == 0))
+        self.assertLess(hologram_error, self.schema.noise_sd)
+
+    @attr("fast")
+    def test_calc_holo_truncation_error_is_below_tolerance(self):
+        spheres = Spheres([Sphere(n=1.59, r=0.5, center=(3, 4, 5))])
+        full = calc_holo(self.schema, spheres, theory=Mie())
+        truncated = calc_holo(
+            self.schema, spheres, theory=Mie(), truncation_tolerance=3)
+        error = np.abs(full - truncated).max().item()
+        self.assertGreater(error, 0)
+        self.assertLess(error, 3 * self.schema.noise_sd)
+
+    @attr("fast")
+    def test_small_tolerance_gives_same_field(self):
+        spheres = Spheres([Sphere(n=1.59, r=0.5, center=(3, 4, 5)),
+                           Sphere(n=1.59, r=0.5, center=(8, 9, 5))])
+        full = ImageFormation(Mie()).calculate_scattered_field(
+            spheres, self.schema)
+        imageformer = ImageFormation(Mie(), truncation_tolerance=1e-6)
+        truncated = imageformer.calculate_scattered_field(
+            spheres, self.schema)
+        self.assertTrue(np.allclose(truncated.values, full.values, **TOLS))
+
+    @attr("fast")
+    def test_support_radius_grows_as_tolerance_shrinks(self):
+        sphere = Sphere(n=1.59, r=0.5, center=(3, 4, 5))
+        args = (flat(self.schema), get_wavevec_from(self.schema),
+                self.schema.medium_index, self.schema.illum_polarization)
+        loose = ImageFormation(Mie(), truncation_tolerance=3)
+        tight = ImageFormation(Mie(), truncation_tolerance=0.3)
+        self.assertLess(loose._support_radius(sphere, *args),
+                        tight._support_radius(sphere, *args))
+
+    @attr("fast")
+    def test_requires_noise_sd(self):
+        schema = prep_schema(
+            detector_grid(shape=8, spacing=0.2), medium_index=1.33,
+            illum_wavelen=0.66, illum_polarization=(1, 0))
+        spheres = Spheres([Sphere(n=1.59, r=0.5, center=(3, 4, 5))])
+        imageformer = ImageFormation(Mie(), truncation_tolerance=1)
+        self.assertRaises(MissingParameter,
+                          imageformer.calculate_scattered_field,
+                          spheres, schema)
+
+
+class TestPrecision(unittest.TestCase):
+    def setUp(self):
+        self.schema = prep_schema(
+            detector_grid(shape=16, spacing=0.2), medium_index=1.33,
+            illum_wavelen=0.66, illum_polarization=(1, 0))
+        self.sphere = Sphere(n=1.59, r=0.5, center=(1, 2, 5))
+
+    @attr("fast")
+    def test_single_precision_fields_are_complex64(self):
+        imageformer = ImageFormation(Mie(), precision='single')
+        fields = imageformer.calculate_scattered_field(
+            self.sphere, self.schema)
+        self.assertEqual(fields.dtype, np.complex64)
+
+    @attr("fast")
+    def test_single_precision_matches_double(self):
+        lens = Lens(0.8, Mie(), quad_npts_theta=20, quad_npts_phi=20)
+        for theory in [Mie(), MieLens(), lens]:
+            double = ImageFormation(theory).calculate_scattered_field(
+                self.sphere, self.schema)
+            imageformer = ImageFormation(theory, precision='single')
+            single = imageformer.calculate_scattered_field(
+                self.sphere, self.schema)
+            self.assertEqual(single.dtype, np.complex64)
+            self.assertTrue(np.allclose(
+                single.values, double.values, atol=1e-6, rtol=1e-5))
+
+    @attr("fast")
+    def test_superposition_in_single_precision(self):
+        spheres = Spheres(
+            [self.sphere, Sphere(n=1.5, r=0.3, center=(2, 1, 4))])
+        imageformer = ImageFormation(Mie(), precision='single')
+        fields = imageformer.calculate_scattered_field(spheres, self.schema)
+        self.assertEqual(fields.dtype, np.complex64)
+
+    @attr("fast")
+    def test_raises_error_for_unknown_precision(self):
+        self.assertRaises(ValueError, ImageFormation, Mie(), precision='half')
+
+
 class TestTransformToDesiredCoords(unittest.TestCase):
     @attr("fast")
     def test_transform_to_desired_coordinates(self):
@@ -278,6 +461,93 @@ class TestTransformToDesiredCoords(unittest.TestCase):
         self.assertTrue(np.allclose(pos, true_pos))
 
 
+    @attr("fast")
+    def test_flat_coordinates_are_reused_for_same_grid_geometry(self):
+        first = get_flat_coordinates(detector_grid(shape=(3, 4), spacing=0.1))
+        detector = detector_grid(shape=(3, 4), spacing=0.1)
+        second = get_flat_coordinates(detector)
+        self.assertTrue(first is second)
+        flat_detector = flat(detector)
+        correct = [flat_detector.x, flat_detector.y, flat_detector.z]
+        self.assertTrue(np.all(first == np.array(correct)))
+
+    @attr("fast")
+    def test_flat_coordinates_differ_for_different_detectors(self):
+        first = get_flat_coordinates(detector_grid(shape=3, spacing=0.1))
+        second = get_flat_coordinates(detector_grid(shape=3, spacing=0.2))
+        self.assertTrue(np.allclose(second, 2 * first))
+
+    @attr("fast")
+    def test_flat_coordinates_are_reused_between_holograms(self):
+        detector_coordinate_cache.clear()
+        for _ in range(3):
+            schema = prep_schema(
+                detector_grid(shape=(5, 6), spacing=.1), medium_index=1.33,
+                illum_wavelen=0.66, illum_polarization=(1, 0))
+            calc_holo(schema, SPHERE, theory=Mie())
+        self.assertEqual(detector_coordinate_cache.info().misses, 1)
+        self.assertTrue(detector_coordinate_cache.info().hits >= 2)
+
+    @attr("fast")
+    def test_transform_with_cached_coordinates_follows_origin(self):
+        detector = detector_grid(shape=(2, 2), spacing=0.1)
+        imageformer = ImageFormation(MockTheory())
+        imageformer._transform_to_desired_coordinates(detector, (0, 0, 1))
+        moved = imageformer._transform_to_desired_coordinates(
+            detector, origin=(0.1, 0.1, 1))
+        fresh = imageformer._transform_to_desired_coordinates(
+            detector_grid(shape=(2, 2), spacing=0.1), origin=(0.1, 0.1, 1))
+        self.assertTrue(np.allclose(moved, fresh, **TOLS))
+
+    @attr("fast")
+    def test_polar_coordinates_are_reused_when_moving_along_z(self):
+        detector = detector_grid(shape=(4, 3), spacing=0.1)
+        imageformer = ImageFormation(MieLens())
+        detector_polar_cache.clear()
+        for z in [1, 2, 3]:
+            cached = imageformer._transform_to_desired_coordinates(
+                detector, origin=(0.1, 0.05, z), wavevec=12.)
+            direct = imageformer._transform_to_desired_coordinates(
+                flat(detector), origin=(0.1, 0.05, z), wavevec=12.)
+            self.assertTrue(np.allclose(cached, direct, **TOLS))
+        self.assertEqual(detector_polar_cache.info().misses, 1)
+        self.assertEqual(detector_polar_cache.info().hits, 2)
+
+    @attr("fast")
+    def test_polar_coordinates_of_support_are_not_cached(self):
+        detector = detector_grid(shape=(6, 5), spacing=0.1)
+        imageformer = ImageFormation(MieLens())
+        points = np.array([1, 7, 8, 20])
+        detector_polar_cache.clear()
+        subset = imageformer._transform_to_desired_coordinates(
+            detector, origin=(0.1, 0.05, 2), wavevec=12., points=points)
+        self.assertEqual(len(detector_polar_cache), 0)
+        full = imageformer._transform_to_desired_coordinates(
+            detector, origin=(0.1, 0.05, 2), wavevec=12.)
+        self.assertTrue(np.allclose(subset, full[:, points], **TOLS))
+
+    @attr("medium")
+    def test_transform_of_support_scales_with_support_not_frame(self):
+        imageformer = ImageFormation(MieLens())
+
+        def best_time(shape):
+            detector = detector_grid(shape=shape, spacing=0.1)
+            points = imageformer._points_within_radius_of_influence(
+                detector, (1.6, 1.6, 2), 1.5)
+            get_flat_coordinates(detector)
+            times = []
+            for _ in range(5):
+                detector_polar_cache.clear()
+                start = time.perf_counter()
+                imageformer._transform_to_desired_coordinates(
+                    detector, (1.6, 1.6, 2), wavevec=12., points=points)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        # same ~700-point support on a 1024^2 and a 32^2 frame
+        self.assertLess(best_time(1024), 10 * best_time(32))
+
+
 def make_imageformer():
     return ImageFormation(MockTheory())
 
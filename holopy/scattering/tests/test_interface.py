@@ -24,6 +24,7 @@ calc_intensity and calc_holo, based on subclass's calc_field
 """
 import unittest
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from nose.plugins.attrib import attr
 
@@ -72,6 +73,55 @@ class TestInterface(unittest.TestCase):
                              2.04017098e+00, 9.13750771e-01])
         self.assertTrue(np.allclose(result.values.squeeze(), expected))
 
+    @attr('fast')
+    def test_calc_cross_sections_batch_matches_calc_cross_sections(self):
+        radii = xr.DataArray([0.2, 0.5, 1.0], dims='r')
+        wavelens = xr.DataArray([0.45, 0.66], dims='illum_wavelen')
+        result = calc_cross_sections_batch(1.6, radii, MED_INDEX, wavelens)
+        self.assertEqual(result.dims, ('r', 'illum_wavelen', 'cross_section'))
+        for i, r in enumerate(radii.values):
+            for j, wavelen in enumerate(wavelens.values):
+                sphere = Sphere(n=1.6, r=r, center=(5, 5, 5))
+                expected = calc_cross_sections(sphere, MED_INDEX, wavelen, POL)
+                self.assertTrue(np.allclose(
+                    result[i, j].values, expected.values, rtol=1e-12))
+
+    @attr('fast')
+    def test_calc_cross_sections_batch_pairs_plain_arrays(self):
+        radii = np.array([0.2, 0.5, 1.0])
+        indices = np.array([1.5, 1.6, 1.7 + 0.01j])
+        result = calc_cross_sections_batch(indices, radii, MED_INDEX, WAVELEN)
+        self.assertEqual(result.shape, (3, 4))
+        for r, n, cross_sections in zip(radii, indices, result.values):
+            sphere = Sphere(n=n, r=r, center=(5, 5, 5))
+            expected = calc_cross_sections(sphere, MED_INDEX, WAVELEN, POL)
+            self.assertTrue(np.allclose(
+                cross_sections, expected.values, rtol=1e-12))
+
+    @attr('fast')
+    def test_calc_cross_sections_batch_in_pool(self):
+        radii = np.linspace(0.1, 1, 50)
+        serial = Mie().raw_cross_sections_batch(
+            1.6, radii, 2 * np.pi * MED_INDEX / WAVELEN, MED_INDEX,
+            batchsize=7)
+        with ThreadPoolExecutor(2) as pool:
+            pooled = calc_cross_sections_batch(
+                1.6, radii, MED_INDEX, WAVELEN, parallel=pool)
+        self.assertTrue(np.allclose(pooled.values.T, serial, rtol=1e-14))
+
+    @attr('fast')
+    def test_calc_cross_sections_batch_follows_mie_backend(self):
+        radii = np.array([0.2, 0.5, 1.0])
+        theory = Mie(backend='numpy')
+        result = calc_cross_sections_batch(
+            1.59 + .01j, radii, MED_INDEX, WAVELEN, theory=theory)
+        for r, cross_sections in zip(radii, result.values):
+            sphere = Sphere(n=1.59 + .01j, r=r, center=(5, 5, 5))
+            expected = calc_cross_sections(
+                sphere, MED_INDEX, WAVELEN, POL, theory=theory)
+            self.assertTrue(np.allclose(
+                cross_sections, expected.values, rtol=1e-12))
+
     @attr('medium')
     def test_calc_intensity(self):
         # FIXME: Test results change when 'auto' theory for SCATTERER changes
@@ -33,6 +33,7 @@ from holopy.core import detector_grid
 from holopy.core.tests.common import verify
 from holopy.scattering.theory.mie_f import multilayer_sphere_lib, miescatlib
 from holopy.scattering import Sphere, calc_holo, Mie
+from holopy.scattering.theory.coefficientcache import CoefficientCache
 
 @attr('medium')
 def test_Shell():
@@ -95,3 +96,28 @@ def test_sooty_particles():
                     rtol = 2e-5)
     assert_allclose(efficiencies_from_scat_units(m_sm, x_sm), gold[2],
                     rtol = 1e-3)
+
+@attr('fast')
+def test_inner_layers_cached():
+    m = np.array([1.59, 1.45, 1.6, 1.4, 1.55]) / 1.33 + 1e-4j
+    x = np.array([5., 6., 7., 8., 9.])
+    cache = CoefficientCache()
+    multilayer_sphere_lib.scatcoeffs_multi(m, x, cache=cache)
+    assert cache.info().misses == 4
+
+    m[-1] = 1.5 / 1.33
+    x[-1] = 9.05
+    cached = multilayer_sphere_lib.scatcoeffs_multi(m, x, cache=cache)
+    assert cache.info().hits == 4
+    assert_allclose(cached, multilayer_sphere_lib.scatcoeffs_multi(m, x),
+                    rtol=0, atol=0)
+
+@attr('fast')
+def test_mie_reuses_inner_layers():
+    multilayer_sphere_lib.inner_layer_cache.clear()
+    t = detector_grid(10, .1)
+    for outer_r in [.8, .81]:
+        s = Sphere(center=(.5, .5, 5), n=[1.59, 1.45, 1.6], r=[.5, .6, outer_r])
+        calc_holo(t, s, 1.33, .66, illum_polarization=(1, 0))
+    assert multilayer_sphere_lib.inner_layer_cache.info().hits == 2
+
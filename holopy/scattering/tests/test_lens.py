@@ -1,4 +1,5 @@
 import unittest
+import warnings
 
 import numpy as np
 import xarray as xr
@@ -22,6 +23,11 @@ LENSMIE_NO_NE = Lens(
     lens_angle=LENS_ANGLE, theory=Mie(False, False), use_numexpr=False)
 
 
+class MieWithoutSymmetry(Mie):
+    """Mie, which Lens integrates over the full (theta, phi) pupil."""
+    azimuthally_symmetric = False
+
+
 SMALL_DETECTOR = update_metadata(
     detector_grid(shape=16, spacing=test_common.pixel_scale),
     illum_wavelen=test_common.wavelen,
@@ -153,21 +159,158 @@ class TestLens(unittest.TestCase):
         holo = calc_holo(pts, scatterer, theory=theory)
         self.assertTrue(True)
 
+    @attr('fast')
+    def test_chunked_integral_same_as_unchunked(self):
+        np.random.seed(1711)
+        positions = np.random.rand(3, 50) * np.array([[30], [6], [20]])
+        kwargs = {'quad_npts_theta': 20, 'quad_npts_phi': 20}
+        chunked = Lens(LENS_ANGLE, MieWithoutSymmetry(False, False),
+                       chunksize=7, **kwargs)
+        unchunked = Lens(LENS_ANGLE, MieWithoutSymmetry(False, False),
+                         chunksize=50, **kwargs)
+        args = (test_common.sphere, 2 * np.pi / test_common.wavelen,
+                test_common.index, 0.3)
+
+        assert_allclose(chunked._compute_integral(positions, *args),
+                        unchunked._compute_integral(positions, *args),
+                        rtol=1e-12, atol=1e-15)
+
+    @attr('fast')
+    def test_symmetric_integral_same_as_2d_quadrature(self):
+        np.random.seed(1013)
+        positions = np.random.rand(3, 50) * np.array([[30], [6], [20]])
+        args = (test_common.sphere, 2 * np.pi / test_common.wavelen,
+                test_common.index, 0.3)
+        symmetric = Lens(LENS_ANGLE, Mie(False, False), quad_npts_theta=50)
+        full = Lens(LENS_ANGLE, MieWithoutSymmetry(False, False),
+                    quad_npts_theta=50, quad_npts_phi=100)
+        assert_allclose(symmetric._compute_integral(positions, *args),
+                        full._compute_integral(positions, *args),
+                        rtol=1e-12, atol=1e-15)
+
+    @attr('fast')
+    def test_symmetric_theory_scattering_matrices_only_in_theta(self):
+        class CountingMie(Mie):
+            npts = []
+
+            def raw_scat_matrs(self, scatterer, pos, *args, **kwargs):
+                self.npts.append(pos.shape[1])
+                return super(CountingMie, self).raw_scat_matrs(
+                    scatterer, pos, *args, **kwargs)
+
+        theory = Lens(LENS_ANGLE, CountingMie(False, False),
+                      quad_npts_theta=30, quad_npts_phi=40)
+        calc_holo(SMALL_DETECTOR, test_common.sphere, theory=theory)
+        self.assertEqual(CountingMie.npts, [30])
+
+    @attr('fast')
+    def test_chunksize_does_not_change_hologram(self):
+        holos = [calc_holo(SMALL_DETECTOR, test_common.sphere,
+                           theory=Lens(LENS_ANGLE, Mie(False, False),
+                                       chunksize=chunksize))
+                 for chunksize in [1, 33, 1000]]
+        for holo in holos[1:]:
+            assert_allclose(holo, holos[0], rtol=1e-12)
+
+    @attr('medium')
+    def test_fft_hologram_same_as_quadrature(self):
+        detector = update_metadata(
+            detector_grid(shape=(24, 20), spacing=test_common.pixel_scale),
+            illum_wavelen=test_common.wavelen,
+            medium_index=test_common.index,
+            illum_polarization=(1, 1))
+        kwargs = {'quad_npts_theta': 200, 'quad_npts_phi': 200}
+        holo_quad = calc_holo(detector, test_common.sphere, theory=Lens(
+            LENS_ANGLE, Mie(False, False), **kwargs))
+        holo_fft = calc_holo(detector, test_common.sphere, theory=Lens(
+            LENS_ANGLE, Mie(False, False), method='fft', fft_npts=512,
+            **kwargs))
+        assert_allclose(holo_fft, holo_quad, atol=1e-3)
+
+    @attr('fast')
+    def test_fft_integral_same_as_quadrature_in_point_order(self):
+        krho, phi = np.meshgrid(np.linspace(-20, 30, 6),
+                                np.linspace(-15, 25, 5))
+        positions = np.array([np.hypot(krho, phi).ravel(),
+                              np.arctan2(phi, krho).ravel(),
+                              np.full(krho.size, 15.)])
+        np.random.seed(1133)
+        positions = positions[:, np.random.permutation(krho.size)]
+        args = (test_common.sphere, 2 * np.pi / test_common.wavelen,
+                test_common.index, 0.4)
+        theory = Lens(LENS_ANGLE, Mie(False, False), method='fft')
+
+        grid = lens._find_regular_grid(positions)
+        integrals = theory._compute_integral_by_fft(positions, grid, *args)
+        correct = theory._compute_integral(positions, *args)
+        scale = np.abs(correct).max()
+        assert_allclose(integrals, correct, atol=2e-3 * scale)
+
+    @attr('medium')
+    def test_fft_check_does_not_warn_on_large_detector(self):
+        detector = update_metadata(
+            detector_grid(shape=256, spacing=0.1), illum_wavelen=0.66,
+            medium_index=1.33, illum_polarization=(1, 0))
+        sphere = Sphere(n=1.59, r=0.5, center=(2, 2, 10))
+        theory = Lens(0.8, MieWithoutSymmetry(False, False), method='fft')
+        with warnings.catch_warnings():
+            warnings.filterwarnings('error', message='The lens integral')
+            calc_holo(detector, sphere, theory=theory)
+
+    @attr('fast')
+    def test_check_quadrature_grows_with_distance(self):
+        theory = Lens(LENS_ANGLE, Mie(False, False))
+        near = theory._check_quadrature(np.array([[10.], [0.], [5.]]))
+        far = theory._check_quadrature(np.array([[1000.], [0.], [5.]]))
+        self.assertEqual(near.quad_npts_theta, theory.quad_npts_theta)
+        self.assertEqual(near.quad_npts_phi, theory.quad_npts_phi)
+        self.assertGreater(far.quad_npts_theta, theory.quad_npts_theta)
+        self.assertGreater(far.quad_npts_phi, theory.quad_npts_phi)
+
+    @attr('fast')
+    def test_fft_not_used_off_regular_grid(self):
+        positions = np.array([[1., 2., 4.], [0., 0.5, 1.], [10., 10., 10.]])
+        self.assertTrue(lens._find_regular_grid(positions) is None)
+        theory = Lens(LENS_ANGLE, Mie(False, False), quad_npts_theta=20,
+                      quad_npts_phi=20)
+        fft_theory = Lens(LENS_ANGLE, Mie(False, False), quad_npts_theta=20,
+                          quad_npts_phi=20, method='fft')
+        args = (test_common.sphere, 2 * np.pi / test_common.wavelen,
+                test_common.index, xr.DataArray([1.0, 0, 0]))
+        assert_equal(fft_theory.raw_fields(positions, *args),
+                     theory.raw_fields(positions, *args))
+
+    @attr('fast')
+    def test_chirp_z_same_as_direct_sum(self):
+        np.random.seed(1145)
+        values = np.random.rand(3, 9) + 1j * np.random.rand(3, 9)
+        u = 0.2 + 0.05 * np.arange(9)
+        x = -3 + 0.7 * np.arange(13)
+        correct = values.dot(np.exp(1j * np.outer(u, x)))
+        result = lens._chirp_z(values, 0.2, 0.05, -3, 0.7, 13, axis=1)
+        assert_allclose(result, correct, rtol=1e-12)
+
     @unittest.skipUnless(lens.NUMEXPR_INSTALLED, "numexpr package required")
-    def test_integrand_prefactor_same_with_numexpr_as_without(self):
+    def test_integrand_phase_same_with_numexpr_as_without(self):
         np.random.seed(1649)
         krho, phi, kz = np.random.randn(3, 101)
 
-        prefactor_numexpr = LENSMIE._integrand_prefactor(krho, phi, kz)
-        prefactor_numpy = LENSMIE_NO_NE._integrand_prefactor(krho, phi, kz)
+        phase_numexpr = LENSMIE._integrand_phase(krho, phi, kz)
+        phase_numpy = LENSMIE_NO_NE._integrand_phase(krho, phi, kz)
 
-        self.assertTrue(np.all(prefactor_numpy == prefactor_numexpr))
+        self.assertTrue(np.all(phase_numpy == phase_numexpr))
+
+    @unittest.skipUnless(lens.NUMEXPR_INSTALLED, "numexpr package required")
+    def test_pupil_weights_same_with_numexpr_as_without(self):
+        weights_numexpr = LENSMIE._pupil_weights(np.float64)
+        weights_numpy = LENSMIE_NO_NE._pupil_weights(np.float64)
+
+        self.assertTrue(np.all(weights_numpy == weights_numexpr))
 
     @unittest.skipUnless(lens.NUMEXPR_INSTALLED, "numexpr package required")
     def test_integrand_parallel_same_with_numexpr_as_without(self):
         np.random.seed(1659)
-        krho, phi, kz = np.random.randn(3, 10)
-        prefactor = LENSMIE._integrand_prefactor(krho, phi, kz)
+        prefactor = LENSMIE._pupil_weights(np.float64)
         pol_angle = np.random.rand() * 2 * np.pi
         shape = (LENSMIE.quad_npts_theta, LENSMIE.quad_npts_phi, 1)
         scat_matrix = np.random.randn(4, *shape)
@@ -182,8 +325,7 @@ class TestLens(unittest.TestCase):
     @unittest.skipUnless(lens.NUMEXPR_INSTALLED, "numexpr package required")
     def test_integrand_perpendicular_same_with_numexpr_as_without(self):
         np.random.seed(1659)
-        krho, phi, kz = np.random.randn(3, 10)
-        prefactor = LENSMIE._integrand_prefactor(krho, phi, kz)
+        prefactor = LENSMIE._pupil_weights(np.float64)
         pol_angle = np.random.rand() * 2 * np.pi
         shape = (LENSMIE.quad_npts_theta, LENSMIE.quad_npts_phi, 1)
         scat_matrix = np.random.randn(4, *shape)
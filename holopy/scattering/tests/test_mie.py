@@ -33,6 +33,9 @@ from nose.plugins.attrib import attr
 from holopy.scattering.scatterer import (
     Sphere, Spheres, Ellipsoid, LayeredSphere)
 from holopy.scattering.theory import Mie
+from holopy.scattering.theory import mienumpy
+from holopy.scattering.theory.mie_f import (
+    mieangfuncs, miescatlib, scatcoeffs_multi)
 from holopy.scattering.imageformation import ImageFormation
 from holopy.scattering.errors import TheoryNotCompatibleError, InvalidScatterer
 from holopy.core.metadata import (
@@ -44,7 +47,7 @@ from holopy.scattering.tests.common import (
 from holopy.core.tests.common import assert_obj_close, verify
 from holopy.scattering.interface import (
     calc_field, calc_holo, calc_intensity, calc_scat_matrix,
-    calc_cross_sections)
+    calc_cross_sections, calc_total_field)
 
 
 
@@ -377,6 +380,206 @@ def test_raw_fields():
   (-0.0021320123934202356-0.0035427449839031066j)]])
 
 
+@attr("fast")
+def test_translation_reuse_matches_direct_calculation():
+    sp = Sphere(r=.5, n=1.6 + 1e-3j, center=(5, 5, 5))
+    sch = detector_grid(40, .1)
+    for center in [(5, 5, 5), (5.03, 4.9, 5)]:
+        moved = Sphere(r=sp.r, n=sp.n, center=center)
+        for polarization in [(1, 0), (0, 1), (1, 1)]:
+            direct = calc_field(
+                sch, moved, 1.33, .66, polarization, theory=Mie()).values
+            reuse = calc_field(
+                sch, moved, 1.33, .66, polarization,
+                theory=Mie(translation_reuse=True)).values
+            assert_allclose(reuse, direct, rtol=0,
+                            atol=1e-8 * np.abs(direct).max())
+
+
+@attr("fast")
+def test_translation_reuse_falls_back_when_detector_not_planar():
+    sp = Sphere(r=.5, n=1.6, center=(5, 5, 5))
+    sch = detector_points(x=[1, 2, 3], y=[1, 2, 3], z=[0, 1, 2])
+    direct = calc_field(sch, sp, 1.33, .66, (1, 0), theory=Mie())
+    reuse = calc_field(
+        sch, sp, 1.33, .66, (1, 0), theory=Mie(translation_reuse=True))
+    assert_equal(reuse.values, direct.values)
+
+
+@attr("fast")
+def test_raw_scat_matrs_same_as_fortran_asm_mie_far():
+    sp = Sphere(r=2.5, n=1.59 + 1e-3j, center=(10, 10, 5))
+    wavevec = 2 * np.pi / (.66 / 1.33)
+    theory = Mie()
+    scat_coeffs = theory._scat_coeffs(sp, wavevec, 1.33)
+    theta = np.linspace(0, np.pi, 101)
+    phi = np.linspace(0, 2 * np.pi, 101)
+    pos = np.array([np.full(theta.size, np.inf), theta, phi])
+
+    scat_matrs = theory.raw_scat_matrs(sp, pos, wavevec, 1.33)
+    fortran = np.array(
+        [mieangfuncs.asm_mie_far(scat_coeffs, t) for t in theta])
+    assert_equal(scat_matrs.shape, (theta.size, 2, 2))
+    # the fortran code uses single-precision prefactors
+    assert_allclose(
+        scat_matrs, fortran, rtol=0, atol=1e-7 * np.abs(fortran).max())
+
+
+@attr("fast")
+def test_numpy_backend_same_as_fortran():
+    sch = detector_grid(20, .1)
+    scatterers = [Sphere(r=.5, n=1.59, center=(1, 1, 3)),
+                  Sphere(r=.5, n=1.59 + .01j, center=(1, 1, 3)),
+                  Sphere(r=(.4, .5), n=(1.59, 1.4), center=(1, 1, 3))]
+    for sp in scatterers:
+        for compute_escat_radial, full_radial_dependence in [
+                (True, True), (False, True), (False, False)]:
+            kwargs = {'compute_escat_radial': compute_escat_radial,
+                      'full_radial_dependence': full_radial_dependence}
+            fortran = calc_field(sch, sp, 1.33, .66, (1, 0),
+                                 theory=Mie(**kwargs)).values
+            numpy = calc_field(sch, sp, 1.33, .66, (1, 0),
+                               theory=Mie(backend='numpy', **kwargs)).values
+            assert_allclose(numpy, fortran, rtol=0,
+                            atol=1e-7 * np.abs(fortran).max())
+
+
+@attr("fast")
+def test_numpy_scatcoeffs_same_as_fortran():
+    for m, x in [(1.2, 5.), (1.59 / 1.33 + 1e-3j, 20.), (1.5, .1)]:
+        nstop = miescatlib.nstop(x)
+        assert_allclose(mienumpy.scatcoeffs(m, x, nstop, 1e-3, 1e-16),
+                        miescatlib.scatcoeffs(m, x, nstop, 1e-3, 1e-16),
+                        rtol=1e-12, atol=1e-30)
+
+
+@attr("fast")
+def test_numpy_log_derivatives_same_as_fortran():
+    z = 12. + .3j
+    start = mienumpy.lentz_dn1(z, 30, 1e-3, 1e-16)
+    assert_allclose(start, mieangfuncs.lentz_dn1(z, 30, 1e-3, 1e-16),
+                    rtol=1e-13)
+    assert_allclose(mienumpy.dn_1_down(z, 30, 20, start),
+                    mieangfuncs.dn_1_down(z, 30, 20, start), rtol=1e-13)
+
+
+@attr("fast")
+def test_numpy_backend_cross_sections():
+    sp = Sphere(r=.5, n=1.59 + .01j, center=(1, 1, 3))
+    fortran = calc_cross_sections(sp, 1.33, .66, (1, 0), theory=Mie())
+    numpy = calc_cross_sections(sp, 1.33, .66, (1, 0),
+                                theory=Mie(backend='numpy'))
+    assert_allclose(numpy, fortran, rtol=1e-12)
+
+
+@attr("fast")
+def test_invalid_backend():
+    assert_raises(ValueError, Mie, backend='cuda')
+
+
+@attr("fast")
+def test_internal_fields_same_as_fortran():
+    m, x = 1.2 + .01j, 10.
+    nstop = miescatlib.nstop(x)
+    random = np.random.RandomState(1)
+    pos = np.array([random.uniform(0, x, 200),
+                    random.uniform(0, np.pi, 200),
+                    random.uniform(0, 2 * np.pi, 200)])
+    fortran = np.array(mieangfuncs.mie_internal_fields(
+        pos, m, miescatlib.internal_coeffs(m, x, nstop), [1, .3]))
+    coeffs = mienumpy.layered_coeffs([m], [x], nstop)
+    assert_allclose(coeffs[0, :, 0], miescatlib.internal_coeffs(m, x, nstop),
+                    rtol=1e-12)
+    numpy = mienumpy.layered_fields(pos, [m], [x], coeffs, np.array([1, .3]))
+    assert_allclose(numpy, fortran, rtol=0,
+                    atol=1e-12 * np.abs(fortran).max())
+
+
+@attr("fast")
+def test_layered_coeffs_same_as_scatcoeffs_multi():
+    m = np.array([1.59, 1.45, 1.6]) / 1.33 + 1e-3j
+    x = np.array([5., 6.5, 7.])
+    coeffs = mienumpy.layered_coeffs(m, x, miescatlib.nstop(x[-1]))
+    al, bl = scatcoeffs_multi(m, x)
+    assert_allclose(coeffs[-1, :, 1], [-1j * bl, -1j * al], atol=1e-13)
+    assert_allclose(coeffs[-1, :, 0], [1 - bl, 1 - al], atol=1e-13)
+
+
+@attr("fast")
+def test_total_field_is_incident_plus_scattered_outside():
+    sch = detector_grid(20, .1)
+    for sp in [Sphere(r=.5, n=1.59 + .01j, center=(1, 1, 3)),
+               Sphere(r=(.4, .5), n=(1.59, 1.4), center=(1, 1, 3))]:
+        total = calc_total_field(sch, sp, 1.33, .66, (0, 1))
+        scattered = calc_field(sch, sp, 1.33, .66, (0, 1))
+        incident = np.array([0, 1, 0]).reshape(3, 1, 1, 1)
+        assert_allclose(total.values, scattered.values + incident, rtol=0,
+                        atol=1e-7 * np.abs(scattered.values).max())
+
+
+@attr("fast")
+def test_layered_total_field_continuous_across_interfaces():
+    m = np.array([1.59, 1.45 + .01j]) / 1.33
+    x = np.array([4., 6.])
+    # extra orders, so that the expansion of the incident field inside
+    # matches the closed form outside
+    coeffs = mienumpy.layered_coeffs(m, x, miescatlib.nstop(x[-1]) + 10)
+    theta = np.linspace(.1, 3, 7)
+    phi = np.linspace(0, 6, 7)
+    m_regions = np.append(m, 1)
+    eps = 1e-9
+    for i, boundary in enumerate(x):
+        fields = [mienumpy.layered_fields(
+            np.array([np.full(7, kr), theta, phi]), m, x, coeffs,
+            np.array([1, .5])) for kr in (boundary - eps, boundary + eps)]
+        radial = np.array([np.sin(theta) * np.cos(phi),
+                           np.sin(theta) * np.sin(phi), np.cos(theta)])
+        e_r = [(f * radial).sum(axis=0) for f in fields]
+        tangential = [f - e * radial for f, e in zip(fields, e_r)]
+        assert_allclose(tangential[0], tangential[1], atol=1e-7)
+        assert_allclose(m_regions[i]**2 * e_r[0],
+                        m_regions[i + 1]**2 * e_r[1], atol=1e-7)
+
+
+@attr("fast")
+def test_total_field_independent_of_chunksize():
+    sp = Sphere(r=(.4, .5), n=(1.59, 1.4), center=(0, 0, 0))
+    random = np.random.RandomState(2)
+    pos = np.array([random.uniform(0, 20, 500),
+                    random.uniform(0, np.pi, 500),
+                    random.uniform(0, 2 * np.pi, 500)])
+    wavevec = 2 * np.pi * 1.33 / .66
+    theory = Mie()
+    args = (pos, sp, wavevec, 1.33, to_vector((1, 0)))
+    assert_allclose(theory.raw_total_fields(*args, chunksize=7),
+                    theory.raw_total_fields(*args), rtol=1e-14)
+
+
+@attr("fast")
+def test_total_field_finite_at_center():
+    sp = Sphere(r=.5, n=1.59, center=(1, 1, 3))
+    sch = detector_points(x=[1, 1], y=[1, 1], z=[3, 3 + 1e-6])
+    field = calc_total_field(sch, sp, 1.33, .66, (1, 0)).values
+    assert np.isfinite(field).all()
+    assert_allclose(field[0], field[1], rtol=0, atol=1e-4)
+
+
+@attr("fast")
+def test_spherical_bessel_same_as_scipy():
+    from scipy.special import spherical_jn, spherical_yn
+    rho = np.concatenate((np.linspace(1e-3, 40, 200),
+                          np.linspace(.01, 30, 100) * (1.5 + .05j),
+                          [np.pi, 2 * np.pi]))
+    l = np.arange(1, 31)
+    expected = [spherical_jn(l, rho[:, None]),
+                spherical_jn(l, rho[:, None], derivative=True),
+                spherical_yn(l, rho[:, None]),
+                spherical_yn(l, rho[:, None], derivative=True)]
+    for value, exact in zip(mienumpy._spherical_bessel(30, rho), expected):
+        assert_allclose(value, exact, rtol=1e-10,
+                        atol=1e-14 * np.abs(exact).max())
+
+
 @attr('medium')
 def test_j0_roots():
     # Checks for misbehavior when j_0(x) = 0
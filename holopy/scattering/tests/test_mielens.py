@@ -22,15 +22,17 @@ Test the ability of the mielens calculations to interface with holopy.
 """
 
 import os
+import pickle
 import unittest
 
 import numpy as np
 import xarray as xr
 from nose.plugins.attrib import attr
 
-from holopy.core.metadata import detector_grid
+from holopy.core.metadata import detector_grid, data_grid
 from holopy.scattering.theory import (
     Mie, MieLens, AberratedMieLens, mielensfunctions)
+from holopy.scattering.theory.mielens import calculator_cache
 from holopy.scattering.scatterer import Sphere, Spheres
 from holopy.scattering.interface import calc_holo
 
@@ -46,13 +48,72 @@ SOFTTOLS = {"atol": 1e-3, "rtol": 1e-3}
 
 class TestMieLens(unittest.TestCase):
     @attr("fast")
-    def test_raises_error_if_multiple_z_values(self):
+    def test_multiple_z_values_same_as_one_at_a_time(self):
         theory = MieLens()
         np.random.seed(10)
         positions = np.random.randn(3, 10)  # the zs will differ by chance
-        self.assertRaises(
-            ValueError, theory.raw_fields, positions, sphere, 1.0, 1.33,
-            xschema.illum_polarization)
+        positions[0] = np.abs(positions[0])
+        fields = theory.raw_fields(
+            positions, sphere, 1.0, 1.33, xschema.illum_polarization)
+        for i in range(positions.shape[1]):
+            field = theory.raw_fields(
+                positions[:, i:i + 1], sphere, 1.0, 1.33,
+                xschema.illum_polarization)
+            self.assertTrue(np.allclose(fields[:, i:i + 1], field, **TOLS))
+
+    @attr("fast")
+    def test_multiplane_detector_same_as_each_plane(self):
+        zs = [0, 1e-6, 2.5e-6]
+        detector = data_grid(np.zeros((3, 10, 10)), spacing=1e-7, z=zs)
+        theory = MieLens(lens_angle=0.8)
+        stack = calc_holo(detector, sphere, index, wavelen, xpolarization,
+                          theory=theory)
+        for i in range(len(zs)):
+            plane = calc_holo(detector.isel(z=[i]), sphere, index, wavelen,
+                              xpolarization, theory=theory)
+            self.assertTrue(np.allclose(
+                stack.isel(z=i).values, plane.isel(z=0).values, **TOLS))
+
+    @attr("fast")
+    def test_planes_share_scattering_matrices(self):
+        calculator_cache.clear()
+        detector = data_grid(
+            np.zeros((2, 10, 10)), spacing=1e-7, z=[0, 1e-6])
+        calc_holo(detector, sphere, index, wavelen, xpolarization,
+                  theory=MieLens(lens_angle=0.8))
+        calculators = list(calculator_cache._store.values())
+        self.assertEqual(len(calculators), 2)
+        self.assertNotEqual(*[c.particle_kz for c in calculators])
+        self.assertIs(calculators[0]._scat_perp_values,
+                      calculators[1]._scat_perp_values)
+
+    @attr("fast")
+    def test_parallel_planes_same_as_serial(self):
+        detector = data_grid(
+            np.zeros((3, 10, 10)), spacing=1e-7, z=[0, 1e-6, 2e-6])
+        serial = calc_holo(detector, sphere, index, wavelen, xpolarization,
+                           theory=MieLens(lens_angle=0.8))
+        parallel = calc_holo(
+            detector, sphere, index, wavelen, xpolarization,
+            theory=MieLens(lens_angle=0.8, parallel=2))
+        self.assertTrue(np.allclose(serial, parallel, rtol=0, atol=0))
+
+    @attr("fast")
+    def test_parallel_theory_can_be_pickled(self):
+        theory = MieLens(lens_angle=0.8, parallel='all')
+        self.assertEqual(pickle.loads(pickle.dumps(theory)), theory)
+
+    @attr("fast")
+    def test_parallel_does_not_change_calculator_cache_keys(self):
+        serial = MieLens(lens_angle=0.8)
+        parallel = MieLens(lens_angle=0.8, parallel=2)
+        self.assertEqual(serial._cache_repr(), parallel._cache_repr())
+        self.assertEqual(parallel.parallel, 2)
+
+    @attr("fast")
+    def test_invalid_parallel_raises_error(self):
+        self.assertRaises(TypeError, MieLens, parallel='many')
+        self.assertRaises(TypeError, MieLens, parallel=0)
 
     @attr("fast")
     def test_desired_coordinate_system_is_cylindrical(self):
@@ -230,6 +291,63 @@ class TestMieLens(unittest.TestCase):
         self.assertTrue(np.allclose(fields_1[0],  fields_0[1], **TOLS))
         self.assertTrue(np.allclose(fields_1[1], -fields_0[0], **TOLS))
 
+    @attr('fast')
+    def test_fields_are_linear_in_polarization(self):
+        theory = MieLens()
+        medium_wavevec = 2 * np.pi / wavelen
+        krho = np.linspace(0, 100, 11)
+        positions = np.array(
+            [krho, np.linspace(0, 2 * np.pi, 11), np.full_like(krho, 20.0)])
+
+        def calc_fields(polarization):
+            return theory.raw_fields(
+                positions.copy(), sphere, medium_wavevec, index,
+                xr.DataArray(polarization))
+
+        diagonal = calc_fields([1.0, 1.0, 0])
+        superposed = (calc_fields([1.0, 0, 0]) +
+                      calc_fields([0, 1.0, 0])) / np.sqrt(2)
+        self.assertTrue(np.allclose(diagonal, superposed, **TOLS))
+
+    @attr('medium')
+    def test_translation_reuse_matches_direct_calculation(self):
+        direct = MieLens(lens_angle=0.8)
+        reuse = MieLens(lens_angle=0.8, translation_reuse=True)
+        for center in [(x, y, z), (x + 2e-7, y - 1e-7, z)]:
+            moved = Sphere(n=sphere.n, r=sphere.r, center=center)
+            holo_direct = calc_holo(xschema, moved, index, wavelen,
+                                    xpolarization, theory=direct)
+            holo_reuse = calc_holo(xschema, moved, index, wavelen,
+                                   xpolarization, theory=reuse)
+            self.assertTrue(np.allclose(holo_direct, holo_reuse, **MEDTOLS))
+
+    @attr('fast')
+    def test_calculator_reused_when_sphere_moves_in_xy(self):
+        calculator_cache.clear()
+        theory = MieLens(lens_angle=0.8)
+        for center in [(x, y, z), (x + 2e-7, y - 1e-7, z)]:
+            moved = Sphere(n=sphere.n, r=sphere.r, center=center)
+            holo = calc_holo(xschema, moved, index, wavelen, xpolarization,
+                             theory=theory)
+        info = calculator_cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+        calculator_cache.clear()
+        fresh = calc_holo(xschema, moved, index, wavelen, xpolarization,
+                          theory=theory)
+        self.assertTrue(np.allclose(holo, fresh, rtol=0, atol=0))
+
+    @attr('fast')
+    def test_new_calculator_when_sphere_moves_in_z_or_lens_changes(self):
+        calculator_cache.clear()
+        for theory, center in [(MieLens(lens_angle=0.8), (x, y, z)),
+                               (MieLens(lens_angle=0.8), (x, y, z + 1e-6)),
+                               (MieLens(lens_angle=0.9), (x, y, z))]:
+            moved = Sphere(n=sphere.n, r=sphere.r, center=center)
+            calc_holo(xschema, moved, index, wavelen, xpolarization,
+                      theory=theory)
+        self.assertEqual(calculator_cache.info().misses, 3)
+
     @attr('fast')
     def test_parameters_returns_correct_keys_and_values(self):
         np.random.seed(1707)
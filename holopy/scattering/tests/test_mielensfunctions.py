@@ -1,4 +1,6 @@
-import warnings
+import os
+import shutil
+import tempfile
 import unittest
 import itertools
 
@@ -75,6 +77,53 @@ class TestMieLensCalculator(unittest.TestCase):
         fields = miecalculator.calculate_scattered_field(krho, kphi)
         self.assertTrue(fields is not None)
 
+    @attr("fast")
+    def test_at_particle_kz_same_as_new_calculator(self):
+        kwargs = {'index_ratio': 1.2, 'size_parameter': 10.0,
+                  'lens_angle': 0.9}
+        calculator = mielensfunctions.MieLensCalculator(
+            particle_kz=10.0, **kwargs)
+        moved = calculator.at_particle_kz(-5.0)
+        new = mielensfunctions.MieLensCalculator(particle_kz=-5.0, **kwargs)
+        krho = np.linspace(0, 600, 301)
+        phi = np.linspace(0, 2 * np.pi, krho.size)
+
+        for field, correct in zip(moved.calculate_scattered_field(krho, phi),
+                                  new.calculate_scattered_field(krho, phi)):
+            self.assertTrue(np.allclose(field, correct, **TOLS))
+        self.assertEqual(calculator.particle_kz, 10.0)
+
+    @attr("fast")
+    def test_large_rho_same_as_finer_quadrature(self):
+        kwargs = {'particle_kz': 10.0, 'index_ratio': 1.2,
+                  'size_parameter': 10.0, 'lens_angle': 0.9}
+        calculator = mielensfunctions.MieLensCalculator(
+            quad_npts=100, **kwargs)
+        finer_calculator = mielensfunctions.MieLensCalculator(
+            quad_npts=600, **kwargs)
+        krho = np.linspace(300, 1500, 301)
+        phi = np.linspace(0, 2 * np.pi, krho.size)
+
+        fields = calculator.calculate_scattered_field(krho, phi)
+        correct = finer_calculator.calculate_scattered_field(krho, phi)
+        rescale = np.abs(correct[0]).max()
+        self.assertTrue(rescale > 0)
+        for field, correct_field in zip(fields, correct):
+            self.assertTrue(
+                np.allclose(field / rescale, correct_field / rescale,
+                            **MEDTOLS))
+
+    @attr("fast")
+    def test_large_rho_field_keeps_single_precision(self):
+        calculator = mielensfunctions.MieLensCalculator(
+            particle_kz=10.0, index_ratio=1.2, size_parameter=10.0,
+            lens_angle=0.9)
+        krho = np.linspace(1000, 1100, 10, dtype=np.float32)
+        phi = np.zeros_like(krho)
+        fields = calculator._calculate_large_krho_scattered_field(krho, phi)
+        for field in fields:
+            self.assertEqual(field.dtype, np.complex64)
+
     @attr("medium")
     def test_central_lobe_is_bright_when_particle_is_above_focus(self):
         zs = np.linspace(2, 10, 11)
@@ -298,6 +347,18 @@ class TestMieLensCalculator(unittest.TestCase):
                 self.assertTrue(close_enough_x)
                 self.assertTrue(close_enough_y)
 
+    @attr("fast")
+    def test_number_of_kept_interpolators_is_bounded(self):
+        calculator = mielensfunctions.MieLensCalculator(
+            particle_kz=10., index_ratio=1.1, size_parameter=2.,
+            lens_angle=0.8, interpolate_integrals=True,
+            interpolator_window_size=1., interpolator_degree=8)
+        for start in range(mielensfunctions.MAX_INTERPOLATORS + 4):
+            calculator.calculate_scattered_field(
+                np.linspace(start, start + 0.5, 5), np.zeros(5))
+        self.assertEqual(len(calculator._interpolators),
+                         mielensfunctions.MAX_INTERPOLATORS)
+
     @attr("medium")
     def test_energy_is_conserved(self):
 
@@ -448,12 +509,27 @@ class TestMieScatteringMatrix(unittest.TestCase):
         msm_highl = mielensfunctions.MieScatteringMatrix(
             parallel_or_perpendicular='perpendicular', max_l=1000,
             **self.default_kwargs)
-        should_be_warned = 'invalid value encountered in cdouble_scalars'
-        with self.assertWarnsRegex(Warning, should_be_warned):
-            warnings.simplefilter('always')
-            s_theta = msm_highl._eval(theta)
+        s_theta = msm_highl._eval(theta)
+        als, bls = msm_highl._calculate_als_bls()
 
         self.assertFalse(np.isnan(s_theta))
+        self.assertLess(als.size, msm_highl.max_l)
+
+    @attr('fast')
+    def test_als_bls_same_as_order_by_order(self):
+        # scipy's Bessel functions of complex argument are only good to
+        # ~1e-11 at large arguments
+        tols = {'atol': 1e-10, 'rtol': 1e-10}
+        for index_ratio in [0.8, 1.1, 1.59 + 0.01j, 2.5]:
+            for size_parameter in [0.5, 10.0, 100.0]:
+                msm = mielensfunctions.MieScatteringMatrix(
+                    index_ratio=index_ratio, size_parameter=size_parameter)
+                als, bls = msm._calculate_als_bls()
+                l = np.arange(1, msm.max_l + 1)
+                als_direct, bls_direct = mielensfunctions.calculate_al_bl(
+                    index_ratio, size_parameter, l)
+                self.assertTrue(np.allclose(als, als_direct, **tols))
+                self.assertTrue(np.allclose(bls, bls_direct, **tols))
 
     @attr("fast")
     def test_perpendicular_interpolator_accuracy(self):
@@ -726,6 +802,76 @@ class TestPiecewiseChebyshevApproximant(unittest.TestCase):
         approx = piecewisecheb(x)
         self.assertTrue(np.allclose(true, approx, **TOLS))
 
+    @attr("fast")
+    def test_call_same_as_approximant_of_each_window(self):
+        # both by window and, with many windows, in one pass:
+        for nwindows in [40, 2 * mielensfunctions.MAX_MASKED_WINDOWS]:
+            piecewisecheb = mielensfunctions.PiecewiseChebyshevApproximant(
+                lambda x: np.exp(1j * x), degree=12,
+                window_breakpoints=np.linspace(0, 20, nwindows + 1))
+            np.random.seed(73)
+            x = np.random.rand(3, 50) * 20
+            approx = piecewisecheb(x)
+            for window, approximant in zip(piecewisecheb._windows,
+                                           piecewisecheb._approximants):
+                mask = piecewisecheb._mask_window(x, window)
+                self.assertTrue(
+                    np.allclose(approx[mask], approximant(x[mask]), **TOLS))
+
+    @attr("fast")
+    def test_real_call_is_accurate_by_window_and_in_one_pass(self):
+        x = np.linspace(0, 19.9, 101)
+        for nwindows in [20, 2 * mielensfunctions.MAX_MASKED_WINDOWS]:
+            piecewisecheb = mielensfunctions.PiecewiseChebyshevApproximant(
+                np.sin, degree=12,
+                window_breakpoints=np.linspace(0, 20, nwindows + 1))
+            approx = piecewisecheb(x)
+            self.assertEqual(approx.dtype, np.float64)
+            self.assertTrue(np.allclose(approx, np.sin(x), **TOLS))
+
+    @attr("fast")
+    def test_adaptive_is_accurate_to_tolerance(self):
+        function = lambda x: np.sin(x**2)
+        x = np.linspace(0, 9.99, 1001)
+        for tolerance in [1e-6, 1e-12]:
+            piecewisecheb = (
+                mielensfunctions.PiecewiseChebyshevApproximant.adaptive(
+                    function, domain=(0, 10), degree=16, tolerance=tolerance))
+            error = np.abs(piecewisecheb(x) - function(x)).max()
+            self.assertLess(error, tolerance)
+
+    @attr("fast")
+    def test_adaptive_windows_are_smaller_where_function_varies_faster(self):
+        piecewisecheb = (
+            mielensfunctions.PiecewiseChebyshevApproximant.adaptive(
+                lambda x: np.sin(x**2), domain=(0, 10), degree=16,
+                tolerance=1e-8))
+        window_sizes = np.diff(piecewisecheb.window_breakpoints)
+        self.assertGreater(window_sizes[0], window_sizes[-1])
+
+    @attr("fast")
+    def test_adaptive_raises_error_when_tolerance_cannot_be_met(self):
+        self.assertRaises(
+            RuntimeError,
+            mielensfunctions.PiecewiseChebyshevApproximant.adaptive,
+            np.sign, domain=(-1, 2), degree=4, tolerance=1e-12,
+            max_windows=64)
+
+    @attr("fast")
+    def test_save_and_load(self):
+        piecewisecheb = mielensfunctions.PiecewiseChebyshevApproximant(
+            lambda x: np.exp(1j * x), degree=12,
+            window_breakpoints=np.linspace(0, 20, 11))
+        filename = os.path.join(tempfile.mkdtemp(), 'approximant.npz')
+        piecewisecheb.save(filename)
+        loaded = mielensfunctions.PiecewiseChebyshevApproximant.load(
+            filename)
+        shutil.rmtree(os.path.dirname(filename))
+
+        x = np.linspace(0, 19.9, 101)
+        self.assertTrue(np.all(loaded(x) == piecewisecheb(x)))
+        self.assertEqual(loaded._dtype, piecewisecheb._dtype)
+
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #                           Helper functions
@@ -0,0 +1,156 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from nose.plugins.attrib import attr
+
+from holopy.core import detector_grid
+from holopy.inference import prior, AlphaModel
+from holopy.scattering import Sphere, calc_holo
+from holopy.scattering.theory import Mie
+from holopy.scattering.theory.mie_f import miescatlib
+from holopy.scattering.theory.mietable import MieCoefficientTable
+
+X_RANGE = (4., 6.)
+M_RANGE = (1.15, 1.25)
+
+
+def exact_coefficients(m, x):
+    return miescatlib.scatcoeffs(m, x, miescatlib.nstop(x), 1e-2, 1e-16)
+
+
+class TestMieCoefficientTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.table = MieCoefficientTable.build(X_RANGE, M_RANGE)
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @attr("fast")
+    def test_interpolation_is_within_error_bound(self):
+        random = np.random.RandomState(1)
+        self.assertLess(self.table.error_bound, 1e-6)
+        for x, m in zip(random.uniform(*X_RANGE, size=20),
+                        random.uniform(*M_RANGE, size=20)):
+            interpolated = self.table(m, x)
+            exact = exact_coefficients(m, x)
+            self.assertEqual(interpolated.shape, exact.shape)
+            self.assertTrue(np.allclose(
+                interpolated, exact, atol=10 * self.table.error_bound))
+
+    @attr("fast")
+    def test_exact_at_grid_points(self):
+        x = self.table.x_range[0] + 10 * self._x_spacing()
+        m = self.table.m_range[0]
+        self.assertTrue(np.allclose(
+            self.table(m, x), exact_coefficients(m, x), atol=1e-14))
+
+    @attr("fast")
+    def test_absorbing_spheres(self):
+        table = MieCoefficientTable.build(X_RANGE, M_RANGE, m_imag=0.01)
+        self.assertTrue(table.contains(1.2 + 0.01j, 5.))
+        self.assertFalse(table.contains(1.2, 5.))
+        self.assertTrue(np.allclose(
+            table(1.2 + 0.01j, 5.), exact_coefficients(1.2 + 0.01j, 5.),
+            atol=10 * table.error_bound))
+
+    @attr("fast")
+    def test_raises_error_outside_table(self):
+        self.assertRaises(ValueError, self.table, 1.2, 10.)
+
+    @attr("fast")
+    def test_save_and_load_memory_maps_table(self):
+        filename = os.path.join(self.tempdir, 'table')
+        self.table.save(filename)
+        loaded = MieCoefficientTable.load(filename)
+        self.assertIsInstance(loaded.coefficients, np.memmap)
+        self.assertEqual(loaded.error_bound, self.table.error_bound)
+        self.assertTrue(np.all(loaded(1.2, 5.) == self.table(1.2, 5.)))
+
+    @attr("fast")
+    def test_mie_uses_table(self):
+        filename = os.path.join(self.tempdir, 'table')
+        self.table.save(filename)
+        detector = detector_grid(10, 0.1)
+        optics = {'medium_index': 1.33, 'illum_wavelen': 0.66,
+                  'illum_polarization': (1, 0)}
+        wavevec = 2 * np.pi * 1.33 / 0.66
+        sphere = Sphere(n=1.2 * 1.33, r=5.1 / wavevec, center=(.5, .5, 5))
+        exact = calc_holo(detector, sphere, theory=Mie(), **optics)
+        tabulated = calc_holo(
+            detector, sphere, theory=Mie(coefficient_table=filename),
+            **optics)
+        self.assertFalse(np.all(tabulated.values == exact.values))
+        self.assertTrue(np.allclose(tabulated.values, exact.values,
+                                    atol=1e-6, rtol=0))
+
+    @attr("fast")
+    def test_mie_falls_back_outside_table(self):
+        detector = detector_grid(10, 0.1)
+        optics = {'medium_index': 1.33, 'illum_wavelen': 0.66,
+                  'illum_polarization': (1, 0)}
+        sphere = Sphere(n=1.59, r=1.5, center=(.5, .5, 5))
+        exact = calc_holo(detector, sphere, theory=Mie(), **optics)
+        tabulated = calc_holo(
+            detector, sphere, theory=Mie(coefficient_table=self.table),
+            **optics)
+        self.assertTrue(np.all(tabulated.values == exact.values))
+
+    @attr("fast")
+    def test_cross_sections_batch_uses_table(self):
+        wavevec = 2 * np.pi * 1.33 / 0.66
+        radii = np.array([4.5, 5.1, 7.]) / wavevec
+        theory = Mie(coefficient_table=self.table)
+        batch = theory.raw_cross_sections_batch(
+            1.2 * 1.33, radii, wavevec, 1.33)
+        for r, cross_sections in zip(radii, batch.T):
+            sphere = Sphere(n=1.2 * 1.33, r=r, center=(5, 5, 5))
+            single = theory.raw_cross_sections(sphere, wavevec, 1.33, None)
+            self.assertTrue(np.allclose(cross_sections, single, rtol=1e-14))
+        exact = Mie().raw_cross_sections_batch(1.2 * 1.33, radii, wavevec,
+                                               1.33)
+        self.assertFalse(np.all(batch[:, :2] == exact[:, :2]))
+        self.assertTrue(np.all(batch[:, 2] == exact[:, 2]))
+
+    @attr("fast")
+    def test_from_model_covers_priors(self):
+        sphere = Sphere(n=prior.Uniform(1.5, 1.6),
+                        r=prior.Gaussian(0.5, 0.01), center=(5, 5, 5))
+        model = AlphaModel(sphere, medium_index=1.33, illum_wavelen=0.66,
+                           illum_polarization=(1, 0), alpha=1)
+        table = MieCoefficientTable.from_model(model, nvalidate=5)
+        wavevec = 2 * np.pi * 1.33 / 0.66
+        for n, r in [(1.5, 0.45), (1.6, 0.55), (1.55, 0.5)]:
+            self.assertTrue(table.contains(n / 1.33, wavevec * r))
+        self.assertFalse(table.contains(1.7 / 1.33, wavevec * 0.5))
+
+    def _x_spacing(self):
+        npts = self.table.coefficients.shape[0]
+        return (self.table.x_range[1] - self.table.x_range[0]) / (npts - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
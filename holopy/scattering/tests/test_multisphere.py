@@ -42,6 +42,10 @@ from holopy.scattering import (
 from holopy.scattering.errors import (
     InvalidScatterer, TheoryNotCompatibleError, MultisphereFailure,
     OverlapWarning)
+from holopy.scattering.theory.multisphere import (
+    normalize_polarization, _integrate4pi, _scattered_amplitude_squared,
+    warm_start_cache)
+from holopy.scattering.theory.mie_f import uts_scsmfo
 from holopy.scattering.tests.common import (
     xschema, yschema, index, wavelen, xpolarization, ypolarization,
     scaling_alpha, sphere)
@@ -57,6 +61,10 @@ SCATTERERS_SMALL_OVERLAP = [
     Sphere(center=[3e-6, 3e-6, 10e-6], n=1.59, r=.5e-6),
     Sphere(center=[3.9e-6, 3.e-6, 10e-6], n=1.59, r=.5e-6),
     ]
+DIMER = Spheres([
+    Sphere(center=[7.1e-6, 7e-6, 10e-6], n=1.5811+1e-4j, r=5e-07),
+    Sphere(center=[6e-6, 7e-6, 10e-6], n=1.5811+1e-4j, r=5e-07),
+    ])
 
 
 class TestMultisphere(unittest.TestCase):
@@ -79,6 +87,54 @@ class TestMultisphere(unittest.TestCase):
         for k, v in kwargs.items():
             self.assertEqual(getattr(theory_out, k), v)
 
+    @attr('fast')
+    def test_warm_start_same_as_cold_start(self):
+        warm_start_cache.clear()
+        medium_wavevec = 2 * np.pi * index / wavelen
+        for meth in [0, 1]:
+            warm = Multisphere(eps=1e-14, meth=meth, warm_start=True)
+            cold = Multisphere(eps=1e-14, meth=meth)
+            warm._scsmfo_setup(DIMER, medium_wavevec, index)
+            moved = Spheres([s.translated(0, 0, 2e-8 * i)
+                             for i, s in enumerate(DIMER.scatterers)])
+            amn_warm, lmax_warm = warm._scsmfo_setup(
+                moved, medium_wavevec, index)
+            amn_cold, lmax_cold = cold._scsmfo_setup(
+                moved, medium_wavevec, index)
+            self.assertEqual(lmax_warm, lmax_cold)
+            assert_allclose(amn_warm, amn_cold, rtol=0,
+                            atol=1e-6 * np.abs(amn_cold).max())
+
+    @attr('fast')
+    def test_warm_start_takes_fewer_iterations(self):
+        warm_start_cache.clear()
+        medium_wavevec = 2 * np.pi * index / wavelen
+        warm = Multisphere(warm_start=True)
+        cold = Multisphere()
+        moved = Spheres([s.translated(0, 2e-9 * i, 0)
+                         for i, s in enumerate(DIMER.scatterers)])
+        warm._scsmfo_setup(DIMER, medium_wavevec, index)
+        warm._scsmfo_setup(moved, medium_wavevec, index)
+        cold._scsmfo_setup(moved, medium_wavevec, index)
+        self.assertEqual(len(cold.last_iterations), 2)
+        self.assertTrue(
+            max(warm.last_iterations) < min(cold.last_iterations))
+
+    @attr('fast')
+    def test_warm_start_shared_between_theories(self):
+        warm_start_cache.clear()
+        medium_wavevec = 2 * np.pi * index / wavelen
+        first = Multisphere(warm_start=True)
+        first._scsmfo_setup(DIMER, medium_wavevec, index)
+        second = first.from_parameters({})
+        cold = Multisphere()
+        moved = Spheres([s.translated(0, 2e-9 * i, 0)
+                         for i, s in enumerate(DIMER.scatterers)])
+        second._scsmfo_setup(moved, medium_wavevec, index)
+        cold._scsmfo_setup(moved, medium_wavevec, index)
+        self.assertTrue(
+            max(second.last_iterations) < min(cold.last_iterations))
+
 
 
 @attr('fast')
@@ -283,6 +339,34 @@ def test_farfield():
     matr = calc_scat_matrix(schema, cluster, illum_wavelen=.66, medium_index=index, theory=Multisphere)
 
 
+@attr('fast')
+def test_scat_matrs_same_as_one_angle_at_a_time():
+    medium_wavevec = 2 * np.pi * index / wavelen
+    amn, lmax = Multisphere()._scsmfo_setup(DIMER, medium_wavevec, index)
+    theta = np.linspace(0, np.pi, 7)
+    phi = np.linspace(0, 6, 7)
+    pos = np.array([np.ones(7), theta, phi])
+    scat_matrs = Multisphere().raw_scat_matrs(
+        DIMER, pos, medium_wavevec, index)
+    for scat_matr, t, p in zip(scat_matrs, theta, phi):
+        s1, s2, s3, s4 = uts_scsmfo.asm(amn, lmax, t, p) * -0.5
+        assert_allclose(scat_matr, [[s2, s3], [s4, s1]], rtol=1e-14)
+
+
+@attr('fast')
+def test_cross_section_quadrature_converged():
+    medium_wavevec = 2 * np.pi * index / wavelen
+    amn, lmax = Multisphere()._scsmfo_setup(DIMER, medium_wavevec, index)
+    pol = normalize_polarization(np.array([1., 0, 0]))
+
+    def costhetawt(theta, phi):
+        return (_scattered_amplitude_squared(theta, phi, pol, amn, lmax)
+                * np.cos(theta))
+
+    assert_allclose(_integrate4pi(costhetawt, lmax + 1),
+                    _integrate4pi(costhetawt, 2 * lmax + 10), rtol=1e-12)
+
+
 @attr('medium')
 def test_wrap_sphere():
     sphere=Sphere(center=[7.1e-6, 7e-6, 10e-6],n=1.5811+1e-4j, r=5e-07)
@@ -7,7 +7,8 @@ from nose.plugins.attrib import attr
 
 from holopy.core import detector_grid, detector_points
 from holopy.core.metadata import update_metadata, flat
-from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.scatteringtheory import (
+    ScatteringTheory, calc_scat_field, fields_to_cartesian)
 from holopy.scattering.theory import Mie
 from holopy.scattering.scatterer import Sphere, Spheres, Ellipsoid
 from holopy.scattering.errors import TheoryNotCompatibleError
@@ -196,6 +197,50 @@ class TestMockScatteringMatrixBasedTheory(unittest.TestCase):
         scattering_matrices = theory.raw_scat_matrs(SPHERE, positions)
         self.assertTrue(scattering_matrices.dtype.name == 'complex128')
 
+    @attr("fast")
+    def test_raw_fields_returns_correct_shape(self):
+        theory = MockScatteringMatrixBasedTheory()
+        positions = np.random.randn(3, 65)
+        fields = theory.raw_fields(
+            positions, SPHERE, 1.0, 1.33, xr.DataArray([1, 0, 0]))
+        self.assertTrue(fields.shape == positions.shape)
+
+
+class TestFarFieldFromScatteringMatrices(unittest.TestCase):
+    # These compare with the compiled Mie extension, so only they need it.
+    @attr("fast")
+    def test_calc_scat_field_matches_fortran(self):
+        from holopy.scattering.theory.mie_f import mieangfuncs
+        np.random.seed(1022)
+        kr, theta, phi, scat_matrs = _make_random_far_field_inputs(23)
+        polarization = np.array([0.6, 0.8])
+        vectorized = calc_scat_field(kr, phi, scat_matrs, polarization)
+        pointwise = np.transpose([
+            mieangfuncs.calc_scat_field(k, p, s, polarization)
+            for k, p, s in zip(kr, phi, scat_matrs)])
+        self.assertTrue(np.allclose(vectorized, pointwise, **TOLS))
+
+    @attr("fast")
+    def test_fields_to_cartesian_matches_fortran(self):
+        from holopy.scattering.theory.mie_f import mieangfuncs
+        np.random.seed(1023)
+        kr, theta, phi, _ = _make_random_far_field_inputs(23)
+        escat_sph = np.random.randn(2, 23) + 1j * np.random.randn(2, 23)
+        vectorized = fields_to_cartesian(escat_sph, theta, phi)
+        pointwise = np.transpose([
+            mieangfuncs.fieldstocart(e, t, p)
+            for e, t, p in zip(escat_sph.T, theta, phi)])
+        self.assertTrue(np.allclose(vectorized, pointwise, **TOLS))
+
+
+def _make_random_far_field_inputs(npts):
+    kr = np.random.uniform(10, 100, npts)
+    theta = np.random.uniform(0, np.pi, npts)
+    phi = np.random.uniform(0, 2 * np.pi, npts)
+    scat_matrs = (np.random.randn(npts, 2, 2) +
+                  1j * np.random.randn(npts, 2, 2))
+    return kr, theta, phi, scat_matrs
+
 
 if __name__ == '__main__':
     unittest.main()
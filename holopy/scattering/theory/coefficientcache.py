@@ -0,0 +1,126 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bounded least-recently-used cache for Lorenz-Mie scattering coefficients.
+
+During fitting, most proposals only move the particle, so the scattering
+coefficients (which depend only on the index, radius, wavevector and
+medium index) are the same from one evaluation to the next. The theories
+look their coefficients up in the shared `scattering_coefficient_cache`
+before computing them from scratch.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class CoefficientCache(object):
+    def __init__(self, maxsize=128):
+        """A thread-safe LRU cache of scattering coefficients.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of coefficient sets to keep. Once full,
+            the least-recently used entry is discarded. A maxsize of 0
+            disables caching.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the cached value for `key`, calling `compute()` and
+        storing its result if `key` is not present.
+
+        Cached arrays are marked read-only, since they are shared between
+        all the callers with the same key.
+        """
+        with self._lock:
+            if key in self._store:
+                self.hits += 1
+                self._store.move_to_end(key)
+                return self._store[key]
+            self.misses += 1
+        return self.put(key, compute())
+
+    def put(self, key, value):
+        """Store `value` for `key`, replacing any value already there,
+        and return it, read-only as for `get`."""
+        value = _make_readonly(value)
+        with self._lock:
+            if self.maxsize > 0:
+                self._store[key] = value
+                self._store.move_to_end(key)
+                self._evict()
+        return value
+
+    def resize(self, maxsize):
+        """Change the maximum number of stored entries."""
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counts."""
+        with self._lock:
+            self._store.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Hit and miss statistics, as a `CacheInfo` namedtuple."""
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.maxsize, len(self._store))
+
+    def __len__(self):
+        return len(self._store)
+
+    def _evict(self):
+        while len(self._store) > max(self.maxsize, 0):
+            self._store.popitem(last=False)
+
+
+def make_key(*args):
+    """Converts scalars and array-likes (including xarray objects) to a
+    hashable tuple suitable for use as a cache key."""
+    key = []
+    for arg in args:
+        if isinstance(arg, str) or arg is None:
+            key.append(arg)
+        else:
+            key.append(tuple(np.ravel(np.asarray(arg)).tolist()))
+    return tuple(key)
+
+
+def _make_readonly(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        value = tuple(_make_readonly(v) for v in value)
+    return value
+
+
+scattering_coefficient_cache = CoefficientCache()
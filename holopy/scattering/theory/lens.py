@@ -1,6 +1,8 @@
+import copy
 import warnings
 
 import numpy as np
+from scipy.special import j0
 
 try:
     import numexpr as ne
@@ -13,18 +15,30 @@ except ModuleNotFoundError:
 
 from holopy.core import detector_points, update_metadata
 from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.mielensfunctions import j2
+
+# The number of points compared to quadrature by the 'fft' method
+FFT_NCHECK = 16
+# The quadrature for that comparison has this many points more than the
+# number of oscillations of the integrand across the pupil
+FFT_CHECK_MARGIN = 32
 
 
 class Lens(ScatteringTheory):
     """ Wraps a ScatteringTheory and overrides the raw_fields to include the
     effect of an objective lens.
+
+    If the wrapped theory is azimuthally symmetric, the integral over
+    the azimuthal angle of the pupil is done analytically, in terms of
+    Bessel functions as in `MieLens`, and only the quadrature over theta
+    is numerical.
     """
     desired_coordinate_system = 'cylindrical'
     parameter_names = ('lens_angle',)
 
-    numexpr_integrand_prefactor1 = (
-        'exp(1j * krho_p * sintheta * cos(phi_relative))')
-    numexpr_integrand_prefactor2 = 'exp(1j * kz_p * (1 - costheta))'
+    numexpr_integrand_phase = (
+        'exp(1j * (krho_p * sintheta * cos(phi_relative) + '
+        'kz_p * (1 - costheta)))')
     numexpr_integrand_prefactor3 = (
         'sqrt(costheta) * sintheta * phi_wts * theta_wts')
     numexpr_integrandl = ('prefactor * (cosphi * (cosphi * S2 + sinphi * S3) +'
@@ -33,7 +47,53 @@ class Lens(ScatteringTheory):
                           + ' cosphi * (cosphi * S4 + sinphi * S1))')
 
     def __init__(self, lens_angle, theory, quad_npts_theta=100,
-                 quad_npts_phi=100, use_numexpr=True):
+                 quad_npts_phi=100, use_numexpr=True, chunksize=32,
+                 method='quadrature', fft_npts=256, fft_oversampling=2.,
+                 fft_tolerance=1e-2):
+        """
+        Parameters
+        ----------
+        lens_angle : float
+            Lens acceptance angle in radians.
+        theory : :class:`.ScatteringTheory` object
+            The theory for the scattering matrices of the scatterer.
+        quad_npts_theta, quad_npts_phi : int, optional
+            The number of quadrature points over the lens pupil.
+        use_numexpr : bool, optional
+            Whether to evaluate the integrand with numexpr, if installed.
+        chunksize : int, optional
+            The number of detector points integrated at once. The
+            integration needs about 4 * 16 * quad_npts_theta *
+            quad_npts_phi * chunksize bytes, whatever the size of the
+            detector.
+        method : {'quadrature', 'fft'}, optional
+            How to evaluate the integral over the lens pupil. With
+            'fft', the fields on a regular detector grid at one z are
+            calculated with chirp-z transforms of the pupil function
+            sampled on a square grid, at a cost of O(M log M) for M
+            points instead of O(quad_npts_theta * quad_npts_phi * M).
+            Other detectors use quadrature.
+        fft_npts : int, optional
+            The smallest number of points across the square grid on
+            which the pupil function is sampled for 'fft'. The error
+            falls as 1 / fft_npts**2, and is about 1e-3 relative for
+            256 points.
+        fft_oversampling : float, optional
+            How much finer than the Nyquist limit for the largest
+            distance from the scatterer to a detector point the pupil
+            grid is, for 'fft'.
+        fft_tolerance : float or None, optional
+            With 'fft', the fields at a few points are checked against
+            quadrature, and a warning is given if they differ by more
+            than `fft_tolerance` relative to the largest field there.
+            The check uses enough quadrature points to resolve the
+            integrand at the farthest of those points, which may be many
+            more than quad_npts_theta and quad_npts_phi. None skips the
+            check.
+        """
+        if method not in ('quadrature', 'fft'):
+            raise ValueError(
+                "method must be 'quadrature' or 'fft', not {}".format(method))
         if not NUMEXPR_INSTALLED:
             warnings.warn(_LENS_WARNING, PerformanceWarning)
             use_numexpr = False
@@ -42,6 +102,11 @@ class Lens(ScatteringTheory):
         self.theory = theory
         self.quad_npts_theta = quad_npts_theta
         self.quad_npts_phi = quad_npts_phi
+        self.chunksize = chunksize
+        self.method = method
+        self.fft_npts = fft_npts
+        self.fft_oversampling = fft_oversampling
+        self.fft_tolerance = fft_tolerance
 
         self.use_numexpr = use_numexpr
         self._setup_quadrature()
@@ -70,10 +135,15 @@ class Lens(ScatteringTheory):
                     illum_polarization):
         pol_angle = np.arctan2(illum_polarization.values[1],
                                illum_polarization.values[0])
-        integral_l, integral_r = self._compute_integral(positions, scatterer,
-                                                        medium_wavevec,
-                                                        medium_index,
-                                                        pol_angle)
+        args = (scatterer, medium_wavevec, medium_index, pol_angle)
+        grid = None
+        if self.method == 'fft':
+            grid = _find_regular_grid(positions)
+        if grid is None:
+            integral_l, integral_r = self._compute_integral(positions, *args)
+        else:
+            integral_l, integral_r = self._compute_integral_by_fft(
+                positions, grid, *args)
 
         fields = self._transform_integral_from_lr_to_xyz(integral_l,
                                                          integral_r,
@@ -85,49 +155,205 @@ class Lens(ScatteringTheory):
 
     def _compute_integral(self, positions, scatterer, medium_wavevec,
                           medium_index, pol_angle):
-        int_l, int_r = self._compute_integrand(positions, scatterer,
-                                               medium_wavevec, medium_index,
-                                               pol_angle)
-        integral_l = np.sum(int_l, axis=(0, 1))
-        integral_r = np.sum(int_r, axis=(0, 1))
-        return integral_l, integral_r
-
-    def _compute_integrand(self, positions, scatterer, medium_wavevec,
-                           medium_index, pol_angle):
-        krho_p, phi_p, kz_p = positions
-        pos_shape = (1, 1, len(kz_p))
-        krho_p = krho_p.reshape(pos_shape)
-        phi_p = phi_p.reshape(pos_shape)
-        kz_p = kz_p.reshape(pos_shape)
-
-        prefactor = self._integrand_prefactor(krho_p, phi_p, kz_p)
-
+        if self.theory.azimuthally_symmetric:
+            return self._compute_symmetric_integral(
+                positions, scatterer, medium_wavevec, medium_index,
+                pol_angle)
+        # The integrand is the product of a pupil term that does not
+        # depend on the detector point and a phase that does. The
+        # pupil terms are calculated once, and the phases one chunk of
+        # detector points at a time, so the memory needed is fixed. Each
+        # chunk is integrated by a matrix product with the pupil terms.
+        dtype = np.result_type(positions, np.complex64)
         scat_matrix = self._calc_scattering_matrix(scatterer,
                                                    medium_wavevec,
                                                    medium_index)
-        integrand_l = self._integrand_prll(prefactor, pol_angle, *scat_matrix)
-        integrand_r = self._integrand_perp(prefactor, pol_angle, *scat_matrix)
-        return integrand_l, integrand_r
+        weights = self._pupil_weights(dtype)
+        pupil_terms = np.array([
+            self._integrand_prll(weights, pol_angle, *scat_matrix),
+            self._integrand_perp(weights, pol_angle, *scat_matrix)],
+            dtype=dtype).reshape(2, -1)
+
+        npoints = positions.shape[1]
+        integrals = np.zeros((2, npoints), dtype=dtype)
+        for start in range(0, npoints, self.chunksize):
+            chunk = slice(start, start + self.chunksize)
+            krho_p, phi_p, kz_p = [
+                p.reshape(1, 1, -1) for p in positions[:, chunk]]
+            phase = self._integrand_phase(krho_p, phi_p, kz_p)
+            integrals[:, chunk] = pupil_terms.dot(
+                phase.reshape(pupil_terms.shape[1], -1))
+        return integrals
+
+    def _compute_symmetric_integral(self, positions, scatterer,
+                                    medium_wavevec, medium_index, pol_angle):
+        # With diagonal scattering matrices S2(theta), S1(theta), the
+        # integrals over phi of the parallel and perpendicular
+        # integrands are
+        #   pi * ((S2 + S1) J0 - (S2 - S1) J2 cos(2 (phi_p - pol_angle)))
+        #   -pi * (S2 - S1) J2 sin(2 (phi_p - pol_angle))
+        # with J0 and J2 evaluated at krho_p * sin(theta).
+        dtype = np.result_type(positions, np.complex64)
+        theta = self._theta_pts.ravel()
+        pos = np.array([0 * theta, theta, 0 * theta])
+        S = np.conj(self.theory.raw_scat_matrs(
+            scatterer, pos, medium_wavevec, medium_index))
+        S1, S2 = S[:, 1, 1], S[:, 0, 0]
+        costheta = self._costheta.ravel()
+        sintheta = self._sintheta.ravel()
+        weights = 0.5 * np.sqrt(costheta) * sintheta * self._theta_wts.ravel()
+        even_terms = (weights * (S2 + S1)).reshape(1, -1)
+        odd_terms = (weights * (S2 - S1)).reshape(1, -1)
 
-    def _integrand_prefactor(self, krho_p, phi_p, kz_p):
+        npoints = positions.shape[1]
+        integrals = np.zeros((2, npoints), dtype=dtype)
+        # the chunks need the same memory as those of the 2D quadrature
+        chunksize = self.chunksize * self.quad_npts_phi
+        for start in range(0, npoints, chunksize):
+            chunk = slice(start, start + chunksize)
+            krho_p, phi_p, kz_p = positions[:, chunk]
+            phase = np.exp(1j * np.outer(kz_p, 1 - costheta))
+            rho_sintheta = np.outer(krho_p, sintheta)
+            even = (even_terms * phase * j0(rho_sintheta)).sum(axis=1)
+            odd = (odd_terms * phase * j2(rho_sintheta)).sum(axis=1)
+            integrals[0, chunk] = even - odd * np.cos(2 * (phi_p - pol_angle))
+            integrals[1, chunk] = -odd * np.sin(2 * (phi_p - pol_angle))
+        return integrals
+
+    def _compute_integral_by_fft(self, positions, grid, scatterer,
+                                 medium_wavevec, medium_index, pol_angle):
+        # In terms of the transverse wavevector (u, v) = sin(theta) *
+        # (cos(phi), sin(phi)) and the detector point (X, Y) = krho *
+        # (cos(phi_p), sin(phi_p)), the integral is the Fourier
+        # transform of the pupil function over the disk u^2 + v^2 <
+        # sin(lens_angle)^2. On a regular detector grid it separates
+        # into chirp-z transforms along x and y.
+        (x0, dx, nx), (y0, dy, ny), order = grid
+        kz = positions[2, 0]
+        extent = max(abs(x0), abs(x0 + dx * (nx - 1)),
+                     abs(y0), abs(y0 + dy * (ny - 1)))
+        pupil_u, pupil_terms = self._pupil_function(
+            extent, kz, scatterer, medium_wavevec, medium_index, pol_angle)
+        du = pupil_u[1] - pupil_u[0]
+        integrals = _chirp_z(pupil_terms, pupil_u[0], du, x0, dx, nx, axis=1)
+        integrals = _chirp_z(integrals, pupil_u[0], du, y0, dy, ny, axis=2)
+        integrals = integrals.reshape(2, -1)[:, order]
+
+        if self.fft_tolerance is not None:
+            self._check_fft_integral(integrals, positions, scatterer,
+                                     medium_wavevec, medium_index, pol_angle)
+        return integrals.astype(np.result_type(positions, np.complex64),
+                                copy=False)
+
+    def _check_fft_integral(self, integrals, positions, scatterer,
+                            medium_wavevec, medium_index, pol_angle):
+        check = np.linspace(0, positions.shape[1] - 1,
+                            min(FFT_NCHECK, positions.shape[1])).astype(int)
+        checker = self._check_quadrature(positions[:, check])
+        correct = checker._compute_integral(
+            positions[:, check], scatterer, medium_wavevec, medium_index,
+            pol_angle)
+        error = (np.abs(integrals[:, check] - correct).max() /
+                 np.abs(correct).max())
+        if error > self.fft_tolerance:
+            warnings.warn(
+                "The lens integral from FFTs differs from quadrature by "
+                "{:.2g} relative. Increase quad_npts_theta and "
+                "quad_npts_phi, or fft_npts.".format(error))
+
+    def _check_quadrature(self, positions):
+        """A copy of this theory whose quadrature resolves the integrand
+        at `positions`. Like the pupil grid of the FFT, it is sized from
+        the distance to the farthest point: the phase varies by up to
+        krho * NA + |kz| * (1 - cos(lens_angle)) across the pupil."""
+        krho, _, kz = positions
+        numerical_aperture = np.sin(self.lens_angle)
+        phi_range = np.abs(krho).max() * numerical_aperture
+        theta_range = phi_range + np.abs(kz).max() * (
+            1 - np.cos(self.lens_angle))
+        checker = copy.copy(self)
+        checker.quad_npts_theta = max(
+            self.quad_npts_theta,
+            int(np.ceil(theta_range / 2)) + FFT_CHECK_MARGIN)
+        checker.quad_npts_phi = max(
+            self.quad_npts_phi, int(np.ceil(phi_range)) + FFT_CHECK_MARGIN)
+        checker._setup_quadrature()
+        return checker
+
+    def _pupil_function(self, extent, kz, scatterer, medium_wavevec,
+                        medium_index, pol_angle):
+        """The pupil function on a square grid of transverse wavevectors
+        u, v, fine enough to integrate exp(i (u X + v Y)) for |X|, |Y| <
+        `extent`, as the grid u and an array (2, nu, nu) of the
+        integrands for the parallel and perpendicular fields."""
+        numerical_aperture = np.sin(self.lens_angle)
+        npts = int(np.ceil(
+            self.fft_oversampling * 2 * numerical_aperture * extent / np.pi))
+        npts = max(npts, self.fft_npts)
+        du = 2 * numerical_aperture / npts
+        pupil_u = -numerical_aperture + du * (np.arange(npts) + 0.5)
+        u, v = np.meshgrid(pupil_u, pupil_u, indexing='ij')
+        weights = _fraction_in_disk(u, v, du, numerical_aperture)
+        inside = weights > 0
+
+        sintheta = np.sqrt(u[inside]**2 + v[inside]**2)
+        theta = np.arcsin(np.clip(sintheta, 0, 1))
+        phi = np.arctan2(v[inside], u[inside])
+        costheta = np.cos(theta)
+        S1, S2, S3, S4 = self._scattering_matrix_at(
+            theta, phi, scatterer, medium_wavevec, medium_index)
+        cosphi = np.cos(phi - pol_angle)
+        sinphi = np.sin(phi - pol_angle)
+        # sin(theta) dtheta dphi = du dv / cos(theta)
+        prefactor = (weights[inside] * du**2 * np.exp(1j * kz * (1 - costheta))
+                     / (2 * np.pi * np.sqrt(costheta)))
+        pupil_terms = np.zeros((2, npts, npts), dtype=complex)
+        pupil_terms[0][inside] = prefactor * (
+            cosphi * (cosphi * S2 + sinphi * S3) +
+            sinphi * (cosphi * S4 + sinphi * S1))
+        pupil_terms[1][inside] = prefactor * (
+            sinphi * (cosphi * S2 + sinphi * S3) -
+            cosphi * (cosphi * S4 + sinphi * S1))
+        return pupil_u, pupil_terms
+
+    def _scattering_matrix_at(self, theta, phi, scatterer, medium_wavevec,
+                              medium_index):
+        pos = np.array([0 * theta, theta, phi]).reshape(3, -1)
+        S = np.conj(self.theory.raw_scat_matrs(
+            scatterer, pos, medium_wavevec, medium_index))
+        return S[:, 1, 1], S[:, 0, 0], S[:, 0, 1], S[:, 1, 0]
+
+    def _integrand_phase(self, krho_p, phi_p, kz_p):
         # define variables for numexpr:
-        sintheta = self._sintheta
-        costheta = self._costheta
-        phi_relative = self._phi_pts - phi_p
-        phi_wts = self._phi_wts
-        theta_wts = self._theta_wts
+        dtype = krho_p.dtype
+        sintheta = self._sintheta.astype(dtype, copy=False)
+        costheta = self._costheta.astype(dtype, copy=False)
+        phi_relative = self._phi_pts.astype(dtype, copy=False) - phi_p
+        if self.use_numexpr:
+            phase = ne.evaluate(self.numexpr_integrand_phase)
+        else:
+            phase = np.exp(1j * (krho_p * sintheta * np.cos(phi_relative) +
+                                 kz_p * (1 - costheta)))
+        return phase
+
+    def _pupil_weights(self, dtype):
+        """The quadrature weights and the factors of the integrand that
+        only depend on the position in the pupil, as (theta, phi, 1)."""
+        dtype = np.finfo(dtype).dtype
+        sintheta = self._sintheta.astype(dtype, copy=False)
+        costheta = self._costheta.astype(dtype, copy=False)
+        phi_wts = self._phi_wts.astype(dtype, copy=False)
+        theta_wts = self._theta_wts.astype(dtype, copy=False)
         if self.use_numexpr:
-            prefactor = ne.evaluate(self.numexpr_integrand_prefactor1)
-            prefactor *= ne.evaluate(self.numexpr_integrand_prefactor2)
-            prefactor *= ne.evaluate(self.numexpr_integrand_prefactor3)
+            weights = ne.evaluate(self.numexpr_integrand_prefactor3)
         else:
-            prefactor = np.exp(
-                1j * krho_p * sintheta * np.cos(phi_relative))
-            prefactor *= np.exp(1j * kz_p * (1 - costheta))
-            prefactor *= (np.sqrt(costheta) * sintheta *
-                          phi_wts * theta_wts)
-        prefactor *= .5 / np.pi
-        return prefactor
+            weights = np.sqrt(costheta) * sintheta * phi_wts * theta_wts
+        weights *= .5 / np.pi
+        return weights
+
+    def _relative_phi(self, prefactor, pol_angle):
+        dtype = np.finfo(prefactor.dtype).dtype
+        return (self._phi_pts - pol_angle).astype(dtype, copy=False)
 
     def _calc_scattering_matrix(self, scatterer, medium_wavevec, medium_index):
         theta, phi = np.meshgrid(self._theta_pts, self._phi_pts)
@@ -135,7 +361,7 @@ class Lens(ScatteringTheory):
         pos = np.array([0 * theta, theta, phi]).reshape(3, -1)
         S = self.theory.raw_scat_matrs(
             scatterer, pos, medium_wavevec, medium_index)
-        S = np.conj(S).reshape(self.quad_npts_theta, self.quad_npts_phi, 2, 2)
+        S = np.conj(S).reshape(self.quad_npts_phi, self.quad_npts_theta, 2, 2)
         S = np.swapaxes(S, 0, 1)
         S1 = S[:, :, 1, 1].reshape(self.quad_npts_theta, self.quad_npts_phi, 1)
         S2 = S[:, :, 0, 0].reshape(self.quad_npts_theta, self.quad_npts_phi, 1)
@@ -144,8 +370,9 @@ class Lens(ScatteringTheory):
         return S1, S2, S3, S4
 
     def _integrand_prll(self, prefactor, pol_angle, S1, S2, S3, S4):
-        cosphi = np.cos(self._phi_pts - pol_angle)
-        sinphi = np.sin(self._phi_pts - pol_angle)
+        phi_relative = self._relative_phi(prefactor, pol_angle)
+        cosphi = np.cos(phi_relative)
+        sinphi = np.sin(phi_relative)
         if self.use_numexpr:
             integrand_l = ne.evaluate(self.numexpr_integrandl)
         else:
@@ -154,8 +381,9 @@ class Lens(ScatteringTheory):
         return integrand_l
 
     def _integrand_perp(self, prefactor, pol_angle, S1, S2, S3, S4):
-        cosphi = np.cos(self._phi_pts - pol_angle)
-        sinphi = np.sin(self._phi_pts - pol_angle)
+        phi_relative = self._relative_phi(prefactor, pol_angle)
+        cosphi = np.cos(phi_relative)
+        sinphi = np.sin(phi_relative)
         if self.use_numexpr:
             integrand_r = ne.evaluate(self.numexpr_integrandr)
         else:
@@ -168,7 +396,8 @@ class Lens(ScatteringTheory):
                                            pol_angle):
         parallel = np.array([      np.cos(pol_angle), np.sin(pol_angle)])
         perpendicular = np.array([-np.sin(pol_angle), np.cos(pol_angle)])
-        xyz = np.zeros([3, prll_component.size], dtype='complex')
+        xyz = np.zeros([3, prll_component.size],
+                       dtype=np.result_type(prll_component, np.complex64))
         for i in range(2):
             xyz[i, :] += prll_component * parallel[i]
             xyz[i, :] += perp_component * perpendicular[i]
@@ -184,6 +413,71 @@ class Lens(ScatteringTheory):
         return -1. * np.exp(1j * particle_kz)
 
 
+def _find_regular_grid(positions, tolerance=1e-8):
+    """
+    The ((x0, dx, nx), (y0, dy, ny), order) of cylindrical `positions`
+    on a regular x-y grid at one z, such that the grid point (i, j),
+    flattened in C order, is ``order[k]`` for point k, or None if the
+    points are not on such a grid.
+    """
+    krho, phi, kz = positions
+    if np.ptp(kz) > tolerance * (1 + np.abs(kz).max()):
+        return None
+    x = krho * np.cos(phi)
+    y = krho * np.sin(phi)
+    scale = tolerance * (1 + max(np.abs(x).max(), np.abs(y).max()))
+    axes = []
+    for values in [x, y]:
+        first = values.min()
+        spacings = np.diff(np.unique(values))
+        spacings = spacings[spacings > scale]
+        step = spacings.min() if spacings.size else 1.
+        index = np.round((values - first) / step).astype(int)
+        if np.abs(first + index * step - values).max() > scale:
+            return None
+        axes.append((first, step, index.max() + 1, index))
+    (x0, dx, nx, i), (y0, dy, ny, j) = axes
+    if nx * ny != positions.shape[1]:
+        return None
+    flat_index = i * ny + j
+    if np.bincount(flat_index).max() > 1:
+        return None
+    return (x0, dx, nx), (y0, dy, ny), flat_index
+
+
+def _chirp_z(values, u0, du, x0, dx, nx, axis):
+    """
+    sum_j values[j] exp(i (u0 + j du) (x0 + m dx)) along `axis`, for
+    m = 0 to nx - 1, with Bluestein's algorithm.
+    """
+    values = np.moveaxis(values, axis, -1)
+    nu = values.shape[-1]
+    j = np.arange(nu)
+    m = np.arange(nx)
+    step = du * dx
+    # j m = (j^2 + m^2 - (m - j)^2) / 2
+    chirped = values * np.exp(1j * (j * du * x0 + 0.5 * step * j**2))
+    size = int(2**np.ceil(np.log2(nu + nx - 1)))
+    d = np.concatenate([np.arange(nx), np.arange(-(nu - 1), 0)])
+    kernel = np.zeros(size, dtype=complex)
+    kernel[d % size] = np.exp(-0.5j * step * d**2)
+    convolved = np.fft.ifft(
+        np.fft.fft(chirped, size) * np.fft.fft(kernel), axis=-1)[..., :nx]
+    result = convolved * np.exp(1j * (0.5 * step * m**2 + u0 * (x0 + m * dx)))
+    return np.moveaxis(result, -1, axis)
+
+
+def _fraction_in_disk(u, v, du, radius, nsub=8):
+    """The fraction of each square cell of side du centered on (u, v)
+    that lies within the disk of `radius`, from nsub x nsub samples."""
+    offsets = du * ((np.arange(nsub) + 0.5) / nsub - 0.5)
+    fraction = np.zeros(u.shape)
+    for du_sub in offsets:
+        for dv_sub in offsets:
+            fraction += (u + du_sub)**2 + (v + dv_sub)**2 < radius**2
+    return fraction / nsub**2
+
+
 def gauss_legendre_pts_wts(a, b, npts=100):
     """Quadrature points for integration on interval [a, b]"""
     pts_raw, wts_raw = np.polynomial.legendre.leggauss(npts)
@@ -26,19 +26,32 @@ scattered field.
 .. moduleauthor:: Vinothan N. Manoharan <vnm@seas.harvard.edu>
 '''
 
+from functools import partial
+
 import numpy as np
-from holopy.core.utils import ensure_array
+from holopy.core.utils import ensure_array, choose_pool, close_pool
 from holopy.core.errors import DependencyMissing
 from holopy.scattering.errors import TheoryNotCompatibleError, InvalidScatterer
 from holopy.scattering.scatterer import Sphere, Spheres
 from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.coefficientcache import (
+    scattering_coefficient_cache, make_key)
+from holopy.scattering.theory.translationreuse import (
+    calc_planar_field, is_planar)
+from holopy.scattering.theory.mietable import get_table
+from holopy.scattering.theory import mienumpy
+from holopy.scattering.theory.mienumpy import asm_mie_far
+from holopy.scattering.theory.mie_f import miescatlib, scatcoeffs_multi
+from holopy.scattering.theory.mie_f.multilayer_sphere_lib import (
+    inner_layer_cache)
 try:
-    from holopy.scattering.theory.mie_f import (mieangfuncs, miescatlib,
-                                                scatcoeffs_multi)
+    from holopy.scattering.theory.mie_f import mieangfuncs
     _COMPILED_FORTRAN = True
 except ImportError:
     _COMPILED_FORTRAN = False
 
+BACKENDS = ('fortran', 'numpy')
+
 
 class Mie(ScatteringTheory):
     """
@@ -61,8 +74,11 @@ class Mie(ScatteringTheory):
     Currently, in calculating the Lorenz-Mie scattering coefficients,
     the maximum size parameter x = ka is limited to 1000.
     """
+    azimuthally_symmetric = True
+
     def __init__(self, compute_escat_radial=True, full_radial_dependence=True,
-                 eps1=1e-2, eps2=1e-16):
+                 eps1=1e-2, eps2=1e-16, translation_reuse=False,
+                 coefficient_table=None, backend='fortran'):
         """
         Parameters
         ----------
@@ -71,16 +87,41 @@ class Mie(ScatteringTheory):
         full_radial dependence : bool
             determines if the full spherical Hankel function will be used,
             or if it will be approximated to be in the far field.
+        translation_reuse : bool
+            If True, fields on a planar detector are interpolated from
+            radial profiles tabulated once per sphere and detector
+            distance, so that moving the sphere in x and y is cheap. The
+            interpolation is accurate to better than 1e-8 relative.
+        coefficient_table : :class:`.MieCoefficientTable` or str, optional
+            A table of precomputed scattering coefficients, or the
+            filename of a saved table, which is memory-mapped. Homogeneous
+            spheres inside the table are interpolated from it, to within
+            its `error_bound`; other spheres are calculated directly.
+            Pass a filename for a theory that can be saved to yaml.
+        backend : {'fortran', 'numpy'}
+            Whether to calculate fields with the compiled Fortran
+            routines, which loop over detector points, or with NumPy,
+            vectorized over detector points. The numpy backend does not
+            need the Fortran extension to be built, and agrees with it
+            to about 1e-8, the precision of the prefactors in the Fortran
+            routines.
         """
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of {}, not {}".format(
+                BACKENDS, backend))
         self.compute_escat_radial = compute_escat_radial
         self.full_radial_dependence = full_radial_dependence
         self.eps1 = eps1
         self.eps2 = eps2
-        if not _COMPILED_FORTRAN:
+        self.translation_reuse = translation_reuse
+        self.coefficient_table = coefficient_table
+        self.backend = backend
+        if backend == 'fortran' and not _COMPILED_FORTRAN:
             raise DependencyMissing("Mie theory", "This is probably "
                                     "due to a problem with compiling Fortran "
                                     "code, as it should be built with the rest"
-                                    " of HoloPy through f2py.")
+                                    " of HoloPy through f2py. Use "
+                                    "backend='numpy' instead.")
         super().__init__()
 
     def can_handle(self, scatterer):
@@ -96,9 +137,9 @@ class Mie(ScatteringTheory):
                 scatterer, medium_wavevec, medium_index)
 
             # In the mie solution the amplitude scattering matrix is
-            # independent of phi
-            return [mieangfuncs.asm_mie_far(scat_coeffs, theta)
-                    for r, theta, phi in pos.T]
+            # independent of phi, so we only evaluate at the unique thetas
+            theta, theta_index = np.unique(pos[1], return_inverse=True)
+            return asm_mie_far(scat_coeffs, theta)[theta_index]
         else:
             raise TheoryNotCompatibleError(self, scatterer)
 
@@ -106,20 +147,66 @@ class Mie(ScatteringTheory):
             self, positions, scatterer, medium_wavevec, medium_index,
             illum_polarization):
         scat_coeffs = self._scat_coeffs(scatterer, medium_wavevec, medium_index)
-        fields = mieangfuncs.mie_fields(
+        kr, theta, phi = positions
+        kz = kr * np.cos(theta)
+        if self.translation_reuse and is_planar(kz):
+            def calculate_xpol_field(krho, phi):
+                positions = np.array(
+                    [np.hypot(krho, kz[0]), np.arctan2(krho, kz[0]), phi])
+                return self._mie_fields(
+                    positions, scat_coeffs, [1, 0],
+                    self.compute_escat_radial, self.full_radial_dependence)
+            key = make_key('mie', scatterer.n, scatterer.r, kz[0],
+                           medium_wavevec, medium_index, repr(self))
+            return calc_planar_field(
+                calculate_xpol_field, key, kr * np.sin(theta), phi,
+                illum_polarization.values[:2])
+        fields = self._mie_fields(
             positions, scat_coeffs, illum_polarization.values[:2],
             self.compute_escat_radial, self.full_radial_dependence)
         return fields
 
+    @property
+    def _mie_fields(self):
+        if self.backend == 'numpy':
+            return mienumpy.mie_fields
+        return mieangfuncs.mie_fields
+
+    def raw_total_fields(
+            self, positions, scatterer, medium_wavevec, medium_index,
+            illum_polarization, chunksize=4096):
+        """
+        Total field inside and around a sphere or layered sphere: the
+        internal field inside each layer, and the incident plus the
+        scattered field outside, with the incident field of unit
+        amplitude and zero phase at the center of the sphere.
+
+        Parameters
+        ----------
+        positions : (3, N) array
+            (kr, theta, phi) of the points, relative to the sphere.
+        chunksize : int
+            Number of points evaluated at once, which bounds the memory
+            used for any number of points; see `mienumpy.layered_fields`.
+
+        Returns
+        -------
+        (3, N) complex array
+            Cartesian components of the field.
+        """
+        coeffs = self._scat_coeffs_internal(
+            scatterer, medium_wavevec, medium_index)
+        return mienumpy.layered_fields(
+            positions, ensure_array(scatterer.n) / medium_index,
+            medium_wavevec * ensure_array(scatterer.r), coeffs,
+            illum_polarization.values[:2], chunksize)
+
     def _raw_internal_fields(
             self, positions, scatterer, medium_wavevec, medium_index,
             illum_polarization):
-        scat_coeffs = self._scat_coeffs(scatterer, medium_wavevec, medium_index)
-        # TODO BUG: this isn't right for layered spheres (and will
-        # probably crash)
-        fields = mieangfuncs.mie_internal_fields(
-            positions, scatterer.n, scat_coeffs, illum_polarization)
-        return fields
+        return self.raw_total_fields(
+            positions, scatterer, medium_wavevec, medium_index,
+            illum_polarization)
 
     def raw_cross_sections(
             self, scatterer, medium_wavevec, medium_index, illum_polarization):
@@ -167,6 +254,52 @@ class Mie(ScatteringTheory):
 
         return np.array([cscat, cabs, cext, asym])
 
+    def raw_cross_sections_batch(self, n, r, medium_wavevec, medium_index,
+                                 parallel=None, batchsize=1024):
+        """
+        Cross sections of many homogeneous spheres at once, with the
+        `backend` and `coefficient_table` of this theory.
+
+        Parameters
+        ----------
+        n, r, medium_wavevec, medium_index : array-like
+            Sphere indices and radii, wavevectors and indices of the
+            medium, as 1D arrays of the same length or scalars. Element i
+            of the result is for (n[i], r[i], medium_wavevec[i],
+            medium_index[i]).
+        parallel : optional
+            Pool or argument to `holopy.core.utils.choose_pool` used to
+            process the batches.
+        batchsize : int
+            Number of spheres handled together by one worker.
+
+        Returns
+        -------
+        cross_sections : array (4, N)
+            As for `raw_cross_sections`, for each sphere.
+        """
+        n, r, medium_wavevec, medium_index = np.broadcast_arrays(
+            *[np.ravel(v) for v in (n, r, medium_wavevec, medium_index)])
+        if (r == 0).any():
+            raise ValueError("Radius is zero")
+        size_parameter = medium_wavevec * r
+        if size_parameter.max() > 1e3:
+            raise ValueError(
+                "radius too large, calculation would take forever")
+        index_ratio = n / medium_index
+        batches = [
+            (index_ratio[i:i + batchsize], size_parameter[i:i + batchsize],
+             medium_wavevec[i:i + batchsize])
+            for i in range(0, r.size, batchsize)]
+        pool = choose_pool(parallel)
+        try:
+            results = list(pool.map(
+                partial(_cross_sections_for_batch, self), batches))
+        finally:
+            if pool is not parallel:
+                close_pool(pool)
+        return np.concatenate(results, axis=1)
+
     def _scat_coeffs(self, s, medium_wavevec, medium_index):
         '''
         Calculate Mie scattering coefficients.
@@ -199,20 +332,55 @@ class Mie(ScatteringTheory):
             msg =  "radius too large, field calculation would take forever"
             raise InvalidScatterer(s, msg)
 
+        if self.coefficient_table is not None and x_arr.size == 1:
+            table = get_table(self.coefficient_table)
+            if m_arr.size == 1 and table.contains(m_arr[0], x_arr[0]):
+                return table(m_arr[0], x_arr[0])
+        # The coefficients do not depend on the particle position, so
+        # during a fit they are usually the same from call to call.
+        key = make_key('mie', s.n, s.r, medium_wavevec, medium_index,
+                       self.eps1, self.eps2, self.backend)
+        return scattering_coefficient_cache.get(
+            key, lambda: self._calculate_scat_coeffs(m_arr, x_arr))
+
+    def _homogeneous_scat_coeffs(self, m, x):
+        """a_n and b_n of a homogeneous sphere with relative index `m` and
+        size parameter `x`, from the coefficient table if it covers them."""
+        if self.coefficient_table is not None:
+            table = get_table(self.coefficient_table)
+            if table.contains(m, x):
+                return table(m, x)
+        return self._calculate_scat_coeffs(np.array([m]), np.array([x]))
+
+    def _calculate_scat_coeffs(self, m_arr, x_arr):
         if len(x_arr) == 1 and len(m_arr) == 1:
             # Could just use scatcoeffs_multi here, but jerome is in favor of
             # keeping the simpler single layer code here
             lmax = miescatlib.nstop(x_arr[0])
-            return  miescatlib.scatcoeffs(m_arr[0], x_arr[0], lmax, self.eps1,
-                                          self.eps2)
+            scatcoeffs = (mienumpy.scatcoeffs if self.backend == 'numpy'
+                          else miescatlib.scatcoeffs)
+            return scatcoeffs(m_arr[0], x_arr[0], lmax, self.eps1, self.eps2)
         else:
-            return scatcoeffs_multi(m_arr, x_arr, self.eps1, self.eps2)
+            # In a fit, usually only the outer layers change, so the
+            # recursion through the inner layers is cached.
+            return scatcoeffs_multi(m_arr, x_arr, self.eps1, self.eps2,
+                                    cache=inner_layer_cache)
 
     def _scat_coeffs_internal(self, s, medium_wavevec, medium_index):
         '''
-        Calculate expansion coefficients for Lorenz-Mie electric field
-        inside a sphere.
+        Calculate expansion coefficients for the Lorenz-Mie electric field
+        inside each layer of a sphere and outside it.
+
+        Returns
+        -------
+        ndarray (nlayers + 1, 2, 2, n), complex
+            Coefficients from `mienumpy.layered_coeffs`. For a
+            homogeneous sphere, the first region holds the internal
+            coefficients c_n and d_n, and the second 1 - b_n, -i b_n and
+            1 - a_n, -i a_n.
         '''
+        if (ensure_array(s.r) == 0).any():
+            raise InvalidScatterer(s, "Radius is zero")
         x_arr = medium_wavevec * ensure_array(s.r)
         m_arr = ensure_array(s.n) / medium_index
 
@@ -221,9 +389,29 @@ class Mie(ScatteringTheory):
             msg = "radius too large, field calculation would take forever"
             raise InvalidScatterer(s, msg)
 
-        if len(x_arr) == 1 and len(m_arr) == 1:
-            # Could just use scatcoeffs_multi here, but jerome is in favor of
-            # keeping the simpler single layer code here
-            lmax = miescatlib.nstop(x_arr[0])
-            return  miescatlib.internal_coeffs(m_arr[0], x_arr[0], lmax)
+        key = make_key('mie-internal', s.n, s.r, medium_wavevec, medium_index)
+        return scattering_coefficient_cache.get(
+            key, lambda: mienumpy.layered_coeffs(
+                m_arr, x_arr, miescatlib.nstop(x_arr.max())))
+
 
+def _cross_sections_for_batch(theory, batch):
+    """
+    The (4, N) cross sections, with the coefficients of the Mie `theory`,
+    for 1D arrays of relative indices, size parameters and medium
+    wavevectors. The scattering coefficients of each sphere are
+    zero-padded to a common order so that the cross sections of the whole
+    batch are evaluated together.
+    """
+    index_ratio, size_parameter, medium_wavevec = batch
+    lmax = max(miescatlib.nstop(x) for x in size_parameter)
+    albl = np.zeros((2, size_parameter.size, lmax), dtype='complex')
+    for i, (m, x) in enumerate(zip(index_ratio, size_parameter)):
+        coeffs = theory._homogeneous_scat_coeffs(m, x)
+        albl[:, i, :coeffs.shape[1]] = coeffs
+    cscat, cext, cback = miescatlib.cross_sections(albl[0], albl[1]) * (
+        2. * np.pi / medium_wavevec**2)
+    cabs = cext - cscat  # conservation of energy
+    asym = 4. * np.pi / (medium_wavevec**2 * cscat) * \
+        miescatlib.asymmetry_parameter(albl[0], albl[1])
+    return np.array([cscat, cabs, cext, asym])
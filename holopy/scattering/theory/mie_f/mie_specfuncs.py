@@ -48,7 +48,8 @@ try:
     from . import mieangfuncs
     from .mieangfuncs import dn_1_down, lentz_dn1
 except ImportError:
-    pass
+    # slower NumPy ports, when the Fortran extension is not built
+    from holopy.scattering.theory.mienumpy import dn_1_down, lentz_dn1
 
 def riccati_psi_xi(x, nstop):
     '''
@@ -27,11 +27,12 @@ Library of code to do Mie scattering calculations.
 import numpy as np
 from numpy import sin, cos, array
 
+from . import mie_specfuncs
 try:
-    from . import mie_specfuncs
     from .mieangfuncs import dn_1_down, lentz_dn1
 except ImportError:
-    pass
+    # slower NumPy ports, when the Fortran extension is not built
+    from holopy.scattering.theory.mienumpy import dn_1_down, lentz_dn1
 
 
 
@@ -138,24 +139,25 @@ def asymmetry_parameter(al, bl):
     Parameters
     ----------
     an, bn : ndarray
-        coefficient arrays from Mie solution
+        coefficient arrays from Mie solution, with the order along the
+        last axis. Coefficients padded with zeros give the same result.
 
     Returns
     -------
-    float
+    float, or ndarray of the leading shape of `an`
 
     Notes
     -----
     See discussion on Bohren & Huffman p. 120.
     The output of this function omits the prefactor of 4/(x^2 Q_sca).
     '''
-    lmax = al.shape[0]
+    lmax = al.shape[-1]
     l = np.arange(lmax) + 1
     selfterm = (l[:-1] * (l[:-1] + 2.) / (l[:-1] + 1.) *
-                np.real(al[:-1] * np.conj(al[1:]) +
-                        bl[:-1] * np.conj(bl[1:]))).sum()
+                np.real(al[..., :-1] * np.conj(al[..., 1:]) +
+                        bl[..., :-1] * np.conj(bl[..., 1:]))).sum(axis=-1)
     crossterm = ((2. * l + 1.)/(l * (l + 1)) *
-                 np.real(al * np.conj(bl))).sum()
+                 np.real(al * np.conj(bl))).sum(axis=-1)
     return selfterm + crossterm
 
 def cross_sections(al, bl):
@@ -166,11 +168,12 @@ def cross_sections(al, bl):
     Parameters
     ----------
     an, bn : ndarray
-        coefficient arrays from Mie solution
+        coefficient arrays from Mie solution, with the order along the
+        last axis. Coefficients padded with zeros give the same result.
    
     Returns
     -------
-    ndarray(3)
+    ndarray(3) or ndarray(3, ...)
         Scattering, extinction, and radar backscattering cross sections
 
     Notes
@@ -178,15 +181,15 @@ def cross_sections(al, bl):
     See Bohren & Huffman eqns. 4.61 and 4.62.
     The output omits a scaling prefactor of 2 * pi / k^2.
     '''
-    lmax = al.shape[0]
+    lmax = al.shape[-1]
 
     l = np.arange(lmax) + 1
     prefactor = (2. * l + 1.)
-    cscat = (prefactor * (np.abs(al)**2 + np.abs(bl)**2)).sum()
-    cext = (prefactor * np.real(al + bl)).sum()
+    cscat = (prefactor * (np.abs(al)**2 + np.abs(bl)**2)).sum(axis=-1)
+    cext = (prefactor * np.real(al + bl)).sum(axis=-1)
 
     # see p. 122
     alts = 2. * (np.arange(lmax) % 2) - 1
-    cback = np.abs((prefactor * alts * (al - bl)).sum())**2
+    cback = np.abs((prefactor * alts * (al - bl)).sum(axis=-1))**2
 
     return array([cscat, cext, cback])
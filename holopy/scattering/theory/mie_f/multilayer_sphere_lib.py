@@ -34,6 +34,7 @@ import numpy as np
 from numpy import exp, sin, cos, real, imag
 
 from ...errors import InvalidScatterer
+from ..coefficientcache import CoefficientCache
 
 try:
     from . import miescatlib
@@ -41,7 +42,11 @@ try:
 except ImportError:
     pass
 
-def scatcoeffs_multi(marray, xarray, eps1 = 1e-3, eps2 = 1e-16):
+# During a fit of a layered sphere, usually only the outer layers change.
+inner_layer_cache = CoefficientCache(maxsize=256)
+
+def scatcoeffs_multi(marray, xarray, eps1 = 1e-3, eps2 = 1e-16,
+                     cache = None):
     '''
     Calculate scattered field expansion coefficients (in the Mie formalism)
     for a particle with an arbitrary number of spherically symmetric layers.
@@ -56,6 +61,9 @@ def scatcoeffs_multi(marray, xarray, eps1 = 1e-3, eps2 = 1e-16):
         underflow criterion for Lentz continued fraction for Dn1
     eps2 : float, optional
         convergence criterion for Lentz continued fraction for Dn1
+    cache : :class:`.CoefficientCache`, optional
+        cache for the recursion through the inner layers; see
+        `layer_ratios`
 
     Returns
     -------
@@ -77,36 +85,7 @@ def scatcoeffs_multi(marray, xarray, eps1 = 1e-3, eps2 = 1e-16):
     # calculate nstop based on outermost radius
     nstop = miescatlib.nstop(xarray.max())
 
-    # initialize H_n^a and H_n^b in the core, see eqns. 12a and 13a
-    intl = log_der_13(marray[0]*xarray[0], nstop, eps1, eps2)[0]
-    hans = intl
-    hbns = intl
-	
-    for lay in np.arange(1, nlayers): # lay is l-1 (index on layers used by Yang)
-        z1 = marray[lay]*xarray[lay-1] # m_l x_{l-1}
-        z2 = marray[lay]*xarray[lay]  # m_l x_l
-
-        # calculate logarithmic derivatives D_n^1 and D_n^3
-        derz1s = log_der_13(z1, nstop, eps1, eps2)
-        derz2s = log_der_13(z2, nstop, eps1, eps2)
-
-        # calculate G1, G2, Gtilde1, Gtilde2 according to 
-        # eqns 26-29
-        # using H^a_n and H^b_n from previous layer
-        G1 = marray[lay]*hans - marray[lay-1]*derz1s[0]
-        G2 = marray[lay]*hans - marray[lay-1]*derz1s[1]
-        Gt1 = marray[lay-1]*hbns - marray[lay]*derz1s[0]
-        Gt2 = marray[lay-1]*hbns - marray[lay]*derz1s[1]
-
-        # calculate ratio Q_n^l for this layer
-        Qnl = Qratio(z1, z2, nstop, dns1 = derz1s, dns2 = derz2s, eps1 = eps1,
-                     eps2 = eps2)
-
-        # now calculate H^a_n and H^b_n in current layer
-        # see eqns 24 and 25
-        hans = (G2*derz2s[0] - Qnl*G1*derz2s[1]) / (G2 - Qnl*G1)
-        hbns = (Gt2*derz2s[0] - Qnl*Gt1*derz2s[1]) / (Gt2 - Qnl*Gt1)
-        # repeat for next layer
+    hans, hbns = layer_ratios(marray, xarray, nstop, eps1, eps2, cache)
 
     # Relate H^a and H^b in the outer layer to the Mie scat coeffs
     # see Yang eqns 14 and 15
@@ -123,3 +102,75 @@ def scatcoeffs_multi(marray, xarray, eps1 = 1e-3, eps2 = 1e-16):
     bn = ((hbns*marray[nlayers-1] + n/xarray[nlayers-1])*psi - psishift) / ( 
         (hbns*marray[nlayers-1] + n/xarray[nlayers-1])*xi - xishift)
     return np.array([an[1:nstop+1], bn[1:nstop+1]]) # output begins at n=1
+
+def layer_ratios(marray, xarray, nstop, eps1 = 1e-3, eps2 = 1e-16,
+                 cache = None):
+    '''
+    Calculate the ratios H^a_n and H^b_n ([Yang2003]_ eqns. 24 and 25) in
+    the outermost layer of marray and xarray, n = 0 to nstop, by
+    recursion outward from the core.
+
+    Parameters
+    ----------
+    marray, xarray, nstop, eps1, eps2
+        as for `scatcoeffs_multi`
+    cache : :class:`.CoefficientCache`, optional
+        If given, the ratios in each inner layer are looked up in (or
+        added to) the cache, keyed on the indices and size parameters of
+        that layer and all the layers inside it. Changing the outer
+        layers then only repeats the recursion through those layers.
+
+    Returns
+    -------
+    hans, hbns : ndarray (complex)
+        H^a_n and H^b_n
+    '''
+    ratios = None
+    # each layer's key extends the key of the layer inside it
+    key = ('multilayer', nstop, eps1, eps2)
+    for lay in range(len(marray)): # lay is l-1 (index on layers used by Yang)
+        def this_layer(inner=ratios, lay=lay):
+            if lay == 0:
+                # initialize H_n^a and H_n^b in the core, eqns. 12a and 13a
+                intl = log_der_13(marray[0]*xarray[0], nstop, eps1, eps2)[0]
+                return intl, intl
+            return _next_layer_ratios(inner, marray[lay-1:lay+1],
+                                      xarray[lay-1:lay+1], nstop, eps1, eps2)
+        if cache is None or lay == len(marray) - 1:
+            ratios = this_layer()
+        else:
+            key = (key, complex(marray[lay]), float(xarray[lay]))
+            ratios = cache.get(key, this_layer)
+    return ratios
+
+def _next_layer_ratios(ratios, marray, xarray, nstop, eps1, eps2):
+    '''
+    H^a_n and H^b_n in a layer from those in the layer inside it; marray
+    and xarray are for the inner and this layer.
+    '''
+    hans, hbns = ratios
+    m_in, m_out = marray
+    z1 = m_out*xarray[0] # m_l x_{l-1}
+    z2 = m_out*xarray[1]  # m_l x_l
+
+    # calculate logarithmic derivatives D_n^1 and D_n^3
+    derz1s = log_der_13(z1, nstop, eps1, eps2)
+    derz2s = log_der_13(z2, nstop, eps1, eps2)
+
+    # calculate G1, G2, Gtilde1, Gtilde2 according to
+    # eqns 26-29
+    # using H^a_n and H^b_n from previous layer
+    G1 = m_out*hans - m_in*derz1s[0]
+    G2 = m_out*hans - m_in*derz1s[1]
+    Gt1 = m_in*hbns - m_out*derz1s[0]
+    Gt2 = m_in*hbns - m_out*derz1s[1]
+
+    # calculate ratio Q_n^l for this layer
+    Qnl = Qratio(z1, z2, nstop, dns1 = derz1s, dns2 = derz2s, eps1 = eps1,
+                 eps2 = eps2)
+
+    # now calculate H^a_n and H^b_n in current layer
+    # see eqns 24 and 25
+    hans = (G2*derz2s[0] - Qnl*G1*derz2s[1]) / (G2 - Qnl*G1)
+    hbns = (Gt2*derz2s[0] - Qnl*Gt1*derz2s[1]) / (Gt2 - Qnl*Gt1)
+    return hans, hbns
@@ -21,12 +21,24 @@
 .. moduleauthor:: Ron Alexander <ralexander@g.harvard.edu>
 """
 
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 from holopy.scattering.scatterer import Sphere
 from holopy.scattering.theory.scatteringtheory import ScatteringTheory
 from holopy.scattering.theory.mielensfunctions import (
     MieLensCalculator, AberratedMieLensCalculator)
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key)
+from holopy.scattering.theory.translationreuse import calc_planar_field
+
+# Calculators hold their quadrature, scattering matrices and interpolants,
+# which only depend on the particle's z, index and size and on the lens,
+# so moving the particle in x and y reuses them.
+calculator_cache = CoefficientCache(maxsize=16)
 
 
 class MieLens(ScatteringTheory):
@@ -36,6 +48,8 @@ class MieLens(ScatteringTheory):
     Calculates holograms of spheres using an analytical solution of the
     Mie scattered field imaged by a perfect lens (see [Leahy2020]_). Can
     use superposition to calculate scattering from multiple spheres.
+    Detectors with several planes in z, such as focal stacks, are
+    calculated one plane at a time.
 
     See Also
     --------
@@ -45,7 +59,8 @@ class MieLens(ScatteringTheory):
     desired_coordinate_system = 'cylindrical'
     parameter_names = ('lens_angle',)
 
-    def __init__(self, lens_angle=1.0, calculator_accuracy_kwargs={}):
+    def __init__(self, lens_angle=1.0, calculator_accuracy_kwargs={},
+                 translation_reuse=False, parallel=None):
         """
         Parameters
         ----------
@@ -57,13 +72,28 @@ class MieLens(ScatteringTheory):
             increase or decrease the accuracy via
             `calculator_accuracy_kwargs.` Valid keys are {`quad_npts`,
             `interpolate_integrals`, `interpolator_window_size`,
-            `interpolator_degree`}, as explained in
-            mielensfunctions.MieLensCalculator.  The default calculation
-            accuracy is roughly 1e-12 relative accuracy.
+            `interpolator_degree`, `interpolator_tolerance`}, as
+            explained in mielensfunctions.MieLensCalculator.  The
+            default calculation accuracy is roughly 1e-12 relative
+            accuracy.
+        translation_reuse : bool
+            If True, the field is interpolated from radial profiles
+            tabulated once per (n, r, z), so that moving the sphere in x
+            and y only costs an interpolation. The interpolation is
+            accurate to better than 1e-8 relative.
+        parallel : {None, int, 'all'}
+            How to compute the planes of a detector with several z:
+            serially, in this many threads, or in one thread per CPU.
+            Threads are used because the planes share their
+            calculators; they are started for each calculation, so the
+            theory holds no pool and can be pickled.
         """
+        _number_of_threads(parallel)  # raises TypeError if invalid
         super(MieLens, self).__init__()
         self.lens_angle = lens_angle
         self.calculator_accuracy_kwargs = calculator_accuracy_kwargs
+        self.translation_reuse = translation_reuse
+        self.parallel = parallel
 
     def can_handle(self, scatterer):
         return isinstance(scatterer, Sphere)
@@ -89,23 +119,50 @@ class MieLens(ScatteringTheory):
         rho, phi, z = positions
         pol_angle = np.arctan2(
             illum_polarization.values[1], illum_polarization.values[0])
-        phi += pol_angle
-        phi %= (2 * np.pi)
-
-        # FIXME mielens assumes that the detector points are at a fixed z!
-        # right now I'm picking one z:
-        particle_kz = np.mean(z)
-        if np.ptp(z) > 1e-13 * (1 + np.abs(particle_kz)):
-            msg = ("mielens currently assumes the detector is a fixed " +
-                   "z from the particle")
-            raise ValueError(msg)
-
-        field_calculator = self._create_calculator(
-            particle_kz=particle_kz,
-            index_ratio=index_ratio,
-            size_parameter=size_parameter,
-            )
 
+        # The calculation assumes all the points are at one z from the
+        # particle, so we calculate each plane of the detector
+        # separately. Everything but the phase of the incident light is
+        # the same for all the planes, so their calculators share it.
+        planes = _group_by_plane(z)
+        calculators = [self._get_calculator(
+            planes[0][0], index_ratio, size_parameter)]
+        for particle_kz, _ in planes[1:]:
+            calculators.append(self._get_calculator(
+                particle_kz, index_ratio, size_parameter,
+                template=calculators[0]))
+
+        def calculate_plane(plane):
+            (_, points), field_calculator = plane
+            return self._calculate_plane_field(
+                field_calculator, rho[points], phi[points], pol_angle,
+                index_ratio, size_parameter)
+
+        if len(planes) == 1:
+            return calculate_plane((planes[0], calculators[0]))
+        fields = np.empty(
+            (3, rho.size), dtype=np.result_type(rho, np.complex64))
+        nthreads = min(_number_of_threads(self.parallel), len(planes))
+        with ThreadPoolExecutor(nthreads) as pool:
+            for (_, points), plane_field in zip(planes, pool.map(
+                    calculate_plane, zip(planes, calculators))):
+                fields[:, points] = plane_field
+        return fields
+
+    def _calculate_plane_field(self, field_calculator, rho, phi, pol_angle,
+                               index_ratio, size_parameter):
+        if self.translation_reuse:
+            def calculate_xpol_field(krho, phi):
+                return self._calculate_field(field_calculator, krho, phi, 0)
+            key = make_key('mielens', index_ratio, size_parameter,
+                           field_calculator.particle_kz, self._cache_repr())
+            return calc_planar_field(
+                calculate_xpol_field, key, rho, phi,
+                [np.cos(pol_angle), np.sin(pol_angle)])
+        return self._calculate_field(field_calculator, rho, phi, pol_angle)
+
+    def _calculate_field(self, field_calculator, rho, phi, pol_angle):
+        phi = (phi - pol_angle) % (2 * np.pi)
         fields_pll, fields_prp = field_calculator.calculate_scattered_field(
             rho, phi)  # parallel and perp to the polarization
 
@@ -113,7 +170,7 @@ class MieLens(ScatteringTheory):
         # to (x, y)
         parallel = np.array([np.cos(pol_angle), np.sin(pol_angle)])
         perpendicular = np.array([-np.sin(pol_angle), np.cos(pol_angle)])
-        field_xyz = np.zeros([3, fields_pll.size], dtype='complex')
+        field_xyz = np.zeros([3, fields_pll.size], dtype=fields_pll.dtype)
         for i in range(2):
             field_xyz[i, :] += fields_pll * parallel[i]
             field_xyz[i, :] += fields_prp * perpendicular[i]
@@ -129,9 +186,30 @@ class MieLens(ScatteringTheory):
         # this by multiplying by e^{ikz}.
         # Combined, we multiply by e^{ikz} / incident_field[x-component]:
         incident_field_x, _ = field_calculator.calculate_incident_field()
-        field_xyz *= np.exp(1j * particle_kz) / incident_field_x
+        field_xyz *= (np.exp(1j * field_calculator.particle_kz) /
+                      incident_field_x)
         return field_xyz
 
+    def _get_calculator(self, particle_kz, index_ratio, size_parameter,
+                        template=None):
+        # A new calculator is a copy of `template`, if given, moved to
+        # particle_kz
+        key = make_key('mielens', particle_kz, index_ratio, size_parameter,
+                       self._cache_repr())
+        if template is not None:
+            return calculator_cache.get(
+                key, lambda: template.at_particle_kz(particle_kz))
+        return calculator_cache.get(key, lambda: self._create_calculator(
+            particle_kz=particle_kz,
+            index_ratio=index_ratio,
+            size_parameter=size_parameter))
+
+    def _cache_repr(self):
+        # the fields do not depend on how the planes are parallelized
+        serial = copy.copy(self)
+        serial.parallel = None
+        return repr(serial)
+
     def _create_calculator(
             self, particle_kz=None, index_ratio=None, size_parameter=None):
         field_calculator = MieLensCalculator(
@@ -147,7 +225,8 @@ class AberratedMieLens(MieLens):
     parameter_names = ('lens_angle', 'spherical_aberration')
 
     def __init__(self, spherical_aberration=0.0, lens_angle=1.0,
-                 calculator_accuracy_kwargs={}):
+                 calculator_accuracy_kwargs={}, translation_reuse=False,
+                 parallel=None):
         """
         Parameters
         ----------
@@ -167,13 +246,21 @@ class AberratedMieLens(MieLens):
             increase or decrease the accuracy via
             `calculator_accuracy_kwargs.` Valid keys are {`quad_npts`,
             `interpolate_integrals`, `interpolator_window_size`,
-            `interpolator_degree`}, as explained in
-            mielensfunctions.MieLensCalculator.  The default calculation
-            accuracy is roughly 1e-12 relative accuracy.
+            `interpolator_degree`, `interpolator_tolerance`}, as
+            explained in mielensfunctions.MieLensCalculator.  The
+            default calculation accuracy is roughly 1e-12 relative
+            accuracy.
+        translation_reuse : bool
+            If True, interpolate the field from tabulated radial profiles;
+            see MieLens.
+        parallel : {None, int, 'all'}
+            How to compute the planes of a detector with several z; see
+            MieLens.
         """
         super(AberratedMieLens, self).__init__(
             lens_angle=lens_angle,
-            calculator_accuracy_kwargs=calculator_accuracy_kwargs)
+            calculator_accuracy_kwargs=calculator_accuracy_kwargs,
+            translation_reuse=translation_reuse, parallel=parallel)
         self.spherical_aberration = spherical_aberration
 
     def _create_calculator(
@@ -186,3 +273,31 @@ class AberratedMieLens(MieLens):
             spherical_aberration=self.spherical_aberration,
             **self.calculator_accuracy_kwargs)
         return field_calculator
+
+
+def _number_of_threads(parallel):
+    if parallel is None:
+        return 1
+    if parallel == 'all':
+        return os.cpu_count()
+    if isinstance(parallel, (int, np.integer)) and parallel > 0:
+        return parallel
+    raise TypeError("Could not interpret 'parallel' argument. Use a "
+                    "positive integer, 'all' or None.")
+
+
+def _group_by_plane(z):
+    """
+    The (kz, points) of each plane of detector points at the same z,
+    where points indexes the plane's points in z. Points within 1e-13
+    relative are in the same plane.
+    """
+    # the common case of a single plane keeps the points in order
+    if np.ptp(z) <= 1e-13 * (1 + np.abs(np.mean(z))):
+        return [(np.mean(z), slice(None))]
+    order = np.argsort(z, kind='stable')
+    sorted_z = z[order]
+    is_new_plane = (np.diff(sorted_z) >
+                    1e-13 * (1 + np.abs(sorted_z[1:])))
+    planes = np.split(order, np.nonzero(is_new_plane)[0] + 1)
+    return [(np.mean(z[points]), points) for points in planes]
@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 from numpy.polynomial.chebyshev import Chebyshev
 from numpy.polynomial.legendre import legval
@@ -5,9 +7,18 @@ from scipy.special import j0, j1, spherical_jn, spherical_yn
 from scipy import interpolate
 
 from holopy.scattering.errors import MissingParameter
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, scattering_coefficient_cache, make_key)
+from holopy.scattering.theory import mienumpy
 
 NPTS = 100
 LEGGAUSS_PTS_WTS_NPTS = np.polynomial.legendre.leggauss(NPTS)
+# Up to this many windows, it is faster to evaluate a Chebyshev approximant
+# window by window than to gather per-point coefficients in one pass:
+MAX_MASKED_WINDOWS = 64
+# Interpolants of the integrals kept by each calculator; a calculator
+# usually sees a few window ranges, one per detector region it covers:
+MAX_INTERPOLATORS = 16
 
 
 # TODO:
@@ -20,7 +31,8 @@ class MieLensCalculator(object):
 
     def __init__(self, particle_kz=None, index_ratio=None, size_parameter=None,
                  lens_angle=None, quad_npts=100, interpolate_integrals='check',
-                 interpolator_window_size=30.0, interpolator_degree=32):
+                 interpolator_window_size=30.0, interpolator_degree=32,
+                 interpolator_tolerance=None):
         """Calculates the field from a Mie scatterer imaged in a high-NA lens.
 
         The incindent electric field is E e^{ikz}, with the particle
@@ -67,6 +79,13 @@ class MieLensCalculator(object):
             although accuracy depends on the `interpolator_window_size`
             parameter as well. The default is 32, which gives 5e-13
             relative accuracy.
+        interpolator_tolerance : float, optional
+            If given, the windows of the approximants are chosen
+            adaptively, by bisection until each approximant is accurate
+            to about `interpolator_tolerance` relative to the largest
+            value of the integrals. The approximants still cover
+            multiples of `interpolator_window_size`, so that they can be
+            reused. Default is None, for fixed-size windows.
 
             It is best to leave the interpolator parameter as-is; they
             are only exposed for testing and advanced usage.
@@ -81,9 +100,22 @@ class MieLensCalculator(object):
         self.interpolate_integrals = interpolate_integrals
         self.interpolator_window_size = interpolator_window_size
         self.interpolator_degree = interpolator_degree
-
-        quad_pts, quad_wts = gauss_legendre_pts_wts(
-            np.cos(self.lens_angle), 1.0, npts=self.quad_npts)
+        self.interpolator_tolerance = interpolator_tolerance
+
+        self._setup_quadrature(npanels=1)
+        # calculators with finer quadratures for large krho, by number
+        # of quadrature panels
+        self._large_krho_calculators = {}
+
+    def _setup_quadrature(self, npanels):
+        # A composite rule, with quad_npts Gauss-Legendre points in each
+        # of npanels equal panels:
+        self._npanels = npanels
+        breakpoints = np.cos(np.linspace(self.lens_angle, 0, npanels + 1))
+        quad_pts, quad_wts = [
+            np.concatenate(v) for v in zip(*[
+                gauss_legendre_pts_wts(a, b, npts=self.quad_npts)
+                for a, b in zip(breakpoints[:-1], breakpoints[1:])])]
 
         # Precompute some quadrature points, mie functions that are
         # independent of rho and phi
@@ -93,6 +125,9 @@ class MieLensCalculator(object):
         self._quad_wts = quad_wts.reshape(-1, 1)
 
         self._precompute_scattering_matrices()
+        # interpolants of the integrals, kept for reuse by later calls
+        # covering the same windows
+        self._interpolators = CoefficientCache(maxsize=MAX_INTERPOLATORS)
 
     def calculate_scattered_field(self, krho, phi):
         """Calculates the field from a Mie scatterer imaged through a
@@ -123,20 +158,27 @@ class MieLensCalculator(object):
 
         Notes
         -----
-        This will have problems for large rho, z, because of the quadrature
-        points. Empirically this problem happens for rho >~ 4 * quad_npts.
-        Could be adaptive if needed....
+        The quadrature over the lens pupil resolves the oscillations of
+        the integrands for krho < 3.2 * quad_npts / lens_angle. Points
+        beyond that are evaluated with composite quadratures over equal
+        panels in theta, doubling the number of panels until they are
+        resolved, so that only the points far from the optical axis pay
+        for the extra accuracy. Large particle kz, which makes the
+        integrands oscillate as well, is not accounted for.
         """
         # 0. Check inputs:
         shape = krho.shape
         if (shape != phi.shape):
             raise ValueError('krho, phi must all be the same shape')
 
-        output_x = np.zeros(shape, dtype='complex')
-        output_y = np.zeros(shape, dtype='complex')
+        # The outputs are in the (complex) precision of krho:
+        dtype = np.result_type(krho, np.complex64)
+        output_x = np.zeros(shape, dtype=dtype)
+        output_y = np.zeros(shape, dtype=dtype)
 
-        # 1. Check for regions where rho is bad and leave as 0:
-        rho_small = krho < 3.9 * self.quad_npts
+        # 1. Split into regions that our quadrature does and does not
+        # resolve:
+        rho_small = krho < self._max_resolved_krho
         rho_large = ~rho_small
 
         # 2. Evaluate scattered fields only at valid rho's:
@@ -153,6 +195,18 @@ class MieLensCalculator(object):
 
         return output_x, output_y
 
+    def at_particle_kz(self, particle_kz):
+        """A calculator for the same particle and lens with the particle
+        at `particle_kz`. It shares the quadrature and scattering
+        matrices, which do not depend on the particle's z, with this
+        one."""
+        calculator = copy.copy(self)
+        calculator.particle_kz = particle_kz
+        calculator._interpolators = CoefficientCache(
+            maxsize=MAX_INTERPOLATORS)
+        calculator._large_krho_calculators = {}
+        return calculator
+
     def calculate_total_field(self, krho, phi):
         """The total (incident + scattered) field at the detector
         """
@@ -184,9 +238,34 @@ class MieLensCalculator(object):
         return field_xcomp, field_ycomp
 
     def _calculate_large_krho_scattered_field(self, krho, phi):
-        # For now, just return 0s:
-        zero = np.zeros(krho.shape, dtype='complex')
-        return zero, zero
+        # Each point is evaluated with the coarsest quadrature, with 2**k
+        # times as many panels as ours, that resolves it:
+        refinement = np.floor(
+            np.log2(krho / self._max_resolved_krho)).astype('int') + 1
+        dtype = np.result_type(krho, np.complex64)
+        field_xcomp = np.zeros(krho.shape, dtype=dtype)
+        field_ycomp = np.zeros(krho.shape, dtype=dtype)
+        for k in np.unique(refinement):
+            these = refinement == k
+            calculator = self._get_large_krho_calculator(
+                self._npanels * 2**k)
+            ex, ey = calculator._calculate_small_krho_scattered_field(
+                krho[these], phi[these])
+            field_xcomp[these] = ex
+            field_ycomp[these] = ey
+        return field_xcomp, field_ycomp
+
+    def _get_large_krho_calculator(self, npanels):
+        if npanels not in self._large_krho_calculators:
+            calculator = copy.copy(self)
+            calculator._setup_quadrature(npanels)
+            self._large_krho_calculators[npanels] = calculator
+        return self._large_krho_calculators[npanels]
+
+    @property
+    def _max_resolved_krho(self):
+        # Empirically, the quadrature is accurate to 1e-10 below this:
+        return 3.2 * self.quad_npts * self._npanels / self.lens_angle
 
     def _precompute_scattering_matrices(self):
         kwargs = {'index_ratio': self.index_ratio,
@@ -257,13 +336,21 @@ class MieLensCalculator(object):
         window_size = self.interpolator_window_size
         window_start = np.floor(krho.min() / window_size)
         window_end = np.ceil(krho.max() / window_size + 1e-4) + 1
-        window_breakpoints = window_size * np.arange(window_start, window_end)
-
-        interpolator = PiecewiseChebyshevApproximant(
-            lambda x: self._direct_eval_mielens_i_n(x, n=n),
-            degree=self.interpolator_degree,
-            window_breakpoints=window_breakpoints)
-        return interpolator(krho)
+        key = (n, window_start, window_end)
+
+        def make_interpolator():
+            window_breakpoints = window_size * np.arange(
+                window_start, window_end)
+            function = lambda x: self._direct_eval_mielens_i_n(x, n=n)
+            if self.interpolator_tolerance is None:
+                return PiecewiseChebyshevApproximant(
+                    function, degree=self.interpolator_degree,
+                    window_breakpoints=window_breakpoints)
+            return PiecewiseChebyshevApproximant.adaptive(
+                function, domain=window_breakpoints[[0, -1]],
+                degree=self.interpolator_degree,
+                tolerance=self.interpolator_tolerance)
+        return self._interpolators.get(key, make_interpolator)(krho)
 
     def _calculate_phase(self):
         return self.particle_kz * (1 - self._quad_pts)
@@ -359,38 +446,14 @@ class MieScatteringMatrix(object):
         """Evaluate S_parallel, perpendicular(theta) directly"""
         # Right now, the pi_l, tau_l functions calculate all values of
         # l at once. So we compute all at once then sum
-
-        # The al, bl calculation can produce nan's if the maximum l
-        # value is made aggressively large, due to weirdness in the
-        # complex arithmetic standard. (The spherical Hankel functions
-        # can be (0 + 1j * inf) when l is large. But, due to the
-        # implementation of complex arithmetic in Python and numpy,
-        # 0 + 1j*inf gets cast as nan + 1j*inf. We then divide a
-        # non-infinite number by the spherical Hankel's nan + 1j*inf,
-        # and that gives nan's when it should give 0.) To avoid this, we
-        # truncate the series at a "reasonable" value of l while
-        # checking that no nans actually appear in the calculation. We
-        # do this by stopping the series if we get a nan, but checking
-        # that the previous term in the series is close to 0:
-        als_bls = list()
-        for l in range(1, self.max_l + 1):
-            this_al_bl = calculate_al_bl(
-                self.index_ratio, self.size_parameter, l)
-            if np.isnan(this_al_bl).any():
-                previous_term_is_nonzero = np.any(np.abs(als_bls[-1]) > 1e-30)
-                if previous_term_is_nonzero:
-                    raise RuntimeError('nan for this value of theta, ka, max_l')
-                break
-            else:
-                truncated_max_l = l
-                als_bls.append(this_al_bl)
-
-        # Now we proceed with the calculation, but using the truncated
-        # max l instead of what the user requested:
-        als, bls = [np.array(i) for i in zip(*als_bls)]
-        coeffs = np.array([
-            (2 * l + 1) / (l * (l + 1))
-            for l in range(1, truncated_max_l + 1)]).reshape(1, -1)
+        key = make_key(
+            'mielens', self.index_ratio, self.size_parameter, self.max_l)
+        als, bls = scattering_coefficient_cache.get(
+            key, self._calculate_als_bls)
+        truncated_max_l = als.size
+
+        l = np.arange(1, truncated_max_l + 1)
+        coeffs = ((2 * l + 1) / (l * (l + 1))).reshape(1, -1)
         pils, tauls = calculate_pil_taul(theta, truncated_max_l)
 
         if self.parallel_or_perpendicular == 'perpendicular':
@@ -404,6 +467,29 @@ class MieScatteringMatrix(object):
     def __call__(self, theta):
         return self._eval(theta)
 
+    def _calculate_als_bls(self):
+        # The al, bl calculation can produce nan's if the maximum l
+        # value is made aggressively large: the spherical Bessel
+        # function y_l(x) overflows to inf when l >> x, and the ratios
+        # that define al, bl become inf / inf. To avoid this, we
+        # truncate the series at a "reasonable" value of l while
+        # checking that no nans actually appear in the calculation. We
+        # do this by stopping the series at the first nan, but checking
+        # that the previous term in the series is close to 0:
+        als, bls = calculate_als_bls(
+            self.index_ratio, self.size_parameter, self.max_l)
+        is_nan = ~(np.isfinite(als) & np.isfinite(bls))
+        if is_nan.any():
+            first_nan = np.argmax(is_nan)
+            previous_term_is_nonzero = first_nan == 0 or np.any(
+                np.abs([als[first_nan - 1], bls[first_nan - 1]]) > 1e-30)
+            if previous_term_is_nonzero:
+                raise RuntimeError('nan for this value of theta, ka, max_l')
+            # We proceed with the calculation using the truncated max l
+            # instead of what the user requested:
+            als, bls = als[:first_nan], bls[:first_nan]
+        return als, bls
+
 
 def j2(x):
     """A fast J_2(x) defined in terms of other special functions """
@@ -437,6 +523,32 @@ def calculate_al_bl(index_ratio, size_parameter, l):
     return AlBlFunctions.calculate_al_bl(index_ratio, size_parameter, l)
 
 
+def calculate_als_bls(index_ratio, size_parameter, max_l):
+    """`a_l` and `b_l` for l = 1 to `max_l`, as in `calculate_al_bl`.
+
+    All the orders are calculated at once from recurrences for the
+    spherical Bessel functions, which is much faster than evaluating
+    each order separately when `max_l` is large. Orders at which the
+    coefficients overflow are returned as nan.
+    """
+    rho = np.array([size_parameter, index_ratio * size_parameter])
+    with np.errstate(all='ignore'):
+        j, dj, y, dy = mienumpy._spherical_bessel(max_l, rho)
+        psi = rho[:, np.newaxis] * j
+        dpsi = j + rho[:, np.newaxis] * dj
+        psi_x, psi_nx = psi
+        dpsi_x, dpsi_nx = dpsi
+        h2_x = j[0] - 1j * y[0]
+        xi_x = size_parameter * h2_x
+        dxi_x = h2_x + size_parameter * (dj[0] - 1j * dy[0])
+
+        a = (dpsi_nx * psi_x - index_ratio * psi_nx * dpsi_x) / (
+             dpsi_nx * xi_x - index_ratio * psi_nx * dxi_x)
+        b = (index_ratio * dpsi_nx * psi_x - psi_nx * dpsi_x) / (
+             index_ratio * dpsi_nx * xi_x - psi_nx * dxi_x)
+    return a, b
+
+
 class AlBlFunctions(object):
     """
     Group of functions for calculating the Mie scattering coefficients,
@@ -621,7 +733,7 @@ def calculate_pil_taul(theta, max_order):
 class PiecewiseChebyshevApproximant(object):
     def __init__(self, function, degree, window_breakpoints, *args):
         """
-        Approximates on [window_breakpoints[0], window_breakpoints[1])
+        Approximates on [window_breakpoints[0], window_breakpoints[-1])
         """
         self.function = function
         self.degree = degree
@@ -632,6 +744,83 @@ class PiecewiseChebyshevApproximant(object):
         self._windows = self._setup_windows()
         self._approximants = self._setup_approximants()
         self._dtype = self._approximants[0].coef.dtype
+        self._setup_coefficients()
+
+    @classmethod
+    def adaptive(cls, function, domain, degree, tolerance, max_windows=4096):
+        """
+        Approximates on [domain[0], domain[1]), with windows chosen so
+        that each approximant is accurate to about `tolerance` times the
+        largest value of `function`.
+
+        Starting from the whole domain, windows are bisected until the
+        last two Chebyshev coefficients of their approximants are below
+        the tolerance, so the windows are small only where `function`
+        varies quickly.
+        """
+        windows = [tuple(domain)]
+        accepted = []
+        scale = 0.
+        while windows:
+            approximants = [
+                Chebyshev.interpolate(function, degree, domain=window)
+                for window in windows]
+            # The sum of the coefficients bounds the approximant:
+            scale = max([scale] + [np.abs(approximant.coef).sum()
+                                   for approximant in approximants])
+            refined = []
+            for window, approximant in zip(windows, approximants):
+                error = np.abs(approximant.coef[-2:]).max()
+                if error <= tolerance * scale:
+                    accepted.append((window, approximant.coef))
+                else:
+                    middle = 0.5 * (window[0] + window[1])
+                    refined.extend([(window[0], middle), (middle, window[1])])
+            if len(accepted) + len(refined) > max_windows:
+                msg = "Could not approximate to tolerance {} in {} windows"
+                raise RuntimeError(msg.format(tolerance, max_windows))
+            windows = refined
+        accepted.sort(key=lambda window_coef: window_coef[0][0])
+        window_breakpoints = np.array(
+            [window[0] for window, _ in accepted] + [domain[1]])
+        coefficients = np.array([coef for _, coef in accepted])
+        return cls._from_coefficients(
+            window_breakpoints, coefficients, function=function)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an approximant saved with `save`. The loaded approximant
+        can be evaluated but does not know its function."""
+        with np.load(filename) as saved:
+            return cls._from_coefficients(
+                saved['window_breakpoints'], saved['coefficients'])
+
+    def save(self, filename):
+        """Save the windows and Chebyshev coefficients to `filename`, so
+        that the approximant can be reused without evaluating the
+        function again."""
+        with open(filename, 'wb') as f:
+            np.savez(f, window_breakpoints=self.window_breakpoints,
+                     coefficients=self._coefficients.T)
+
+    @classmethod
+    def _from_coefficients(cls, window_breakpoints, coefficients,
+                           function=None):
+        approximant = cls.__new__(cls)
+        approximant.function = function
+        approximant.degree = coefficients.shape[1] - 1
+        approximant.window_breakpoints = np.asarray(window_breakpoints)
+        approximant.args = ()
+
+        approximant._domain = (
+            window_breakpoints[0], window_breakpoints[-1])
+        approximant._windows = approximant._setup_windows()
+        approximant._approximants = [
+            Chebyshev(coef, domain=window)
+            for coef, window in zip(coefficients, approximant._windows)]
+        approximant._dtype = coefficients.dtype
+        approximant._setup_coefficients()
+        return approximant
 
     def _setup_windows(self):
         windows = [
@@ -644,19 +833,69 @@ class PiecewiseChebyshevApproximant(object):
                     self.function, self.degree, domain=window, *self.args)
                 for window in self._windows]
 
+    def _setup_coefficients(self):
+        # (degree + 1, nwindows), so that each step of the Clenshaw
+        # recurrence gathers from one contiguous row
+        self._coefficients = np.ascontiguousarray(np.array(
+            [approximant.coef for approximant in self._approximants]).T)
+        self._coefficients_real = np.ascontiguousarray(
+            self._coefficients.real)
+        self._coefficients_imag = np.ascontiguousarray(
+            self._coefficients.imag)
+        self._breakpoints = np.asarray(self.window_breakpoints, dtype=float)
+
     def __call__(self, x):
         x = np.asarray(x)
         if x.max() >= self._domain[1] or x.min() < self._domain[0]:
             msg = "x must be within interpolation window [{}, {})".format(
                 *self._domain)
             raise ValueError(msg)
+        if len(self._windows) <= MAX_MASKED_WINDOWS:
+            return self._evaluate_by_window(x)
+        # All windows are evaluated at once: each point finds its window
+        # and the Clenshaw recurrence runs with per-point coefficients.
+        window = np.searchsorted(self._breakpoints, x, side='right') - 1
+        start = self._breakpoints[window]
+        stop = self._breakpoints[window + 1]
+        t = (2 * x - (start + stop)) / (stop - start)
+        if np.iscomplexobj(self._coefficients):
+            # real arithmetic is much faster than mixed real-complex:
+            return (_clenshaw(self._coefficients_real, t, window) +
+                    1j * _clenshaw(self._coefficients_imag, t, window))
+        return _clenshaw(self._coefficients, t, window)
+
+    def _evaluate_by_window(self, x):
         result = np.zeros(x.shape, dtype=self._dtype)
-        for window, approximant in zip(self._windows, self._approximants):
+        for i, window in enumerate(self._windows):
             mask = self._mask_window(x, window)
-            result[mask] = approximant(x[mask])
+            t = (2 * x[mask] - (window[0] + window[1])) / (
+                window[1] - window[0])
+            if np.iscomplexobj(self._coefficients):
+                result[mask] = (
+                    _clenshaw(self._coefficients_real[:, i], t) +
+                    1j * _clenshaw(self._coefficients_imag[:, i], t))
+            else:
+                result[mask] = _clenshaw(self._coefficients[:, i], t)
         return result
 
     @classmethod
     def _mask_window(cls, x, window):
         return (x >= window[0]) & (x < window[1])
 
+
+def _clenshaw(coefficients, t, window=None):
+    """Sum of the Chebyshev series with real coefficients at t. With
+    `window`, coefficients is a (degree + 1, nwindows) array and each
+    point t uses the series coefficients[:, window]; otherwise it is the
+    (degree + 1,) series for every point."""
+    b1 = np.zeros(t.shape)
+    b2 = np.zeros(t.shape)
+    two_t = 2 * t
+    next_b = np.empty(t.shape)
+    for coef in coefficients[:0:-1]:
+        np.multiply(two_t, b1, out=next_b)
+        next_b -= b2
+        next_b += coef if window is None else coef[window]
+        b1, b2, next_b = next_b, b1, b2
+    first = coefficients[0] if window is None else coefficients[0][window]
+    return first + t * b1 - b2
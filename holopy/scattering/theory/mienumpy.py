@@ -0,0 +1,470 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+"""
+NumPy implementations of the Lorenz-Mie routines in ``mie_f``.
+
+The field routines are vectorized over field points, where the Fortran
+routines in ``mieangfuncs`` loop over them; the recurrences for the
+scattering coefficients are per sphere and are plain Python ports.
+The fields inside and around layered spheres (`layered_coeffs`,
+`layered_fields`) have no Fortran counterpart. This module must not
+import from ``mie_f``, which falls back on it when the Fortran extension
+is not built.
+"""
+import numpy as np
+from scipy.special import riccati_jn, riccati_yn, spherical_jn, spherical_yn
+
+from holopy.scattering.theory.scatteringtheory import (
+    calc_scat_field, fields_to_cartesian, incident_field_in_scattering_plane)
+from holopy.scattering.theory.mielensfunctions import calculate_pil_taul
+
+
+def lentz_dn1(z, n, eps1, eps2):
+    """
+    Logarithmic derivative D_n(z) of the Riccati-Bessel function psi_n,
+    for a single order `n`, by the Lentz (1976) continued fraction.
+    Port of ``mieangfuncs.lentz_dn1``, including the workaround for
+    ill-conditioning (numerator or denominator below `eps1`); converges
+    when the products differ from 1 by less than `eps2`.
+    """
+    z = complex(z)
+
+    def a_i(i):
+        # Lentz eqn. 9; Lentz's v is our n + 0.5
+        return (-1)**(i + 1) * 2 * (n + i - 0.5) / z
+
+    a1 = a_i(1)
+    a2 = a_i(2)
+    numerator = a2 + 1. / a1
+    denominator = a2
+    nth_product = a1 * numerator / denominator
+    nth_convergent = nth_product
+    ctr = 3
+    while (abs(nth_product.real - 1) > eps2 or
+           abs(nth_product.imag) > eps2):
+        ai = a_i(ctr)
+        numerator = ai + 1. / numerator
+        denominator = ai + 1. / denominator
+        if abs(numerator / ai) < eps1 or abs(denominator / ai) < eps1:
+            # Wiscombe eqns. 34-35
+            aiplus1 = a_i(ctr + 1)
+            xi1 = 1. + aiplus1 * numerator
+            xi2 = 1. + aiplus1 * denominator
+            nth_convergent = nth_convergent * xi1 / xi2
+            aiplus2 = a_i(ctr + 2)
+            numerator = aiplus2 + numerator / xi1
+            denominator = aiplus2 + denominator / xi2
+            ctr += 2
+        nth_product = numerator / denominator
+        nth_convergent = nth_convergent * nth_product
+        ctr += 1
+    return nth_convergent - n / z
+
+
+def dn_1_down(z, nmx, nstop, start_val):
+    """
+    Logarithmic derivatives D_n(z), n = 0 to `nstop`, by downward
+    recursion from D_nmx = `start_val`. Port of ``mieangfuncs.dn_1_down``.
+    """
+    z = complex(z)
+    dn = np.zeros(nmx + 1, dtype='complex128')
+    dn[nmx] = start_val
+    for i in range(nmx, 0, -1):
+        dn[i - 1] = i / z - 1. / (dn[i] + i / z)
+    return dn[:nstop + 1]
+
+
+def scatcoeffs(m, x, nstop, eps1=1e-3, eps2=1e-16):
+    """
+    Lorenz-Mie scattering coefficients a_n, b_n, n = 1 to `nstop`, as an
+    array (2, nstop). Same algorithm as ``miescatlib.scatcoeffs``
+    ([Bohren1983]_ eq. 4.88).
+    """
+    dnmx = dn_1_down(m * x, nstop + 1, nstop,
+                     lentz_dn1(m * x, nstop + 1, eps1, eps2))
+    n = np.arange(nstop + 1)
+    psi = riccati_jn(nstop, x)[0]
+    xi = psi + 1j * riccati_yn(nstop, x)[0]
+    psishift = np.concatenate((np.zeros(1), psi))[:nstop + 1]
+    xishift = np.concatenate((np.zeros(1), xi))[:nstop + 1]
+    an = (((dnmx / m + n / x) * psi - psishift) /
+          ((dnmx / m + n / x) * xi - xishift))
+    bn = (((dnmx * m + n / x) * psi - psishift) /
+          ((dnmx * m + n / x) * xi - xishift))
+    return np.array([an[1:], bn[1:]])
+
+
+def mie_fields(positions, scat_coeffs, einc, compute_escat_radial=True,
+               full_radial_dependence=True, chunksize=4096):
+    """
+    Fields scattered by a spherically symmetric scatterer, evaluated at
+    all points at once. Array equivalent of ``mieangfuncs.mie_fields``.
+
+    Parameters
+    ----------
+    positions : (3, N) array
+        (kr, theta, phi) of the points, relative to the scatterer.
+    scat_coeffs : (2, nstop) complex array
+        Scattering coefficients a_n, b_n.
+    einc : (2,) array
+        The (x, y) incident polarization.
+    compute_escat_radial : bool
+        Whether to include the radial (near-field) component.
+    full_radial_dependence : bool
+        Whether to use the spherical Hankel functions, rather than their
+        far-field limits, in the amplitude scattering matrices.
+    chunksize : int
+        Number of points for which the (npoints, nstop) special
+        functions are held at once.
+
+    Returns
+    -------
+    (3, N) complex array
+        Cartesian components of the scattered field.
+    """
+    kr, theta, phi = positions
+    if full_radial_dependence:
+        scat_matrs = asm_mie_fullradial(scat_coeffs, kr, theta, chunksize)
+    else:
+        scat_matrs = asm_mie_far(scat_coeffs, theta, chunksize)
+    escat_sph = calc_scat_field(kr, phi, scat_matrs, einc)
+    fields = fields_to_cartesian(escat_sph, theta, phi)
+    if compute_escat_radial:
+        einc_parallel = einc[0] * np.cos(phi) + einc[1] * np.sin(phi)
+        escat_rad = einc_parallel * radial_field_mie(
+            scat_coeffs[0], kr, theta, chunksize)
+        fields += escat_rad * np.array([
+            np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi),
+            np.cos(theta)])
+    return fields
+
+
+def asm_mie_far(scat_coeffs, theta, chunksize=4096):
+    """
+    Far-field amplitude scattering matrices for a spherically symmetric
+    scatterer, evaluated at all angles `theta` at once.
+
+    Array equivalent of ``mieangfuncs.asm_mie_far``. The angular functions
+    pi_n, tau_n are computed by upward recurrence for a chunk of angles at
+    a time, so the intermediate arrays stay small, and are contracted
+    against the scattering coefficients with a single matrix product.
+
+    Parameters
+    ----------
+    scat_coeffs : ndarray (2, nstop), complex
+        Scattering coefficients a_n, b_n
+    theta : ndarray (N,)
+        Spherical coordinate theta (radians)
+    chunksize : int, optional
+        Number of angles to evaluate at once.
+
+    Returns
+    -------
+    ndarray (N, 2, 2), complex
+        Amplitude scattering matrices in the Bohren & Huffman form. Only
+        the diagonal elements, S2 and S1, are nonzero.
+    """
+    theta = np.atleast_1d(theta)
+    al, bl = scat_coeffs
+    nstop = al.shape[0]
+    l = np.arange(1, nstop + 1)
+    prefactor = (2. * l + 1.) / (l * (l + 1.))
+    # real and imaginary parts of the weighted a_n, b_n, stacked so that
+    # the contraction is a real matrix product:
+    weights = np.array([
+        (prefactor * al).real, (prefactor * al).imag,
+        (prefactor * bl).real, (prefactor * bl).imag])
+
+    asm = np.zeros((theta.size, 2, 2), dtype='complex128')
+    for start in range(0, theta.size, chunksize):
+        these = slice(start, start + chunksize)
+        pis, taus = calculate_pil_taul(theta[these], nstop)
+        pi_sums = pis.dot(weights.T)
+        tau_sums = taus.dot(weights.T)
+        asm[these, 0, 0].real = tau_sums[:, 0] + pi_sums[:, 2]
+        asm[these, 0, 0].imag = tau_sums[:, 1] + pi_sums[:, 3]
+        asm[these, 1, 1].real = pi_sums[:, 0] + tau_sums[:, 2]
+        asm[these, 1, 1].imag = pi_sums[:, 1] + tau_sums[:, 3]
+    return asm
+
+
+def asm_mie_fullradial(scat_coeffs, kr, theta, chunksize=4096):
+    """
+    Amplitude scattering matrices with the full radial dependence of the
+    spherical Hankel functions, normalized so that the far-field
+    formalism of `calc_scat_field` applies. Array equivalent of
+    ``mieangfuncs.asm_mie_fullradial``; returns (N, 2, 2).
+    """
+    kr = np.atleast_1d(kr)
+    theta = np.atleast_1d(theta)
+    al, bl = scat_coeffs
+    nstop = al.shape[0]
+    l = np.arange(1, nstop + 1)
+    prefactor = (2. * l + 1.) / (l * (l + 1.)) * 1j**l
+
+    asm = np.zeros((theta.size, 2, 2), dtype='complex128')
+    for start in range(0, theta.size, chunksize):
+        these = slice(start, start + chunksize)
+        pis, taus = calculate_pil_taul(theta[these], nstop)
+        hl, dhl = _hankel_and_derivative(l, kr[these])
+        a_dhl = al * prefactor * dhl
+        b_hl = 1j * bl * prefactor * hl
+        inv_prefactor = np.exp(-1j * kr[these]) * kr[these]
+        asm[these, 0, 0] = inv_prefactor * (
+            (a_dhl * taus).sum(axis=1) + (b_hl * pis).sum(axis=1))
+        asm[these, 1, 1] = inv_prefactor * (
+            (a_dhl * pis).sum(axis=1) + (b_hl * taus).sum(axis=1))
+    return asm
+
+
+def radial_field_mie(al, kr, theta, chunksize=4096):
+    """
+    Dimensionless radial component of the scattered field, which needs a
+    prefactor of the incident field parallel to the scattering plane.
+    Array equivalent of ``mieangfuncs.radial_field_mie``; see Bohren &
+    Huffman pp. 94-95.
+    """
+    kr = np.atleast_1d(kr)
+    theta = np.atleast_1d(theta)
+    nstop = al.shape[0]
+    l = np.arange(1, nstop + 1)
+    weights = al * (2 * l + 1) * 1j**(l + 1)
+
+    erad = np.zeros(theta.size, dtype='complex128')
+    for start in range(0, theta.size, chunksize):
+        these = slice(start, start + chunksize)
+        pis, _ = calculate_pil_taul(theta[these], nstop)
+        hl, _ = _hankel_and_derivative(l, kr[these])
+        erad[these] = (np.sin(theta[these]) / kr[these] *
+                       (weights * pis * hl).sum(axis=1))
+    return erad
+
+
+def _hankel_and_derivative(l, kr):
+    """h_l(kr) = j_l + i y_l and (d/dkr)(kr h_l) / kr, as (N, nstop)."""
+    l = l.reshape(1, -1)
+    kr = kr.reshape(-1, 1)
+    hl = spherical_jn(l, kr) + 1j * spherical_yn(l, kr)
+    dhl = (hl / kr + spherical_jn(l, kr, derivative=True) +
+           1j * spherical_yn(l, kr, derivative=True))
+    return hl, dhl
+
+
+def layered_coeffs(m_arr, x_arr, nstop):
+    """
+    Coefficients of the field in every region of a layered sphere, the
+    core first and the surrounding medium last.
+
+    In each region, with relative index m, the field is the expansion of
+    [Bohren1983]_ eq. 8.1, sum_n E_n (M_o1n[u_n] - i N_e1n[v_n]), with
+    radial functions u_n = A j_n(m k r) + B y_n(m k r) for the transverse
+    electric part and likewise v_n for the transverse magnetic part.
+    Outside, A = 1 - b_n and B = -i b_n (and a_n for v_n), so the field is
+    the incident plus the scattered field. The coefficients are carried
+    outward from the core, where B = 0, by matching the tangential fields
+    at each interface, and normalized at each step; the matching to the
+    incident field fixes the overall scale. Orders that overflow on the
+    way out are left as the incident field outside and zero inside.
+
+    Parameters
+    ----------
+    m_arr, x_arr : array_like
+        Relative indices and size parameters of the layers, core first.
+    nstop : int
+        Number of orders.
+
+    Returns
+    -------
+    (nlayers + 1, 2, 2, nstop) complex array
+        The coefficients, indexed by region, (TE, TM), (A, B) and order.
+    """
+    m_regions = np.append(np.asarray(m_arr, dtype=complex), 1.)
+    l = np.arange(1, nstop + 1)
+    coeffs = np.zeros((m_regions.size, 2, 2, nstop), dtype=complex)
+    coeffs[0, :, 0] = 1.
+    log_scale = np.zeros((m_regions.size, 2, nstop))
+    with np.errstate(all='ignore'):
+        for layer, x in enumerate(np.asarray(x_arr, dtype=float)):
+            m_in, m_out = m_regions[layer], m_regions[layer + 1]
+            (a_te, b_te), (a_tm, b_tm) = coeffs[layer]
+            psi, dpsi, eta, deta = _riccati_bessel(l, m_in * x)
+            # tangential E and H of each part, up to common factors
+            te_e, te_h = (a_te * psi + b_te * eta) / m_in, \
+                a_te * dpsi + b_te * deta
+            tm_e, tm_h = (a_tm * dpsi + b_tm * deta) / m_in, \
+                a_tm * psi + b_tm * eta
+            # invert the same relations outside the interface, using the
+            # Wronskian psi * deta - dpsi * eta = 1
+            psi, dpsi, eta, deta = _riccati_bessel(l, m_out * x)
+            outer = np.array([
+                [m_out * deta * te_e - eta * te_h,
+                 psi * te_h - m_out * dpsi * te_e],
+                [deta * tm_h - m_out * eta * tm_e,
+                 m_out * psi * tm_e - dpsi * tm_h]])
+            norm = np.abs(outer).max(axis=1)
+            coeffs[layer + 1] = outer / norm[:, np.newaxis]
+            log_scale[layer + 1] = log_scale[layer] + np.log(norm)
+        # outside, A + i B = 1 for the incident field to have unit amplitude
+        outside = coeffs[-1, :, 0] + 1j * coeffs[-1, :, 1]
+        coeffs *= (np.exp(log_scale - log_scale[-1]) /
+                   outside)[:, :, np.newaxis]
+    failed = ~np.isfinite(coeffs).all(axis=(0, 2))
+    for part, order in zip(*np.nonzero(failed)):
+        coeffs[:, part, :, order] = 0
+        coeffs[-1, part, 0, order] = 1
+    return coeffs
+
+
+def layered_fields(positions, m_arr, x_arr, coeffs, einc, chunksize=4096):
+    """
+    Total field inside and around a spherically symmetric scatterer:
+    the internal field inside, and the incident plus the scattered field
+    outside, with the incident field of unit amplitude and zero phase at
+    the center of the scatterer.
+
+    Parameters
+    ----------
+    positions : (3, N) array
+        (kr, theta, phi) of the points, with k the wavevector in the
+        medium.
+    m_arr, x_arr : array_like
+        Relative indices and size parameters of the layers, core first.
+    coeffs : (nlayers + 1, 2, 2, nstop) complex array
+        Coefficients from `layered_coeffs`.
+    einc : (2,) array
+        The (x, y) incident polarization.
+    chunksize : int
+        Number of points for which the (npoints, nstop) special functions
+        are held at once, which bounds the memory used for any number of
+        points.
+
+    Returns
+    -------
+    (3, N) complex array
+        Cartesian components of the field.
+    """
+    kr, theta, phi = (np.asarray(p, dtype=float) for p in positions)
+    m_regions = np.append(np.asarray(m_arr, dtype=complex), 1.)
+    nstop = coeffs.shape[-1]
+    l = np.arange(1, nstop + 1)
+    en = 1j**l * (2. * l + 1.) / (l * (l + 1.))
+    # points on an interface belong to the region inside it
+    region = np.searchsorted(np.asarray(x_arr, dtype=float), kr)
+    einc_sph = incident_field_in_scattering_plane(einc, phi)
+
+    fields = np.zeros((3, kr.size), dtype=complex)
+    for start in range(0, kr.size, chunksize):
+        these = np.arange(start, min(start + chunksize, kr.size))
+        for this_region in np.unique(region[these]):
+            points = these[region[these] == this_region]
+            (a_te, b_te), (a_tm, b_tm) = coeffs[this_region]
+            outside = this_region == len(m_regions) - 1
+            if outside:
+                # the expansion of the incident field converges slowly
+                # away from the scatterer, so it is added in closed form
+                a_te, a_tm = a_te - 1, a_tm - 1
+            # the field is finite at the center, where only n = 1
+            # contributes, so evaluate it just off the center
+            rho = m_regions[this_region] * np.maximum(kr[points], 1e-12)
+            pis, taus = calculate_pil_taul(theta[points], nstop)
+            u, v, dv = _radial_functions(
+                l, rho, a_te, b_te, a_tm, b_tm, this_region > 0)
+            e_theta = (en * (pis * u - 1j * taus * dv)).sum(axis=1)
+            e_phi = (en * (taus * u - 1j * pis * dv)).sum(axis=1)
+            sintheta = np.sin(theta[points])
+            e_r = (sintheta / rho *
+                   (en * -1j * l * (l + 1) * pis * v).sum(axis=1))
+            fields[:, points] = fields_to_cartesian(
+                [einc_sph[0, points] * e_theta,
+                 -einc_sph[1, points] * e_phi],
+                theta[points], phi[points])
+            fields[:, points] += einc_sph[0, points] * e_r * np.array([
+                sintheta * np.cos(phi[points]),
+                sintheta * np.sin(phi[points]), np.cos(theta[points])])
+            if outside:
+                fields[:2, points] += np.outer(
+                    einc[:2], np.exp(1j * kr[points] * np.cos(theta[points])))
+    return fields
+
+
+def _riccati_bessel(l, z):
+    """psi_l(z) = z j_l(z) and eta_l(z) = z y_l(z), and their derivatives."""
+    j = spherical_jn(l, z)
+    y = spherical_yn(l, z)
+    return (z * j, j + z * spherical_jn(l, z, derivative=True),
+            z * y, y + z * spherical_yn(l, z, derivative=True))
+
+
+def _radial_functions(l, rho, a_te, b_te, a_tm, b_tm, singular):
+    """u_l(rho), v_l(rho) and (rho v_l)' / rho as (N, nstop); the y_l terms
+    are only evaluated if `singular`, since they diverge at rho = 0."""
+    j, dj, y, dy = _spherical_bessel(l.size, rho, singular)
+    u = a_te * j
+    v = a_tm * j
+    dv = a_tm * dj
+    if singular:
+        u = u + b_te * y
+        v = v + b_tm * y
+        dv = dv + b_tm * dy
+    return u, v, dv + v / rho[:, np.newaxis]
+
+
+def _spherical_bessel(nstop, rho, singular=True):
+    """
+    j_l(rho), j_l'(rho), y_l(rho), y_l'(rho) for l = 1 to `nstop`, as
+    (N, nstop) arrays for the (N,) complex array `rho` (y_l only if
+    `singular`). Vectorized recurrences, which for many points are much
+    faster than the order-by-order evaluation in scipy.special.
+    """
+    rho = rho.astype(complex)
+    sin = np.sin(rho)
+    cos = np.cos(rho)
+    l = np.arange(nstop + 1)
+    # ratios j_l / j_(l-1) by downward recurrence, started high enough
+    # above both nstop and |rho| to have converged
+    size = np.abs(rho).max()
+    start = max(nstop, int(size + 4.05 * size**(1. / 3.) + 2)) + 16
+    ratios = np.zeros((rho.size, nstop + 2), dtype=complex)
+    ratio = np.zeros_like(rho)
+    with np.errstate(all='ignore'):
+        for order in range(start, 0, -1):
+            ratio = 1. / ((2 * order + 1) / rho - ratio)
+            if order <= nstop + 1:
+                ratios[:, order] = ratio
+        # normalize to whichever of j_0 and j_1 is larger, so that the
+        # zeros of either are handled
+        j0 = sin / rho
+        j1 = sin / rho**2 - cos / rho
+        j1 = np.where(np.abs(j0) > np.abs(j1), j0 * ratios[:, 1], j1)
+        j = np.empty((rho.size, nstop + 2), dtype=complex)
+        j[:, 0] = j0
+        j[:, 1:] = j1[:, np.newaxis] * np.cumprod(
+            np.concatenate((np.ones((rho.size, 1)), ratios[:, 2:]), axis=1),
+            axis=1)
+    rho = rho[:, np.newaxis]
+    dj = j[:, :-2] - (l[1:] + 1) / rho * j[:, 1:-1]
+    if not singular:
+        return j[:, 1:-1], dj, None, None
+    y = np.empty((rho.shape[0], nstop + 1), dtype=complex)
+    y[:, 0] = -cos / rho[:, 0]
+    y[:, 1] = -cos / rho[:, 0]**2 - sin / rho[:, 0]
+    for order in range(1, nstop):
+        y[:, order + 1] = (2 * order + 1) / rho[:, 0] * y[:, order] - \
+            y[:, order - 1]
+    dy = y[:, :-1] - (l[1:] + 1) / rho * y[:, 1:]
+    return j[:, 1:-1], dj, y[:, 1:], dy
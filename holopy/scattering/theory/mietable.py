@@ -0,0 +1,276 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tabulated Lorenz-Mie scattering coefficients.
+
+A fit of a sphere's radius and index evaluates the Mie coefficients
+a_n(m, x), b_n(m, x) at thousands of nearby (m, x). A
+`MieCoefficientTable` computes them once on a regular grid of size
+parameter x and real part of the relative index m, stores the grid in a
+memory-mapped file so that it can be shared between fits and processes,
+and interpolates it with local tensor-product Lagrange polynomials.
+"""
+import math
+import os
+
+import numpy as np
+import yaml
+
+from holopy.core import prior
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key)
+try:
+    from holopy.scattering.theory.mie_f import miescatlib
+except ImportError:
+    pass
+
+COEFFICIENTS_FILENAME = 'coefficients.npy'
+GRID_FILENAME = 'grid.yaml'
+open_tables = CoefficientCache(maxsize=8)
+
+
+class MieCoefficientTable(object):
+    """
+    Mie coefficients of homogeneous spheres on a regular (x, m) grid.
+
+    Build a table with `build` or `from_model`, save it with `save`, and
+    reopen it (memory-mapped) with `load`. Calling the table returns the
+    coefficients as `miescatlib.scatcoeffs` would.
+
+    Attributes
+    ----------
+    error_bound : float
+        The largest absolute error of the interpolated coefficients,
+        relative to a direct calculation, found at random points of the
+        table when it was built.
+    """
+    def __init__(self, coefficients, x_range, m_range, m_imag=0., order=6,
+                 error_bound=None, filename=None):
+        """
+        Parameters
+        ----------
+        coefficients : (nx, nm, 2, lmax) complex array
+            a_n, b_n at each grid point, zero-padded beyond the order
+            needed at that point.
+        x_range, m_range : 2-element tuple
+            The first and last size parameter and real part of the
+            relative index of the grid.
+        m_imag : float
+            The imaginary part of the relative index, which is fixed.
+        order : int
+            Number of grid points along each axis used to interpolate.
+        """
+        self.coefficients = coefficients
+        self.x_range = tuple(float(v) for v in x_range)
+        self.m_range = tuple(float(v) for v in m_range)
+        self.m_imag = float(m_imag)
+        self.order = int(order)
+        self.error_bound = error_bound
+        self.filename = filename
+        self._x_grid = _grid(self.x_range, coefficients.shape[0])
+        self._m_grid = _grid(self.m_range, coefficients.shape[1])
+
+    @classmethod
+    def build(cls, x_range, m_range, m_imag=0., x_spacing=0.05,
+              m_spacing=0.002, order=6, eps1=1e-2, eps2=1e-16,
+              nvalidate=100, seed=0):
+        """
+        Calculate a table covering `x_range` and `m_range`.
+
+        The grid is extended by half the interpolation stencil on each
+        side, so that points near the ends of the ranges are interpolated
+        as accurately as points in the middle. `eps1` and `eps2` are as
+        for :class:`.Mie`; `nvalidate` random points are compared to a
+        direct calculation to set `error_bound`.
+        """
+        pad = order / 2
+        x_min = max(x_range[0] - pad * x_spacing, x_spacing)
+        x_max = x_range[1] + pad * x_spacing
+        m_min = m_range[0] - pad * m_spacing
+        m_max = m_range[1] + pad * m_spacing
+        nx = max(int(np.ceil((x_max - x_min) / x_spacing)) + 1, order)
+        nm = max(int(np.ceil((m_max - m_min) / m_spacing)) + 1, order)
+        x_nodes = np.linspace(x_min, x_max, nx)
+        m_nodes = np.linspace(m_min, m_max, nm) + 1j * m_imag
+
+        # Every node gets a few orders beyond its own nstop, so that all
+        # the nodes of a stencil have the orders needed at its center.
+        lmax = [miescatlib.nstop(x) + 4 for x in x_nodes]
+        coefficients = np.zeros((nx, nm, 2, max(lmax)), dtype='complex')
+        for i, (x, nstop) in enumerate(zip(x_nodes, lmax)):
+            for j, m in enumerate(m_nodes):
+                coefficients[i, j, :, :nstop] = miescatlib.scatcoeffs(
+                    m, x, nstop, eps1, eps2)
+        # high orders at small x can underflow in the recurrences
+        coefficients[~np.isfinite(coefficients)] = 0
+
+        table = cls(coefficients, (x_min, x_max), (m_min, m_max), m_imag,
+                    order)
+        table.error_bound = table._validate(
+            x_range, m_range, nvalidate, eps1, eps2, seed)
+        return table
+
+    @classmethod
+    def from_model(cls, model, medium_index=None, illum_wavelen=None,
+                   nsd=5, **kwargs):
+        """
+        Calculate a table covering the priors of a single-sphere `model`.
+
+        Gaussian priors are covered to `nsd` standard deviations. The
+        medium index and wavelength are taken from the model unless
+        given. Other keyword arguments are passed to `build`.
+        """
+        if medium_index is None:
+            medium_index = model.medium_index
+        if illum_wavelen is None:
+            illum_wavelen = model.illum_wavelen
+        medium_wavevec = 2 * np.pi * medium_index / illum_wavelen
+        scatterer = model.scatterer
+        r_range = _range_of(scatterer.r, nsd)
+        n = scatterer.n
+        if isinstance(n, prior.ComplexPrior):
+            n_range = _range_of(n.real, nsd)
+            m_imag = n.imag
+        else:
+            n_range = _range_of(np.real(n) if np.isscalar(n) else n, nsd)
+            m_imag = np.imag(n) if np.isscalar(n) else 0.
+        if isinstance(m_imag, prior.Prior):
+            raise ValueError("The imaginary part of the index must be fixed "
+                             "to tabulate Mie coefficients")
+        return cls.build(
+            tuple(medium_wavevec * np.array(r_range)),
+            tuple(np.array(n_range) / medium_index),
+            m_imag=m_imag / medium_index, **kwargs)
+
+    @classmethod
+    def load(cls, filename):
+        """Open a table saved with `save`, memory-mapping its
+        coefficients."""
+        with open(os.path.join(filename, GRID_FILENAME)) as grid_file:
+            grid = yaml.safe_load(grid_file)
+        coefficients = np.load(
+            os.path.join(filename, COEFFICIENTS_FILENAME), mmap_mode='r')
+        return cls(coefficients, filename=filename, **grid)
+
+    def save(self, filename):
+        """Save the table in the directory `filename`."""
+        os.makedirs(filename, exist_ok=True)
+        np.save(os.path.join(filename, COEFFICIENTS_FILENAME),
+                self.coefficients)
+        grid = {'x_range': list(self.x_range), 'm_range': list(self.m_range),
+                'm_imag': self.m_imag, 'order': self.order,
+                'error_bound': (None if self.error_bound is None
+                                else float(self.error_bound))}
+        with open(os.path.join(filename, GRID_FILENAME), 'w') as grid_file:
+            yaml.safe_dump(grid, grid_file)
+        self.filename = filename
+
+    def contains(self, m, x):
+        """Whether (m, x) can be interpolated from the table."""
+        m = complex(m)
+        return (self.x_range[0] <= x <= self.x_range[1] and
+                self.m_range[0] <= m.real <= self.m_range[1] and
+                abs(m.imag - self.m_imag) <= 1e-12)
+
+    def __call__(self, m, x):
+        """
+        Interpolated a_n and b_n for relative index `m` and size parameter
+        `x`, as an array (2, nstop(x)).
+        """
+        if not self.contains(m, x):
+            raise ValueError("(m, x) = ({}, {}) is outside the table".format(
+                m, x))
+        i, x_weights = _lagrange_weights(self._x_grid, x, self.order)
+        j, m_weights = _lagrange_weights(
+            self._m_grid, complex(m).real, self.order)
+        nstop = miescatlib.nstop(x)
+        stencil = self.coefficients[
+            i:i + self.order, j:j + self.order, :, :nstop]
+        weights = np.outer(x_weights, m_weights).ravel()
+        return weights.dot(stencil.reshape(weights.size, -1)).reshape(
+            2, nstop)
+
+    def __repr__(self):
+        if self.filename is not None:
+            return "{}.load({!r})".format(
+                self.__class__.__name__, self.filename)
+        return "{}(x_range={}, m_range={}, m_imag={})".format(
+            self.__class__.__name__, self.x_range, self.m_range, self.m_imag)
+
+    def _validate(self, x_range, m_range, npts, eps1, eps2, seed):
+        random = np.random.RandomState(seed)
+        errors = [0.]
+        for x, m in zip(random.uniform(*x_range, size=npts),
+                        random.uniform(*m_range, size=npts)):
+            m = m + 1j * self.m_imag
+            exact = miescatlib.scatcoeffs(m, x, miescatlib.nstop(x),
+                                          eps1, eps2)
+            errors.append(np.abs(self(m, x) - exact).max())
+        return float(max(errors))
+
+
+def get_table(table_or_filename):
+    """The `MieCoefficientTable` for a table or the filename of a saved
+    table; saved tables stay open for reuse."""
+    if isinstance(table_or_filename, MieCoefficientTable):
+        return table_or_filename
+    return open_tables.get(
+        make_key(os.path.abspath(table_or_filename)),
+        lambda: MieCoefficientTable.load(table_or_filename))
+
+
+def _grid(value_range, npts):
+    start, stop = value_range
+    return start, (stop - start) / (npts - 1), npts
+
+
+def _lagrange_weights(grid, value, order):
+    """The first index and the Lagrange interpolation weights of the
+    `order` points of the equally-spaced `grid` centered on `value`.
+    Called once per lookup, so this works with python floats."""
+    start, spacing, npts = grid
+    position = (value - start) / spacing
+    first = min(max(math.floor(position) - (order - 1) // 2, 0),
+                npts - order)
+    offsets = [position - first - k for k in range(order)]
+    weights = []
+    for k in range(order):
+        weight = 1.
+        for j in range(order):
+            if j != k:
+                weight *= offsets[j] / (k - j)
+        weights.append(weight)
+    return first, weights
+
+
+def _range_of(parameter, nsd):
+    if isinstance(parameter, prior.BoundedGaussian):
+        return (max(parameter.lower_bound, parameter.mu - nsd * parameter.sd),
+                min(parameter.upper_bound, parameter.mu + nsd * parameter.sd))
+    if isinstance(parameter, prior.Gaussian):
+        return (parameter.mu - nsd * parameter.sd,
+                parameter.mu + nsd * parameter.sd)
+    if isinstance(parameter, prior.Uniform):
+        if not np.isfinite(parameter.interval):
+            raise ValueError("Cannot tabulate Mie coefficients over an "
+                             "unbounded prior")
+        return (parameter.lower_bound, parameter.upper_bound)
+    if isinstance(parameter, prior.Prior):
+        raise ValueError("Cannot find the range of prior {}".format(
+            parameter))
+    return (parameter, parameter)
@@ -31,7 +31,6 @@ import numpy as np
 import os
 from numpy import arctan2, sin, cos
 from warnings import warn
-from scipy.integrate import dblquad
 
 from holopy.core.utils import SuppressOutput
 from holopy.core.errors import DependencyMissing
@@ -39,6 +38,8 @@ from holopy.scattering.scatterer import Spheres,Sphere
 from holopy.scattering.errors import (
     TheoryNotCompatibleError, InvalidScatterer, MultisphereFailure)
 from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key)
 try:
     from holopy.scattering.theory.mie_f import (uts_scsmfo, scsmfo_min,
                                                 mieangfuncs)
@@ -46,6 +47,12 @@ try:
 except ImportError:
     _COMPILED_FORTRAN = False
 
+# The last solution of the interaction equations for each number of spheres
+# and set of theory options, used as the initial iterate with warm_start.
+# A fit makes a new theory for every evaluation, so these are kept here
+# rather than on the theory.
+warm_start_cache = CoefficientCache(maxsize=16)
+
 def normalize_polarization(illum_polarization):
     return (illum_polarization / np.sqrt((illum_polarization**2).sum()))[:2]
 
@@ -77,9 +84,21 @@ class Multisphere(ScatteringTheory):
     qeps2 : float (optional)
         error tolerance used to determine at what order the cluster
         spherical harmonic expansion should be truncated
+    warm_start : bool (optional)
+        if True, start the solution of the interaction equations from the
+        last solution for a cluster with the same number of spheres, in
+        the same medium, rather than from the single-sphere
+        coefficients. Successive clusters in a fit differ only slightly,
+        so this saves iterations. The solutions are shared by all
+        Multisphere theories with the same options, in the module's
+        `warm_start_cache`.
 
     Notes
     -----
+    After each solution of the interaction equations, `last_iterations`
+    holds the number of iterations used for each of the two incident
+    polarizations.
+
     According to Mackowski's manual for SCSMFO1B.FOR [1]_ and later
     papers [2]_, the biconjugate gradient is generally the most
     efficient method for solving the interaction equations, especially
@@ -121,7 +140,8 @@ class Multisphere(ScatteringTheory):
 
     """
     def __init__(self, niter=200, eps=1e-6, meth=1, qeps1=1e-5, qeps2=1e-8,
-                 compute_escat_radial=False, suppress_fortran_output=True):
+                 compute_escat_radial=False, suppress_fortran_output=True,
+                 warm_start=False):
         self.niter = niter
         self.eps = eps
         self.meth = meth
@@ -129,6 +149,8 @@ class Multisphere(ScatteringTheory):
         self.qeps2 = qeps2
         self.compute_escat_radial = compute_escat_radial
         self.suppress_fortran_output=suppress_fortran_output
+        self.warm_start = warm_start
+        self.last_iterations = None
 
         if not _COMPILED_FORTRAN:
             raise DependencyMissing("Multisphere theory", "This is probably "
@@ -183,15 +205,26 @@ class Multisphere(ScatteringTheory):
         if (centers > 1e4).any():
             raise InvalidScatterer(scatterer, "Particle separation "
                                         "too large, calculation would take forever")
+        last_solution = None
+        if self.warm_start:
+            key = make_key('multisphere', len(scatterer.scatterers),
+                           medium_wavevec, medium_index, repr(self))
+            last_solution = warm_start_cache.get(key, lambda: None)
         with SuppressOutput(suppress_output=self.suppress_fortran_output):
             # The fortran code uses oppositely directed z axis (they
             # have laser propagation as positive, we have it negative),
             # so we multiply the z coordinate by -1 to correct for that.
-            _, lmax, amn0, converged = scsmfo_min.amncalc(
-                1, centers[:,0],  centers[:,1],
-                -1.0 * centers[:,2],  m.real, m.imag,
-                scatterer.r * medium_wavevec, self.niter, self.eps,
-                self.qeps1, self.qeps2,  self.meth, (0,0))
+            args = (1, centers[:,0],  centers[:,1],
+                    -1.0 * centers[:,2],  m.real, m.imag,
+                    scatterer.r * medium_wavevec, self.niter, self.eps,
+                    self.qeps1, self.qeps2,  self.meth, (0,0))
+            if last_solution is None:
+                result = scsmfo_min.amnsolve(*args, 0)
+            else:
+                result = scsmfo_min.amnsolve(
+                    *args, 1, amn=last_solution.copy(order='F'))
+        _, lmax, amn0, converged, solution, iterations = result
+        self.last_iterations = tuple(int(i) for i in iterations)
 
         # converged == 1 if the SCSMFO iterative solver converged
         # f2py converts F77 LOGICAL to int
@@ -208,6 +241,8 @@ class Multisphere(ScatteringTheory):
         if np.isnan(amn).any():
             raise MultisphereFailure()
 
+        if self.warm_start:
+            warm_start_cache.put(key, solution)
         return amn, lmax
 
     def raw_fields(self, positions, scatterer, medium_wavevec, medium_index,
@@ -261,8 +296,7 @@ class Multisphere(ScatteringTheory):
         positions
         '''
         amn, lmax = self._scsmfo_setup(scatterer, medium_wavevec=medium_wavevec, medium_index=medium_index)
-        scat_matrs = [_asm_far(theta, phi, amn, lmax) for r, theta, phi in pos.T]
-        return scat_matrs
+        return _asm_far(pos[1], pos[2], amn, lmax)
 
     def _calc_cscat(self, scatterer, medium_wavevec, medium_index, illum_polarization, amn = None, lmax = None):
         '''
@@ -320,15 +354,11 @@ class Multisphere(ScatteringTheory):
         if amn is None:
             amn, lmax = self._scsmfo_setup(scatterer, medium_wavevec=medium_wavevec, medium_index=medium_index)
 
-        # define integrand: A^2 sin theta (vector scattering amplitude A)
+        # define integrand: A^2 (vector scattering amplitude A)
         def ampsq(theta, phi):
-            einc = mieangfuncs.incfield(*pol, phi = phi)
-            asm = _asm_far(theta, phi, amn, lmax)
-            ascat_sph = np.dot(asm, einc) # in par/perp basis
-            ascatsq = (np.abs(ascat_sph)**2).sum()
-            return ascatsq * np.sin(theta)
+            return _scattered_amplitude_squared(theta, phi, pol, amn, lmax)
 
-        integral = _integrate4pi(ampsq)
+        integral = _integrate4pi(ampsq, lmax)
 
         cscat = integral / medium_wavevec**2
         return cscat
@@ -340,15 +370,12 @@ class Multisphere(ScatteringTheory):
         """
         pol = normalize_polarization(illum_polarization)
 
-        # define integrand: A^2 sin theta cos theta
+        # define integrand: A^2 cos theta
         def costhetawt(theta, phi):
-            einc = mieangfuncs.incfield(*pol, phi = phi)
-            asm = _asm_far(theta, phi, amn, lmax)
-            ascat_sph = np.dot(asm, einc) # in par/perp basis
-            ascatsq = (np.abs(ascat_sph)**2).sum()
-            return ascatsq * np.sin(theta) * np.cos(theta)
+            return (_scattered_amplitude_squared(theta, phi, pol, amn, lmax)
+                    * np.cos(theta))
 
-        integral = _integrate4pi(costhetawt)
+        integral = _integrate4pi(costhetawt, lmax + 1)
 
         asym = integral / medium_wavevec**2 # need to divide by cscat
         return asym
@@ -389,17 +416,44 @@ class Multisphere(ScatteringTheory):
 
 def _asm_far(theta, phi, amn, lmax):
     """
-    Calculate far field amplitude scattering matrix for fixed angles
+    Calculate far field amplitude scattering matrices, as a (2, 2) array
+    for scalar angles or an (N, 2, 2) array for arrays of N angles
     """
-    asm = np.roll(uts_scsmfo.asm(amn, lmax, theta, phi),
-                  -1).reshape((2,2)) * -0.5 #correction factor
+    theta, phi = np.broadcast_arrays(theta, phi)
+    sa = uts_scsmfo.asmvec(amn, lmax, theta.ravel(), phi.ravel())
+    # asm returns (s1, s2, s3, s4); the matrix is ((s2, s3), (s4, s1))
+    asm = sa[[1, 2, 3, 0]].T.reshape((-1, 2, 2)) * -0.5 #correction factor
+    if theta.ndim == 0:
+        return asm[0]
     return asm
 
-def _integrate4pi(integrand):
+def _scattered_amplitude_squared(theta, phi, pol, amn, lmax):
+    """
+    |A|^2 of the vector scattering amplitude A for incident polarization
+    `pol` at arrays of angles
+    """
+    asm = _asm_far(theta, phi, amn, lmax)
+    # incident field in par/perp basis, as mieangfuncs.incfield
+    ex, ey = np.asarray(pol, dtype=float)
+    einc = np.array([ex * np.cos(phi) + ey * np.sin(phi),
+                     ex * np.sin(phi) - ey * np.cos(phi)])
+    ascat_sph = np.einsum('nij,jn->ni', asm, einc)
+    return (np.abs(ascat_sph)**2).sum(axis=1)
+
+def _integrate4pi(integrand, order):
     '''
-    Integrate integrand(theta, phi) over 4 pi of spherical solid angle.
-    Integrand should already have factor of sin theta.
+    Integrate integrand(theta, phi) over 4 pi of spherical solid angle,
+    with integrand evaluated on arrays of angles.
+
+    Uses a product of Gauss-Legendre quadrature in cos theta and the
+    trapezoid rule in phi, which is exact (to round-off) for integrands
+    that are sums of spherical harmonics of degree up to 2 * order + 1,
+    such as the squared amplitude of a VSH expansion to order `order`.
     '''
-    integral, error = dblquad(integrand, 0, 2 * np.pi, lambda theta:0.,
-                              lambda theta:np.pi)
-    return integral
+    costheta, theta_wts = np.polynomial.legendre.leggauss(order + 1)
+    nphi = 2 * order + 4
+    theta, phi = np.meshgrid(np.arccos(costheta),
+                             np.arange(nphi) * 2 * np.pi / nphi,
+                             indexing='ij')
+    values = integrand(theta.ravel(), phi.ravel()).reshape(theta.shape)
+    return (theta_wts.dot(values)).sum() * 2 * np.pi / nphi
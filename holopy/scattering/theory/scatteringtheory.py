@@ -24,10 +24,6 @@
 import numpy as np
 
 from holopy.core.holopy_object import HoloPyObject
-try:
-    from holopy.scattering.theory.mie_f import mieangfuncs
-except ImportError:
-    pass
 
 
 class ScatteringTheory(HoloPyObject):
@@ -52,9 +48,15 @@ class ScatteringTheory(HoloPyObject):
     By default, ScatteringTheories computer `raw_fields` from the
     `raw_scat_matrs`; over-ride the `raw_fields` method to compute the
     fields in a different way.
+
+    Subclasses whose `raw_scat_matrs` are diagonal and do not depend on
+    the azimuthal angle phi for every scatterer they can handle should
+    set `azimuthally_symmetric` to True; theories that wrap them, such
+    as `Lens`, can then integrate over phi analytically.
     """
     desired_coordinate_system = 'spherical'
     parameter_names = tuple()
+    azimuthally_symmetric = False
 
     def __init__(self):
         # holopy's yaml functionality inspects the code, so we need an
@@ -80,14 +82,10 @@ class ScatteringTheory(HoloPyObject):
         scat_matr = self.raw_scat_matrs(
             scatterer, pos, medium_wavevec=medium_wavevec,
             medium_index=medium_index)
-
-        fields = np.zeros_like(pos.T, dtype=np.array(scat_matr).dtype)
-        for i, point in enumerate(pos.T):
-            kr, theta, phi = point
-            escat_sph = mieangfuncs.calc_scat_field(
-                kr, phi, scat_matr[i], illum_polarization.values[:2])
-            fields[i] = mieangfuncs.fieldstocart(escat_sph, theta, phi)
-        return fields.T
+        kr, theta, phi = pos
+        escat_sph = calc_scat_field(
+            kr, phi, scat_matr, illum_polarization.values[:2])
+        return fields_to_cartesian(escat_sph, theta, phi)
 
     @property
     def parameters(self):
@@ -110,3 +108,58 @@ class ScatteringTheory(HoloPyObject):
         kwargs = self._dict
         kwargs.update(parameters)
         return self.__class__(**kwargs)
+
+
+def calc_scat_field(kr, phi, scat_matrs, illum_polarization):
+    """Far-field scattered field from amplitude scattering matrices.
+
+    Vectorized equivalent of ``mieangfuncs.calc_scat_field``, evaluated
+    for all N points at once.
+
+    Parameters
+    ----------
+    kr, phi : (N,) numpy.ndarray
+        Dimensionless radial coordinate and azimuthal angle of each point.
+    scat_matrs : (N, 2, 2) array_like
+        Amplitude scattering matrix at each point, in the Bohren & Huffman
+        convention.
+    illum_polarization : (2,) array_like
+        The (x, y) incident polarization.
+
+    Returns
+    -------
+    escat_sph : (2, N) numpy.ndarray
+        The (theta, phi) spherical components of the scattered field.
+    """
+    scat_matrs = np.asarray(scat_matrs)
+    einc_sph = incident_field_in_scattering_plane(illum_polarization, phi)
+    prefactor = 1j / kr * np.exp(1j * kr)  # Bohren & Huffman formalism
+    escat_sph = prefactor * np.einsum('nij,jn->in', scat_matrs, einc_sph)
+    escat_sph[1] *= -1  # accounts for escatperp = -escatphi
+    return escat_sph
+
+
+def incident_field_in_scattering_plane(illum_polarization, phi):
+    """Decompose the (x, y) incident polarization into components parallel
+    and perpendicular to the scattering plane at azimuthal angles `phi`.
+    Vectorized equivalent of ``mieangfuncs.incfield``; returns (2, N).
+    """
+    ex, ey = illum_polarization[0], illum_polarization[1]
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
+    return np.array([ex * cosphi + ey * sinphi, ex * sinphi - ey * cosphi])
+
+
+def fields_to_cartesian(escat_sph, theta, phi):
+    """Convert (2, N) (theta, phi) field components to (3, N) Cartesian
+    components. Vectorized equivalent of ``mieangfuncs.fieldstocart``.
+    """
+    e_theta, e_phi = escat_sph
+    costheta = np.cos(theta)
+    sintheta = np.sin(theta)
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
+    return np.array([
+        costheta * cosphi * e_theta - sinphi * e_phi,
+        costheta * sinphi * e_theta + cosphi * e_phi,
+        -sintheta * e_theta])
@@ -28,17 +28,13 @@ import numpy as np
 from holopy.scattering.scatterer import Sphere, Spheroid, Cylinder
 from holopy.scattering.errors import TheoryNotCompatibleError, TmatrixFailure
 from holopy.core.errors import DependencyMissing
-from holopy.scattering.theory.scatteringtheory import ScatteringTheory
+from holopy.scattering.theory.scatteringtheory import (
+    ScatteringTheory, calc_scat_field, fields_to_cartesian)
 try:
     from holopy.scattering.theory.tmatrix_f.S import ampld
     COMPILED_TMATRIX_FORTRAN = True
 except ModuleNotFoundError:
     COMPILED_TMATRIX_FORTRAN = False
-try:
-    from holopy.scattering.theory.mie_f import mieangfuncs
-    _NO_MIEANGFUNCS = False
-except ImportError:
-    _NO_MIEANGFUNCS = True
 
 class Tmatrix(ScatteringTheory):
     """
@@ -141,21 +137,10 @@ class Tmatrix(ScatteringTheory):
 
         scat_matr = self.raw_scat_matrs(scatterer, pos,
                     medium_wavevec=medium_wavevec, medium_index=medium_index)
-        fields = np.zeros_like(pos.T, dtype = scat_matr.dtype)
-
-        if _NO_MIEANGFUNCS:
-            warnings.warn("Problem with holopy.scattering.theory.mie_f.mieang"
-                          "funcs. This is probably due to a problem compiling"
-                          "Fortran code. Returning scattering matrices only,"
-                          "not fields. Subsequent calculations will fail.")
-            return scat_matr
-
-        for i, point in enumerate(pos.T):
-            kr, theta, phi = point
-            # TODO: figure out why postfactor is needed -- it is not used in dda.py
-            postfactor = np.array([[np.cos(phi),np.sin(phi)],
-                                   [-np.sin(phi),np.cos(phi)]])
-            escat_sph = mieangfuncs.calc_scat_field(kr, phi,
-                                    np.dot(scat_matr[i],postfactor), [1,0])
-            fields[i] = mieangfuncs.fieldstocart(escat_sph, theta, phi)
-        return fields.T
+        kr, theta, phi = pos
+        # TODO: figure out why postfactor is needed -- it is not used in dda.py
+        postfactor = np.array([[np.cos(phi), np.sin(phi)],
+                               [-np.sin(phi), np.cos(phi)]])
+        scat_matr = np.einsum('nij,jkn->nik', scat_matr, postfactor)
+        escat_sph = calc_scat_field(kr, phi, scat_matr, [1, 0])
+        return fields_to_cartesian(escat_sph, theta, phi)
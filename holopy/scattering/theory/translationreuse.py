@@ -0,0 +1,102 @@
+# Copyright 2011-2016, Vinothan N. Manoharan, Thomas G. Dimiduk,
+# Rebecca W. Perry, Jerome Fung, Ryan McGorty, Anna Wang, Solomon Barkley
+#
+# This file is part of HoloPy.
+#
+# HoloPy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HoloPy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HoloPy.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Reuse of tabulated fields from axially symmetric scatterers when only the
+scatterer's transverse position changes.
+
+For an x-polarized incident beam, the field scattered by a sphere onto a
+plane a distance z away has the form, in cylindrical coordinates,
+
+    E_rho = A(krho) cos(phi),  E_phi = -B(krho) sin(phi),
+    E_z = C(krho) cos(phi),
+
+and the field for any other polarization follows by linearity and
+rotation. The three radial profiles depend only on (n, r, z), so they are
+tabulated once on a fine 1D grid in krho and interpolated onto the
+detector for each new (x, y).
+"""
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+from holopy.scattering.theory.coefficientcache import (
+    CoefficientCache, make_key)
+
+TABULATION_SPACING = 0.05  # in units of 1/k; ~125 points per wavelength
+planar_field_cache = CoefficientCache(maxsize=16)
+
+
+def is_planar(kz):
+    """Whether the points at (dimensionless) heights `kz` lie on one plane
+    perpendicular to the optical axis."""
+    kz = np.asarray(kz)
+    mean_kz = np.mean(kz)
+    return np.ptp(kz) <= 1e-13 * (1 + np.abs(mean_kz))
+
+
+def calc_planar_field(calculate_xpol_field, key, krho, phi, polarization):
+    """Interpolate the field on a plane from tabulated radial profiles.
+
+    Parameters
+    ----------
+    calculate_xpol_field : function
+        Called as ``calculate_xpol_field(krho, phi)`` with 1D arrays, it
+        returns the (3, N) cartesian field from an x-polarized beam at
+        those points on the plane.
+    key : tuple
+        Everything besides the transverse position that the field depends
+        on (scatterer, plane height, medium, and theory options).
+    krho, phi : numpy.ndarray
+        Cylindrical coordinates of the detector points relative to the
+        scatterer, with the radial coordinate rescaled by the wavevector.
+    polarization : 2-element array-like
+        The (x, y) components of the incident polarization. May be
+        complex.
+
+    Returns
+    -------
+    field : (3, N) numpy.ndarray
+    """
+    # Round the tabulated range up to a power of 2, so that small moves
+    # of the scatterer keep using the same table.
+    krho_max = 2 ** np.ceil(np.log2(max(np.max(krho), 1.0)))
+    profiles = planar_field_cache.get(
+        key + make_key(krho_max),
+        lambda: _tabulate_radial_profiles(calculate_xpol_field, krho_max))
+    radial_a, radial_b, radial_c = profiles(krho)
+
+    pol_x, pol_y = np.asarray(polarization)[:2]
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
+    along_pol = pol_x * cosphi + pol_y * sinphi
+    across_pol = pol_y * cosphi - pol_x * sinphi
+    e_rho = radial_a * along_pol
+    e_phi = radial_b * across_pol
+    return np.array([
+        e_rho * cosphi - e_phi * sinphi,
+        e_rho * sinphi + e_phi * cosphi,
+        radial_c * along_pol])
+
+
+def _tabulate_radial_profiles(calculate_xpol_field, krho_max):
+    npts = int(np.ceil(krho_max / TABULATION_SPACING)) + 4
+    krho = np.linspace(0, krho_max, npts)
+    # Along phi = 0 the field is (A, 0, C); along phi = pi/2 it is (B, 0, 0)
+    on_axis = calculate_xpol_field(krho, np.zeros(npts))
+    off_axis = calculate_xpol_field(krho, np.full(npts, np.pi / 2))
+    radial_profiles = np.array([on_axis[0], off_axis[0], on_axis[2]])
+    return CubicSpline(krho, radial_profiles, axis=1)